@@ -0,0 +1,124 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
+from pydantic import BaseModel
+from datetime import date, timedelta
+from typing import Optional
+import asyncio
+import os
+from app.core.config import settings
+from app.core import profiling
+from app.core.dependencies import get_invoice_archive, get_webhook_queue
+from app.core.security import revoke_token
+from app.services.circuit_breaker import circuit_breakers
+
+router = APIRouter()
+
+class ProfilingUpdate(BaseModel):
+    # Profile sync runs for this many minutes from now; 0 stops
+    syncRunsMinutes: Optional[float] = None
+
+class TokenRevocation(BaseModel):
+    token: Optional[str] = None
+    jti: Optional[str] = None
+
+class ArchiveRequest(BaseModel):
+    before: Optional[date] = None
+
+def _isoformat(moment):
+    return moment.isoformat() if moment else None
+
+@router.get("/admin/profiling")
+async def read_profiling():
+    return {
+        "enabled": settings.PROFILING_ENABLED,
+        "syncRuns": settings.PROFILE_SYNC_RUNS,
+        "syncRunsUntil": _isoformat(profiling.sync_runs_profiled_until()),
+        "header": profiling.PROFILE_HEADER,
+    }
+
+@router.post("/admin/profiling")
+async def update_profiling(profiling_update: ProfilingUpdate):
+    """
+    Profile sync runs for the next `syncRunsMinutes` (up to a day), on every
+    worker sharing PROFILE_DIR; 0 stops early. PROFILE_SYNC_RUNS profiles
+    them all the time instead.
+    """
+    if not settings.PROFILING_ENABLED:
+        raise HTTPException(status_code=400, detail="Profiling is disabled (set PROFILING_ENABLED)")
+    minutes = profiling_update.syncRunsMinutes
+    if minutes is not None:
+        window = timedelta(minutes=minutes)
+        if window < timedelta(0) or window > profiling.MAX_SYNC_PROFILE_WINDOW:
+            limit = profiling.MAX_SYNC_PROFILE_WINDOW.total_seconds() / 60
+            raise HTTPException(status_code=400, detail=f"syncRunsMinutes must be between 0 and {limit:g}")
+        profiling.profile_sync_runs_for(window)
+    return {"syncRuns": settings.PROFILE_SYNC_RUNS, "syncRunsUntil": _isoformat(profiling.sync_runs_profiled_until())}
+
+@router.get("/admin/profiles")
+async def list_profiles():
+    return profiling.list_profiles()
+
+@router.get("/admin/profiles/{profile_id}")
+async def download_profile(profile_id: str):
+    path = profiling.get_profile_path(profile_id)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, filename=os.path.basename(path))
+
+@router.post("/admin/tokens/revoke")
+async def revoke(revocation: TokenRevocation):
+    if not revocation.token and not revocation.jti:
+        raise HTTPException(status_code=400, detail="Provide a token or jti to revoke")
+    revoke_token(token=revocation.token, jti=revocation.jti)
+    return {"message": "Token revoked"}
+
+@router.get("/admin/webhooks")
+async def webhook_queue_stats():
+    queue = get_webhook_queue()
+    return {**queue.stats, "queued": queue.queue.qsize()}
+
+@router.get("/admin/circuits")
+async def circuit_states():
+    """
+    State of each upstream's circuit breaker, with call counts since startup
+    """
+    return {
+        "enabled": settings.CIRCUIT_BREAKERS_ENABLED,
+        "circuits": circuit_breakers.snapshot(),
+    }
+
+@router.post("/admin/circuits/{upstream}/reset")
+async def reset_circuit(upstream: str):
+    """
+    Close an upstream's circuit now, e.g. once an outage is known to be over
+    """
+    if upstream not in circuit_breakers.breakers:
+        raise HTTPException(status_code=404, detail="Unknown upstream")
+    circuit_breakers[upstream].reset()
+    return circuit_breakers[upstream].snapshot()
+
+@router.get("/admin/archive")
+async def archive_status():
+    archive = get_invoice_archive()
+    return {
+        "running": archive.is_running(),
+        "cutoff": archive.cutoff().isoformat(),
+        "afterMonths": settings.ARCHIVE_AFTER_MONTHS,
+        "intervalSeconds": settings.ARCHIVE_INTERVAL_SECONDS,
+        "lastRun": archive.last_run,
+    }
+
+@router.post("/admin/archive")
+async def run_archive(archive_request: Optional[ArchiveRequest] = None):
+    """
+    Archive pushed invoices from closed periods now; `before` overrides the
+    cutoff (ARCHIVE_AFTER_MONTHS ago) and is rounded down to a month
+    """
+    archive = get_invoice_archive()
+    before = archive_request.before if archive_request else None
+    if before and before > archive.cutoff():
+        raise HTTPException(status_code=400, detail=f"Periods from {archive.cutoff().isoformat()} on are still open")
+    result = await asyncio.to_thread(archive.run, before)
+    if result is None:
+        raise HTTPException(status_code=409, detail="An archive run is already in progress")
+    return result
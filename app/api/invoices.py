@@ -1,104 +1,163 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Any, Dict, List, Optional
 from datetime import datetime
+import asyncio
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 from app.core.database import get_db
+from app.core.dependencies import get_invoice_archive, get_sync_scheduler, get_tenant_id, get_validation_service
+from app.core.http_cache import cached_response
+from app.core.profiling import sync_run_profile
 from app.models.invoice import Invoice, InvoiceStatus
-from app.services.dext_service import DextService
+from app.services.archive_service import InvoiceArchive
+from app.services.sync_scheduler import SyncScheduler, UnknownTenantError
 from app.services.validation_service import ValidationService
-from app.services.xero_service import XeroService
 
 router = APIRouter()
-dext_service = DextService()
-validation_service = ValidationService()
-xero_service = XeroService()
 
-@router.get("/invoices", response_model=List[Invoice])
+class InvoiceResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    dext_id: Optional[str] = None
+    supplier_name: Optional[str] = None
+    vat_number: Optional[str] = None
+    vat_code: Optional[str] = None
+    amount: Optional[float] = None
+    date: Optional[datetime] = None
+    status: Optional[InvoiceStatus] = None
+    confidence_score: Optional[float] = None
+    validation_errors: Optional[Any] = None
+    xero_invoice_id: Optional[str] = None
+    tenant_id: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    # Read from the Parquet archive of closed periods
+    archived: bool = False
+
+invoice_adapter = TypeAdapter(InvoiceResponse)
+# Lists are built from the response's columns as plain rows, which skips
+# constructing ORM objects and models for every invoice
+INVOICE_COLUMNS = [column for column in Invoice.__table__.c if column.name in InvoiceResponse.model_fields]
+invoice_rows_adapter = TypeAdapter(List[Dict[str, Any]])
+
+def _get_tenant_invoice(db: Session, invoice_id: int, tenant_id: str) -> Optional[Invoice]:
+    return db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.tenant_id == tenant_id).first()
+
+def _updated_at(invoice) -> Optional[datetime]:
+    # Invoices from the archive are plain dicts
+    return invoice["updated_at"] if isinstance(invoice, dict) else invoice.updated_at
+
+@router.get("/invoices", responses={200: {"model": List[InvoiceResponse]}})
 async def get_invoices(
+    request: Request,
     status: InvoiceStatus = None,
     start_date: datetime = None,
     end_date: datetime = None,
-    db: Session = Depends(get_db)
+    include_archived: bool = False,
+    db: Session = Depends(get_db),
+    tenant_id: str = Depends(get_tenant_id),
+    archive: InvoiceArchive = Depends(get_invoice_archive)
 ):
     """
-    Get all invoices with optional filtering
+    Get all invoices with optional filtering, including archived ones from
+    closed periods if requested. Cached until one of the tenant's invoices
+    changes; supports If-None-Match. There is no Last-Modified: deletes and
+    invoices leaving the filter would not move it.
     """
-    query = db.query(Invoice)
-    
-    if status:
-        query = query.filter(Invoice.status == status)
-    if start_date:
-        query = query.filter(Invoice.date >= start_date)
-    if end_date:
-        query = query.filter(Invoice.date <= end_date)
-        
-    return query.all()
+    async def render():
+        query = db.query(*INVOICE_COLUMNS).filter(Invoice.tenant_id == tenant_id)
+
+        if status:
+            query = query.filter(Invoice.status == status)
+        if start_date:
+            query = query.filter(Invoice.date >= start_date)
+        if end_date:
+            query = query.filter(Invoice.date <= end_date)
+
+        invoices = [{**row._asdict(), "archived": False} for row in query]
+        if include_archived:
+            # Scanning Parquet files blocks, so it runs off the event loop
+            invoices += await asyncio.to_thread(archive.read, tenant_id, status, start_date, end_date)
+        return invoice_rows_adapter.dump_json(invoices), None, None
+
+    key = ("list", status, start_date, end_date, include_archived)
+    return await cached_response(request, db, tenant_id, key, render)
 
 @router.post("/invoices/sync")
-async def sync_invoices(db: Session = Depends(get_db)):
+async def sync_invoices(
+    db: Session = Depends(get_db),
+    tenant_id: str = Depends(get_tenant_id),
+    scheduler: SyncScheduler = Depends(get_sync_scheduler)
+):
     """
     Sync invoices from Dext
     """
     try:
-        # Fetch invoices from Dext
-        invoices_data = await dext_service.fetch_invoices()
-        
-        for invoice_data in invoices_data:
-            # Process invoice data
-            invoice = dext_service.process_invoice(invoice_data)
-            
-            # Check if invoice already exists
-            existing_invoice = db.query(Invoice).filter(
-                Invoice.dext_id == invoice.dext_id
-            ).first()
-            
-            if existing_invoice:
-                continue
-                
-            # Validate invoice
-            validation_result = await validation_service.validate_invoice(invoice)
-            invoice.confidence_score = validation_result["confidence_score"]
-            
-            if validation_result["is_valid"]:
-                invoice.status = InvoiceStatus.VALIDATED
-                
-                # Push to Xero
-                xero_result = await xero_service.push_invoice(invoice)
-                if xero_result["success"]:
-                    invoice.xero_invoice_id = xero_result["xero_invoice_id"]
-                    invoice.status = InvoiceStatus.PUSHED_TO_XERO
-                else:
-                    invoice.status = InvoiceStatus.ERROR
-                    invoice.validation_errors = {"xero_error": xero_result["error"]}
-            else:
-                invoice.status = InvoiceStatus.ERROR
-                invoice.validation_errors = validation_result["errors"]
-            
-            db.add(invoice)
-        
-        db.commit()
-        return {"message": "Invoice sync completed successfully"}
+        scheduler.tenant_settings(db, tenant_id)
+    except UnknownTenantError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if scheduler.is_running(tenant_id):
+        raise HTTPException(status_code=409, detail="A sync is already running for this tenant")
+
+    try:
+        async with sync_run_profile():
+            metrics = await scheduler.run([tenant_id])
+        return {"message": "Invoice sync completed successfully", "metrics": metrics.get(tenant_id)}
         
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/invoices/{invoice_id}", response_model=Invoice)
-async def get_invoice(invoice_id: int, db: Session = Depends(get_db)):
+@router.get("/invoices/anomalies")
+async def scan_invoice_anomalies(
+    tenant_id: str = Depends(get_tenant_id),
+    scheduler: SyncScheduler = Depends(get_sync_scheduler)
+):
     """
-    Get a specific invoice by ID
+    Scan all stored invoices for likely duplicates and unusual amounts
     """
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    return invoice
+    if scheduler.anomaly_detector is None:
+        raise HTTPException(status_code=400, detail="Anomaly detection is disabled")
+    return await asyncio.to_thread(scheduler.anomaly_detector.scan, tenant_id)
+
+@router.get("/invoices/{invoice_id}", responses={200: {"model": InvoiceResponse}})
+async def get_invoice(
+    invoice_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    tenant_id: str = Depends(get_tenant_id),
+    archive: InvoiceArchive = Depends(get_invoice_archive)
+):
+    """
+    Get a specific invoice by ID, from the archive if it has been archived.
+    The ETag and Last-Modified come from the invoice's updated_at.
+    """
+    async def render():
+        invoice = _get_tenant_invoice(db, invoice_id, tenant_id)
+        if invoice is None:
+            invoice = await asyncio.to_thread(archive.get, tenant_id, invoice_id)
+        if not invoice:
+            raise HTTPException(status_code=404, detail="Invoice not found")
+        updated_at = _updated_at(invoice)
+        etag = None
+        if updated_at:
+            etag = f'W/"{invoice_id}-{updated_at.isoformat()}"'
+        body = invoice_adapter.dump_json(invoice_adapter.validate_python(invoice, from_attributes=True))
+        return body, updated_at, etag
+
+    return await cached_response(request, db, tenant_id, ("invoice", invoice_id), render)
 
 @router.post("/invoices/{invoice_id}/validate")
-async def validate_invoice(invoice_id: int, db: Session = Depends(get_db)):
+async def validate_invoice(
+    invoice_id: int,
+    db: Session = Depends(get_db),
+    tenant_id: str = Depends(get_tenant_id),
+    validation_service: ValidationService = Depends(get_validation_service)
+):
     """
     Manually trigger validation for a specific invoice
     """
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
+    invoice = _get_tenant_invoice(db, invoice_id, tenant_id)
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
         
@@ -115,24 +174,48 @@ async def validate_invoice(invoice_id: int, db: Session = Depends(get_db)):
     return validation_result
 
 @router.post("/invoices/{invoice_id}/push-to-xero")
-async def push_to_xero(invoice_id: int, db: Session = Depends(get_db)):
+async def push_to_xero(
+    invoice_id: int,
+    db: Session = Depends(get_db),
+    tenant_id: str = Depends(get_tenant_id),
+    scheduler: SyncScheduler = Depends(get_sync_scheduler)
+):
     """
-    Manually push a validated invoice to Xero
+    Manually push a validated invoice to Xero. If Xero is unavailable the
+    push is deferred to the next sync.
     """
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
+    invoice = _get_tenant_invoice(db, invoice_id, tenant_id)
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
         
     if invoice.status != InvoiceStatus.VALIDATED:
         raise HTTPException(status_code=400, detail="Invoice must be validated first")
         
-    xero_result = await xero_service.push_invoice(invoice)
-    if xero_result["success"]:
-        invoice.xero_invoice_id = xero_result["xero_invoice_id"]
-        invoice.status = InvoiceStatus.PUSHED_TO_XERO
-    else:
-        invoice.status = InvoiceStatus.ERROR
-        invoice.validation_errors = {"xero_error": xero_result["error"]}
-    
+    try:
+        ingestion = scheduler.tenant_context(db, tenant_id).ingestion
+    except UnknownTenantError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    xero_result = await ingestion.push(invoice)
+    db.commit()
+    return xero_result
+
+@router.post("/invoices/{invoice_id}/release")
+async def release_invoice(
+    invoice_id: int,
+    db: Session = Depends(get_db),
+    tenant_id: str = Depends(get_tenant_id)
+):
+    """
+    Clear an anomaly hold after review so the invoice can be pushed to Xero
+    """
+    invoice = _get_tenant_invoice(db, invoice_id, tenant_id)
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+
+    if invoice.status != InvoiceStatus.ON_HOLD:
+        raise HTTPException(status_code=400, detail="Invoice is not on hold")
+
+    invoice.status = InvoiceStatus.VALIDATED
+    invoice.validation_errors = None
     db.commit()
-    return xero_result 
\ No newline at end of file
+    return {"message": "Invoice released", "status": invoice.status.value}
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from typing import Optional
 from app.core.database import get_db
+from app.core.dependencies import get_tenant_id
 from app.models.settings import Settings
 from pydantic import BaseModel
 import json
@@ -14,33 +15,53 @@ class SettingsUpdate(BaseModel):
     xeroClientSecret: Optional[str] = None
     openaiApiKey: Optional[str] = None
     googleCloudVisionCredentials: Optional[str] = None
+    maxConcurrency: Optional[int] = None
+    xeroTenantId: Optional[str] = None
+    dextWebhookSecret: Optional[str] = None
 
-def get_settings(db: Session) -> Settings:
-    settings = db.query(Settings).first()
+def get_settings(db: Session, tenant_id: str) -> Settings:
+    settings = db.query(Settings).filter(Settings.tenant_id == tenant_id).first()
     if not settings:
-        settings = Settings()
+        settings = Settings(tenant_id=tenant_id)
         db.add(settings)
         db.commit()
         db.refresh(settings)
     return settings
 
+def claim_xero_tenant(db: Session, settings: Settings, xero_tenant_id: str):
+    """
+    Connect the tenant to a Xero organisation, which no other tenant may have
+    """
+    xero_tenant_id = xero_tenant_id or None
+    if xero_tenant_id:
+        owner = db.query(Settings).filter(
+            Settings.xero_tenant_id == xero_tenant_id, Settings.id != settings.id
+        ).first()
+        if owner:
+            raise HTTPException(status_code=409, detail="Xero organisation is connected to another tenant")
+    settings.xero_tenant_id = xero_tenant_id
+
 @router.get("/settings")
-async def read_settings(db: Session = Depends(get_db)):
-    settings = get_settings(db)
+async def read_settings(db: Session = Depends(get_db), tenant_id: str = Depends(get_tenant_id)):
+    settings = get_settings(db, tenant_id)
     return {
         "dextApiKey": settings.dext_api_key,
         "xeroClientId": settings.xero_client_id,
         "xeroClientSecret": settings.xero_client_secret,
         "openaiApiKey": settings.openai_api_key,
         "googleCloudVisionCredentials": settings.google_cloud_vision_credentials,
+        "maxConcurrency": settings.max_concurrency,
+        "xeroTenantId": settings.xero_tenant_id,
+        "dextWebhookSecret": settings.dext_webhook_secret,
     }
 
 @router.post("/settings")
 async def update_settings(
     settings_update: SettingsUpdate,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    tenant_id: str = Depends(get_tenant_id)
 ):
-    settings = get_settings(db)
+    settings = get_settings(db, tenant_id)
     
     if settings_update.dextApiKey is not None:
         settings.dext_api_key = settings_update.dextApiKey
@@ -50,6 +71,14 @@ async def update_settings(
         settings.xero_client_secret = settings_update.xeroClientSecret
     if settings_update.openaiApiKey is not None:
         settings.openai_api_key = settings_update.openaiApiKey
+    if settings_update.maxConcurrency is not None:
+        if settings_update.maxConcurrency < 1:
+            raise HTTPException(status_code=400, detail="maxConcurrency must be at least 1")
+        settings.max_concurrency = settings_update.maxConcurrency
+    if settings_update.xeroTenantId is not None:
+        claim_xero_tenant(db, settings, settings_update.xeroTenantId)
+    if settings_update.dextWebhookSecret is not None:
+        settings.dext_webhook_secret = settings_update.dextWebhookSecret
     if settings_update.googleCloudVisionCredentials is not None:
         try:
             credentials = json.loads(settings_update.googleCloudVisionCredentials)
@@ -0,0 +1,55 @@
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from pydantic import BaseModel
+from typing import List, Optional
+from app.core.dependencies import get_sync_scheduler
+from app.core.security import is_admin, may_act_for, token_tenants, verify_api_key
+from app.services.sync_scheduler import SyncScheduler
+
+# Multi-organisation syncs. POST /invoices/sync syncs the caller's own
+# tenant; these endpoints start a run across many tenants and report
+# per-tenant throughput.
+
+router = APIRouter()
+
+class SyncRunRequest(BaseModel):
+    tenants: Optional[List[str]] = None
+
+@router.post("/sync/run", status_code=202)
+async def start_sync_run(
+    background_tasks: BackgroundTasks,
+    sync_request: Optional[SyncRunRequest] = None,
+    scheduler: SyncScheduler = Depends(get_sync_scheduler),
+    claims: dict = Depends(verify_api_key)
+):
+    """
+    Start a sync of the given tenants in the background. Tenants already
+    being synced are skipped. Admins default to every configured tenant,
+    other callers to the tenants their token allows.
+    """
+    tenants = sync_request.tenants if sync_request else None
+    if not is_admin(claims):
+        if tenants is None:
+            tenants = token_tenants(claims)
+        if not all(may_act_for(claims, tenant_id) for tenant_id in tenants):
+            raise HTTPException(status_code=403, detail="Token does not grant access to these tenants")
+    background_tasks.add_task(scheduler.run, tenants)
+    return {"message": "Sync started", "tenants": tenants or "all"}
+
+@router.get("/sync/metrics")
+async def read_sync_metrics(
+    scheduler: SyncScheduler = Depends(get_sync_scheduler),
+    claims: dict = Depends(verify_api_key)
+):
+    """
+    Per-tenant progress and throughput of the latest run (for the tenants
+    the caller may see), plus current use of the shared upstream budget
+    """
+    return {
+        "workers": scheduler.workers,
+        "tenantConcurrency": scheduler.tenant_concurrency,
+        "budget": scheduler.budget.snapshot(),
+        "tenants": {
+            tenant_id: metrics for tenant_id, metrics in scheduler.metrics.items()
+            if may_act_for(claims, tenant_id)
+        },
+    }
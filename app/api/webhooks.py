@@ -0,0 +1,155 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+import base64
+import hashlib
+import hmac
+import json
+import logging
+from app.core.config import settings
+from app.core.database import get_db
+from app.core.dependencies import get_webhook_queue
+from app.models.settings import Settings
+from app.services.webhook_service import WebhookEvent, WebhookQueue
+
+# Webhook receivers. They only verify the signature and queue the affected
+# IDs; all fetching and processing happens in the WebhookQueue workers, so
+# the sender gets its acknowledgement straight away. The tenant always comes
+# from signed data: Dext events are signed with the tenant's own secret
+# (the URL's ?tenant= only says which secret to check), and Xero events
+# carry the Xero organisation's tenantId.
+
+router = APIRouter()
+
+logger = logging.getLogger("app.webhooks")
+
+DEXT_SIGNATURE_HEADER = "X-Dext-Signature"
+XERO_SIGNATURE_HEADER = "x-xero-signature"
+
+def _signature(secret: str, body: bytes) -> bytes:
+    return hmac.new(secret.encode(), body, hashlib.sha256).digest()
+
+def verify_dext_signature(body: bytes, signature: Optional[str], secret: Optional[str]) -> bool:
+    """
+    Dext signs the raw body with HMAC-SHA256, hex encoded
+    """
+    if not secret or not signature:
+        return False
+    expected = _signature(secret, body).hex()
+    return hmac.compare_digest(expected, signature.lower())
+
+def dext_webhook_secret(db: Session, tenant_id: str) -> Optional[str]:
+    """
+    Secret the tenant's Dext webhooks are signed with. DEXT_WEBHOOK_SECRET
+    only stands in for the default tenant's.
+    """
+    tenant_settings = db.query(Settings).filter(Settings.tenant_id == tenant_id).first()
+    if tenant_settings and tenant_settings.dext_webhook_secret:
+        return tenant_settings.dext_webhook_secret
+    if tenant_id == settings.DEFAULT_TENANT_ID:
+        return settings.DEXT_WEBHOOK_SECRET
+    return None
+
+def xero_tenants(db: Session, xero_tenant_ids: Iterable[str]) -> Dict[str, str]:
+    """
+    Our tenant for each known Xero organisation id. XERO_TENANT_ID maps to
+    the default tenant unless a tenant's settings claim it.
+    """
+    xero_tenant_ids = set(xero_tenant_ids)
+    rows = db.query(Settings.tenant_id, Settings.xero_tenant_id).filter(Settings.xero_tenant_id.in_(xero_tenant_ids))
+    tenants = {xero_tenant_id: tenant_id for tenant_id, xero_tenant_id in rows}
+    if settings.XERO_TENANT_ID in xero_tenant_ids:
+        tenants.setdefault(settings.XERO_TENANT_ID, settings.DEFAULT_TENANT_ID)
+    return tenants
+
+def verify_xero_signature(body: bytes, signature: Optional[str]) -> bool:
+    """
+    Xero signs the raw body with HMAC-SHA256 using the webhook key, base64 encoded
+    """
+    if not settings.XERO_WEBHOOK_KEY or not signature:
+        return False
+    expected = base64.b64encode(_signature(settings.XERO_WEBHOOK_KEY, body)).decode()
+    return hmac.compare_digest(expected, signature)
+
+def _parse_timestamp(value: Optional[str]) -> datetime:
+    if not value:
+        return datetime.utcnow()
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+
+@router.post("/webhooks/dext")
+async def receive_dext_webhook(
+    request: Request,
+    tenant: Optional[str] = None,
+    db: Session = Depends(get_db),
+    queue: WebhookQueue = Depends(get_webhook_queue)
+):
+    """
+    Dext document publication events:
+    {"id": "<delivery id>", "event": "document.published", "occurred_at": "...",
+     "data": {"id": "<document id>"}}
+    """
+    tenant = tenant or settings.DEFAULT_TENANT_ID
+    body = await request.body()
+    secret = dext_webhook_secret(db, tenant)
+    if not verify_dext_signature(body, request.headers.get(DEXT_SIGNATURE_HEADER), secret):
+        raise HTTPException(status_code=401, detail="Invalid signature")
+
+    try:
+        payload = json.loads(body)
+        event = WebhookEvent(
+            source="dext",
+            category="document",
+            resource_id=str(payload["data"]["id"]),
+            event_id=str(payload["id"]),
+            occurred_at=_parse_timestamp(payload.get("occurred_at")),
+            tenant_id=tenant,
+        )
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+
+    queued = queue.enqueue(event)
+    return {"queued": queued}
+
+@router.post("/webhooks/xero")
+async def receive_xero_webhook(
+    request: Request,
+    db: Session = Depends(get_db),
+    queue: WebhookQueue = Depends(get_webhook_queue)
+):
+    """
+    Xero invoice events. Xero expects 401 for a bad
+    signature and an empty 200 otherwise, including for its intent-to-receive
+    check, which carries no events. Each event is routed by its tenantId;
+    events for Xero organisations no tenant is connected to are ignored.
+    """
+    body = await request.body()
+    if not verify_xero_signature(body, request.headers.get(XERO_SIGNATURE_HEADER)):
+        return Response(status_code=401)
+
+    try:
+        payload = json.loads(body)
+        xero_events = payload.get("events", [])
+        tenants = xero_tenants(db, (xero_event["tenantId"] for xero_event in xero_events))
+        for xero_event in xero_events:
+            category = xero_event["eventCategory"]
+            if category != "INVOICE":
+                continue
+            tenant_id = tenants.get(xero_event["tenantId"])
+            if tenant_id is None:
+                logger.info("Ignoring Xero event for unknown organisation %s", xero_event["tenantId"])
+                continue
+            # Xero has no delivery id; resource, time and type identify a redelivery
+            event_id = f"{xero_event['resourceId']}:{xero_event['eventDateUtc']}:{xero_event['eventType']}"
+            queue.enqueue(WebhookEvent(
+                source="xero",
+                category=category,
+                resource_id=xero_event["resourceId"],
+                event_id=event_id,
+                occurred_at=_parse_timestamp(xero_event["eventDateUtc"]),
+                tenant_id=tenant_id,
+            ))
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+
+    return Response(status_code=200)
@@ -1,6 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from app.core.database import get_db
+from app.api.settings import claim_xero_tenant
+from app.core.dependencies import get_tenant_id
 from app.models.settings import Settings
 import requests
 from datetime import datetime, timedelta
@@ -10,17 +12,18 @@ router = APIRouter()
 
 XERO_AUTH_URL = "https://login.xero.com/identity/connect/authorize"
 XERO_TOKEN_URL = "https://identity.xero.com/connect/token"
+XERO_CONNECTIONS_URL = "https://api.xero.com/connections"
 XERO_SCOPE = "offline_access accounting.transactions accounting.contacts"
 
-def get_settings(db: Session) -> Settings:
-    settings = db.query(Settings).first()
+def get_settings(db: Session, tenant_id: str) -> Settings:
+    settings = db.query(Settings).filter(Settings.tenant_id == tenant_id).first()
     if not settings:
         raise HTTPException(status_code=404, detail="Settings not found")
     return settings
 
 @router.get("/xero/auth-url")
-async def get_xero_auth_url(db: Session = Depends(get_db)):
-    settings = get_settings(db)
+async def get_xero_auth_url(db: Session = Depends(get_db), tenant_id: str = Depends(get_tenant_id)):
+    settings = get_settings(db, tenant_id)
     
     if not settings.xero_client_id:
         raise HTTPException(
@@ -46,9 +49,10 @@ async def get_xero_auth_url(db: Session = Depends(get_db)):
 @router.post("/xero/callback")
 async def handle_xero_callback(
     code: str,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    tenant_id: str = Depends(get_tenant_id)
 ):
-    settings = get_settings(db)
+    settings = get_settings(db, tenant_id)
     
     if not settings.xero_client_id or not settings.xero_client_secret:
         raise HTTPException(
@@ -71,6 +75,21 @@ async def handle_xero_callback(
         token_response.raise_for_status()
         token_data = token_response.json()
         
+        # The organisation the user just connected; Xero calls and webhook
+        # events are matched to the tenant by it
+        connections_response = requests.get(
+            XERO_CONNECTIONS_URL,
+            headers={"Authorization": f"Bearer {token_data['access_token']}"}
+        )
+        connections_response.raise_for_status()
+        organisations = [
+            c["tenantId"] for c in connections_response.json() if c.get("tenantType") == "ORGANISATION"
+        ]
+        if not organisations:
+            raise HTTPException(status_code=400, detail="No Xero organisation connected")
+        if settings.xero_tenant_id not in organisations:
+            claim_xero_tenant(db, settings, organisations[0])
+
         # Update settings with tokens
         settings.xero_access_token = token_data["access_token"]
         settings.xero_refresh_token = token_data["refresh_token"]
@@ -81,6 +100,8 @@ async def handle_xero_callback(
         db.commit()
         return {"message": "Xero authentication successful"}
         
+    except HTTPException:
+        raise
     except requests.exceptions.RequestException as e:
         raise HTTPException(
             status_code=400,
@@ -93,8 +114,8 @@ async def handle_xero_callback(
         )
 
 @router.post("/xero/refresh-token")
-async def refresh_xero_token(db: Session = Depends(get_db)):
-    settings = get_settings(db)
+async def refresh_xero_token(db: Session = Depends(get_db), tenant_id: str = Depends(get_tenant_id)):
+    settings = get_settings(db, tenant_id)
     
     if not settings.xero_client_id or not settings.xero_client_secret or not settings.xero_refresh_token:
         raise HTTPException(
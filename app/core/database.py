@@ -1,7 +1,9 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+import logging
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,6 +18,25 @@ if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
 # Create SQLAlchemy engine
 engine = create_engine(DATABASE_URL)
 
+# Slow query log; 0 (the default) leaves the engine without any listeners
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "0"))
+slow_query_logger = logging.getLogger("app.slow_query")
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_start_time"].pop()) * 1000
+    if elapsed_ms >= SLOW_QUERY_THRESHOLD_MS:
+        slow_query_logger.warning("Slow query (%.1f ms): %s", elapsed_ms, statement)
+
+def enable_slow_query_log(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+if SLOW_QUERY_THRESHOLD_MS > 0:
+    enable_slow_query_log(engine)
+
 # Create SessionLocal class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -0,0 +1,53 @@
+from fastapi import Depends, Header, HTTPException
+from functools import lru_cache
+from typing import Optional
+from app.core.config import settings
+from app.core.security import is_admin, may_act_for, token_tenants, verify_api_key
+from app.services.archive_service import InvoiceArchive
+from app.services.sync_scheduler import SyncScheduler
+from app.services.validation_service import ValidationService
+from app.services.webhook_service import WebhookProcessor, WebhookQueue
+
+# Service factories for FastAPI's Depends(). Each service is built on the
+# first request that needs it and shared afterwards, so importing the API
+# modules does no client construction; tests and benchmarks can swap them
+# through app.dependency_overrides. Dext and Xero clients carry a tenant's
+# credentials, so they come from SyncScheduler.tenant_context instead.
+
+def get_tenant_id(
+    x_tenant_id: Optional[str] = Header(None),
+    claims: dict = Depends(verify_api_key)
+) -> str:
+    """
+    Organisation the request acts on, from the X-Tenant-ID header. The
+    header only picks among the tenants the caller's token allows; without
+    it a token for a single tenant acts for that one.
+    """
+    tenant_id = x_tenant_id
+    if not tenant_id:
+        allowed = [] if is_admin(claims) else token_tenants(claims)
+        tenant_id = allowed[0] if len(allowed) == 1 else settings.DEFAULT_TENANT_ID
+    if not may_act_for(claims, tenant_id):
+        raise HTTPException(status_code=403, detail="Token does not grant access to this tenant")
+    return tenant_id
+
+@lru_cache(maxsize=None)
+def get_validation_service() -> ValidationService:
+    return ValidationService()
+
+@lru_cache(maxsize=None)
+def get_sync_scheduler() -> SyncScheduler:
+    return SyncScheduler(get_validation_service())
+
+@lru_cache(maxsize=None)
+def get_invoice_archive() -> InvoiceArchive:
+    return InvoiceArchive()
+
+@lru_cache(maxsize=None)
+def get_webhook_queue() -> WebhookQueue:
+    processor = WebhookProcessor(get_sync_scheduler())
+    return WebhookQueue(
+        processor.handle,
+        workers=settings.WEBHOOK_WORKERS,
+        max_attempts=settings.WEBHOOK_MAX_ATTEMPTS
+    )
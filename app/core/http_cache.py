@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Awaitable, Callable, Hashable, Iterable, Optional, Tuple
+import gzip
+import hashlib
+import threading
+import time
+from fastapi import Request, Response
+from sqlalchemy import event, select, text
+from sqlalchemy.orm import Session
+from app.core.config import settings
+from app.models.invoice import Invoice
+from app.models.invoice_generation import InvoiceGeneration
+
+# Polling clients revalidate on every request; the conditional GET is what
+# keeps that cheap
+CACHE_CONTROL = "private, no-cache"
+VARY = "Accept-Encoding, X-Tenant-ID"
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: str
+    last_modified: Optional[datetime]
+    generation: int
+    created: float = field(default_factory=time.monotonic)
+    gzipped: Optional[bytes] = None
+
+    def gzip_body(self) -> Optional[bytes]:
+        """
+        Compressed body, computed once; None when compression does not help
+        """
+        if self.gzipped is None:
+            if len(self.body) < settings.GZIP_MINIMUM_SIZE:
+                self.gzipped = b""
+            else:
+                compressed = gzip.compress(self.body, compresslevel=6)
+                self.gzipped = compressed if len(compressed) < len(self.body) else b""
+        return self.gzipped or None
+
+class ResponseCache:
+    """
+    Serialized invoice responses per tenant, most recently used kept.
+
+    Each entry records the tenant's shared generation (the
+    invoice_generations row) it was rendered at, and is only served while
+    the caller's current generation still matches. Entries also expire
+    after HTTP_CACHE_TTL_SECONDS as a backstop for SQL run outside the app.
+    """
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, Hashable], CachedResponse]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, tenant_id: str, key: Hashable, generation: int) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get((tenant_id, key))
+            if entry is None:
+                return None
+            if entry.generation != generation or time.monotonic() - entry.created > self.ttl_seconds:
+                self._remove((tenant_id, key))
+                return None
+            self._entries.move_to_end((tenant_id, key))
+            return entry
+
+    def put(self, tenant_id: str, key: Hashable, entry: CachedResponse):
+        # Too large to be worth holding
+        if len(entry.body) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove((tenant_id, key))
+            self._entries[(tenant_id, key)] = entry
+            self._size += len(entry.body)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, cache_key: Tuple[str, Hashable]):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self._size -= len(entry.body)
+
+response_cache = ResponseCache(
+    settings.HTTP_CACHE_MAX_ENTRIES,
+    settings.HTTP_CACHE_MAX_BYTES,
+    settings.HTTP_CACHE_TTL_SECONDS,
+)
+
+INVOICE_GENERATIONS = InvoiceGeneration.__table__
+
+def bump_invoice_generations(connection, tenant_ids: Iterable[str]):
+    """
+    Advance the tenants' shared generations in the caller's transaction.
+    ORM changes do this through the flush hook below; Core inserts, updates
+    and deletes of invoices must call it before committing.
+    """
+    # A fixed order keeps concurrent writers from deadlocking on the rows
+    for tenant_id in sorted(set(tenant_ids)):
+        connection.execute(
+            text(
+                "INSERT INTO invoice_generations (tenant_id, generation) VALUES (:tenant_id, 1) "
+                "ON CONFLICT (tenant_id) DO UPDATE SET generation = invoice_generations.generation + 1"
+            ),
+            {"tenant_id": tenant_id},
+        )
+
+def invoice_generation(db: Session, tenant_id: str) -> int:
+    return db.execute(
+        select(INVOICE_GENERATIONS.c.generation).where(INVOICE_GENERATIONS.c.tenant_id == tenant_id)
+    ).scalar() or 0
+
+@event.listens_for(Session, "after_flush")
+def _bump_changed_tenants(session, flush_context):
+    tenants = {
+        instance.tenant_id or settings.DEFAULT_TENANT_ID
+        for instance in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(instance, Invoice)
+    }
+    if tenants:
+        bump_invoice_generations(session.connection(), tenants)
+
+def content_etag(body: bytes) -> str:
+    return 'W/"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+def _not_modified(request: Request, entry: CachedResponse) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison: W/ prefixes are ignored
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or entry.etag.removeprefix("W/") in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and entry.last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # HTTP dates have whole-second precision
+        return entry.last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
+    return False
+
+async def cached_response(
+    request: Request,
+    db: Session,
+    tenant_id: str,
+    key: Hashable,
+    render: Callable[[], Awaitable[Tuple[bytes, Optional[datetime], Optional[str]]]],
+) -> Response:
+    """
+    Serve a JSON response from the cache, rendering it on a miss. `render`
+    is a coroutine function returning the body, its last-modified time (None to validate on the ETag
+    alone) and optionally an ETag (by default a hash of the body). Answers
+    304 when the client's copy is current and sends the stored gzip body to
+    clients that accept it. Costs one primary-key lookup of the tenant's
+    generation on a hit.
+    """
+    generation = invoice_generation(db, tenant_id)
+    entry = response_cache.get(tenant_id, key, generation)
+    if entry is None:
+        body, last_modified, etag = await render()
+        entry = CachedResponse(body, etag or content_etag(body), last_modified, generation)
+        response_cache.put(tenant_id, key, entry)
+
+    headers = {"ETag": entry.etag, "Cache-Control": CACHE_CONTROL, "Vary": VARY}
+    if entry.last_modified is not None:
+        headers["Last-Modified"] = format_datetime(entry.last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+
+    if _not_modified(request, entry):
+        return Response(status_code=304, headers=headers)
+
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        compressed = entry.gzip_body()
+        if compressed is not None:
+            headers["Content-Encoding"] = "gzip"
+            return Response(compressed, media_type="application/json", headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
@@ -1,16 +1,21 @@
-from sqlalchemy.orm import Session
-from app.core.database import engine, Base
-from app.models.settings import Settings
-from app.models.invoice import Invoice
+from app.core.database import engine
+from app.core.migrations import get_schema_version, latest_version, run_migrations
 
 def init_db():
     """
-    Initialize the database
+    Initialize the database, applying any pending migrations. When the
+    recorded schema version is already current this is a single query.
     """
-    # Create all tables
-    Base.metadata.create_all(bind=engine)
+    with engine.connect() as connection:
+        if get_schema_version(connection) >= latest_version():
+            return
+
+    run_migrations(engine)
 
 if __name__ == "__main__":
-    print("Creating database tables...")
+    import logging
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    print("Migrating database...")
     init_db()
-    print("Database tables created successfully!") 
\ No newline at end of file
+    print(f"Database schema is at version {latest_version()}")
@@ -0,0 +1,313 @@
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+from sqlalchemy import (
+    JSON, Column, DateTime, Enum, Float, Index, Integer, MetaData, String, Table, inspect, select, text,
+)
+from sqlalchemy.engine import Connection, Engine
+import logging
+import time
+
+# Schema migrations. Each migration has a version; the highest applied one is
+# recorded in the schema_version table. Transactional migrations get a
+# Connection inside a transaction. Non-transactional ones get the Engine and
+# manage their own (short) transactions, which is what CREATE INDEX
+# CONCURRENTLY and batched backfills need. They must be idempotent because a
+# crash before the version is recorded means they run again.
+
+schema_metadata = MetaData()
+schema_version_table = Table(
+    "schema_version",
+    schema_metadata,
+    Column("version", Integer, nullable=False),
+)
+
+logger = logging.getLogger("app.migrations")
+
+# Arbitrary key for the Postgres advisory lock that serialises migration runs
+# when several instances start at once
+MIGRATION_LOCK_KEY = 726_010_330
+
+class Migration:
+    def __init__(self, version: int, description: str, upgrade: Callable, transactional: bool = True):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.transactional = transactional
+
+    def __repr__(self):
+        return f"<Migration {self.version} - {self.description}>"
+
+MIGRATIONS: List[Migration] = []
+
+def migration(version: int, description: str, transactional: bool = True):
+    """
+    Register the decorated function as a migration
+    """
+    def register(upgrade: Callable) -> Callable:
+        if any(m.version == version for m in MIGRATIONS):
+            raise ValueError(f"Duplicate migration version {version}")
+        MIGRATIONS.append(Migration(version, description, upgrade, transactional))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return upgrade
+    return register
+
+def latest_version() -> int:
+    return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+def get_schema_version(connection: Connection) -> int:
+    """
+    Version recorded in the database, or 0 if it has never been initialised
+    """
+    if not inspect(connection).has_table("schema_version"):
+        return 0
+    version = connection.execute(select(schema_version_table.c.version)).scalar()
+    return version or 0
+
+def set_schema_version(connection: Connection, version: int):
+    schema_metadata.create_all(bind=connection)
+    connection.execute(schema_version_table.delete())
+    connection.execute(schema_version_table.insert().values(version=version))
+
+@contextmanager
+def migration_lock(engine: Engine):
+    """
+    Hold the advisory lock that serialises schema changes across instances.
+    Not reentrant across connections: don't take it inside a migration.
+    """
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+def run_migrations(engine: Engine, target: Optional[int] = None) -> List[Migration]:
+    """
+    Apply pending migrations up to `target` (default: all) and return them
+    """
+    target = latest_version() if target is None else target
+    applied = []
+    with migration_lock(engine):
+        with engine.connect() as connection:
+            current = get_schema_version(connection)
+
+        for pending in MIGRATIONS:
+            if pending.version <= current or pending.version > target:
+                continue
+            logger.info("Applying migration %s: %s", pending.version, pending.description)
+            if pending.transactional:
+                with engine.begin() as connection:
+                    pending.upgrade(connection)
+                    set_schema_version(connection, pending.version)
+            else:
+                pending.upgrade(engine)
+                with engine.begin() as connection:
+                    set_schema_version(connection, pending.version)
+            applied.append(pending)
+    return applied
+
+# Online schema helpers
+
+def create_index_concurrently(engine: Engine, name: str, table: str, columns: List[str], unique: bool = False):
+    """
+    Build an index without blocking writes. On Postgres this uses CREATE INDEX
+    CONCURRENTLY, which cannot run inside a transaction; a previous failed
+    build leaves an INVALID index behind, which is dropped and rebuilt.
+    """
+    unique_sql = "UNIQUE " if unique else ""
+    columns_sql = ", ".join(columns)
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as connection:
+            connection.execute(text(f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({columns_sql})"))
+        return
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        invalid = connection.execute(
+            text(
+                "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND NOT i.indisvalid"
+            ),
+            {"name": name},
+        ).first()
+        if invalid:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        connection.execute(
+            text(f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns_sql})")
+        )
+
+def drop_index_concurrently(engine: Engine, name: str):
+    """
+    Drop an index without blocking reads or writes on Postgres
+    """
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        return
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+def add_column(engine: Engine, table: str, column: str, ddl_type: str):
+    """
+    Add a nullable column with no default, which Postgres does without
+    rewriting the table; populate it afterwards with backfill_in_batches
+    """
+    with engine.begin() as connection:
+        existing = {c["name"] for c in inspect(connection).get_columns(table)}
+        if column not in existing:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+def backfill_in_batches(
+    engine: Engine,
+    table: str,
+    set_sql: str,
+    where_sql: str = "1 = 1",
+    batch_size: int = 5000,
+    pause: float = 0.0,
+    params: Optional[dict] = None,
+) -> int:
+    """
+    Run `UPDATE table SET set_sql WHERE where_sql` over consecutive id ranges,
+    one short transaction per batch, so row locks are only ever held on a
+    single batch. Returns the number of rows updated.
+    """
+    with engine.connect() as connection:
+        low, high = connection.execute(text(f"SELECT MIN(id), MAX(id) FROM {table}")).first()
+    if low is None:
+        return 0
+
+    updated = 0
+    for start in range(low, high + 1, batch_size):
+        with engine.begin() as connection:
+            result = connection.execute(
+                text(f"UPDATE {table} SET {set_sql} WHERE id >= :start AND id < :end AND ({where_sql})"),
+                {**(params or {}), "start": start, "end": start + batch_size},
+            )
+            updated += result.rowcount
+        if pause:
+            time.sleep(pause)
+    return updated
+
+# Migrations. Version 1 is the marker written by init_db before migrations
+# existed; its create_all ran against a Base the models were not registered
+# on, so the baseline below is version 2.
+
+# The schema as the models declared it when migrations were introduced.
+# It is frozen here rather than taken from the models, which later
+# migrations keep changing.
+baseline_metadata = MetaData()
+Table(
+    "invoices",
+    baseline_metadata,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("dext_id", String, unique=True, index=True),
+    Column("supplier_name", String),
+    Column("vat_number", String),
+    Column("vat_code", String),
+    Column("amount", Float),
+    Column("date", DateTime),
+    Column("status", Enum("PENDING", "VALIDATED", "PUSHED_TO_XERO", "ERROR", name="invoicestatus")),
+    Column("confidence_score", Float),
+    Column("validation_errors", JSON, nullable=True),
+    Column("xero_invoice_id", String, nullable=True),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+    Index("ix_invoices_date", "date"),
+    Index("ix_invoices_status_date", "status", "date"),
+)
+Table(
+    "settings",
+    baseline_metadata,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("dext_api_key", String, nullable=True),
+    Column("xero_client_id", String, nullable=True),
+    Column("xero_client_secret", String, nullable=True),
+    Column("xero_access_token", String, nullable=True),
+    Column("xero_refresh_token", String, nullable=True),
+    Column("openai_api_key", String, nullable=True),
+    Column("xero_token_expires_at", String, nullable=True),
+    Column("google_cloud_vision_credentials", JSON, nullable=True),
+)
+
+@migration(2, "Baseline schema")
+def _baseline_schema(connection: Connection):
+    baseline_metadata.create_all(bind=connection)
+
+@migration(3, "Invoice date and status/date indexes", transactional=False)
+def _invoice_date_indexes(engine: Engine):
+    create_index_concurrently(engine, "ix_invoices_date", "invoices", ["date"])
+    create_index_concurrently(engine, "ix_invoices_status_date", "invoices", ["status", "date"])
+
+@migration(4, "Tenant columns and per-tenant invoice uniqueness", transactional=False)
+def _tenant_columns(engine: Engine):
+    from app.core.config import settings
+
+    add_column(engine, "invoices", "tenant_id", "VARCHAR")
+    add_column(engine, "settings", "tenant_id", "VARCHAR")
+    add_column(engine, "settings", "max_concurrency", "INTEGER")
+    # Everything that predates tenancy belongs to the default organisation
+    for table in ("invoices", "settings"):
+        backfill_in_batches(
+            engine, table, "tenant_id = :tenant", "tenant_id IS NULL",
+            params={"tenant": settings.DEFAULT_TENANT_ID},
+        )
+    # Dext ids become unique per organisation rather than globally. The new
+    # index is built before the old one goes, so uniqueness is never unenforced.
+    create_index_concurrently(
+        engine, "ix_invoices_tenant_dext_id", "invoices", ["tenant_id", "dext_id"], unique=True
+    )
+    drop_index_concurrently(engine, "ix_invoices_dext_id")
+    create_index_concurrently(engine, "ix_invoices_tenant_status_date", "invoices", ["tenant_id", "status", "date"])
+    # Before tenancy the app only ever read the first settings row, so that
+    # one stays the tenant's; any others are detached (kept, but belonging to
+    # no tenant) so the unique index can be built
+    with engine.begin() as connection:
+        connection.execute(text(
+            "UPDATE settings SET tenant_id = NULL WHERE tenant_id IS NOT NULL AND id NOT IN "
+            "(SELECT MIN(id) FROM settings WHERE tenant_id IS NOT NULL GROUP BY tenant_id)"
+        ))
+    create_index_concurrently(engine, "ix_settings_tenant_id", "settings", ["tenant_id"], unique=True)
+
+@migration(5, "Document extraction cache")
+def _document_extractions(connection: Connection):
+    from app.models.document_extraction import DocumentExtraction
+
+    DocumentExtraction.__table__.create(bind=connection, checkfirst=True)
+
+@migration(6, "On-hold invoice status", transactional=False)
+def _on_hold_status(engine: Engine):
+    # Non-native enums elsewhere are plain strings; Postgres needs the new
+    # label added to the type, which ADD VALUE does without a table rewrite
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ALTER TYPE invoicestatus ADD VALUE IF NOT EXISTS 'ON_HOLD'"))
+
+@migration(7, "Monthly invoice partitions and archived invoice keys", transactional=False)
+def _partition_invoices(engine: Engine):
+    from app.core.config import settings
+    from app.core.partitions import archive_cutoff, partition_invoices_table
+    from app.models.archived_invoice import ArchivedInvoice
+
+    with engine.begin() as connection:
+        ArchivedInvoice.__table__.create(bind=connection, checkfirst=True)
+    partition_invoices_table(
+        engine,
+        archive_cutoff(settings.ARCHIVE_AFTER_MONTHS),
+        months_ahead=settings.PARTITION_MONTHS_AHEAD,
+    )
+
+@migration(8, "Per-tenant Xero tenant id and Dext webhook secret", transactional=False)
+def _tenant_upstream_identity(engine: Engine):
+    add_column(engine, "settings", "xero_tenant_id", "VARCHAR")
+    add_column(engine, "settings", "dext_webhook_secret", "VARCHAR")
+    create_index_concurrently(engine, "ix_settings_xero_tenant_id", "settings", ["xero_tenant_id"], unique=True)
+
+@migration(9, "Shared invoice cache generations")
+def _invoice_generations(connection: Connection):
+    from app.models.invoice_generation import InvoiceGeneration
+
+    InvoiceGeneration.__table__.create(bind=connection, checkfirst=True)
@@ -0,0 +1,281 @@
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+import re
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from app.core.migrations import migration_lock
+
+# Monthly RANGE partitioning of the invoices table on Postgres. Each open
+# month (from the archive cutoff on, see archive_cutoff) lives in
+# invoices_pYYYY_MM. Rows without a date and rows from closed months sit in
+# invoices_default, the cold partition: the archive job
+# (app.services.archive_service) moves pushed invoices from closed months to
+# Parquet and then retires those months' partitions, so what is left of them
+# joins the default partition. Queries filtering on `date` only touch the
+# partitions they need, and the partition count stays bounded as history
+# grows. Other databases keep a plain table and every function here is a
+# no-op on them.
+
+TABLE = "invoices"
+DEFAULT_PARTITION = "invoices_default"
+PARTITION_PATTERN = re.compile(r"^invoices_p(\d{4})_(\d{2})$")
+
+# A partitioned table's unique indexes must include the partition key, so
+# the indexes below only enforce uniqueness of id and of (tenant_id, dext_id)
+# per date. Ids come from a sequence, but a Dext document stored again with
+# a different date would slip past the index, so Dext ids are claimed in
+# invoice_dext_ids instead: a plain table keyed on (tenant_id, dext_id) that
+# a row trigger on invoices keeps in step, and whose primary key rejects a
+# second claim with the same IntegrityError the unique index raised before
+# partitioning. The trade-off is a second index write on every insert and on
+# every update or delete that changes a Dext id. Rows moved between
+# partitions by this module keep their claims.
+PARTITIONED_INDEXES: List[Tuple[str, List[str], bool]] = [
+    ("ix_invoices_id_date", ["id", "date"], True),
+    ("ix_invoices_date", ["date"], False),
+    ("ix_invoices_status_date", ["status", "date"], False),
+    ("ix_invoices_tenant_dext_id", ["tenant_id", "dext_id", "date"], True),
+    ("ix_invoices_tenant_status_date", ["tenant_id", "status", "date"], False),
+]
+
+DEXT_ID_TABLE = "invoice_dext_ids"
+# Set for the rest of a transaction that moves rows between partitions, so
+# the trigger leaves their claims alone
+MOVING_ROWS_SETTING = "app.moving_invoice_rows"
+
+CLAIM_DEXT_ID_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION claim_invoice_dext_id() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('{MOVING_ROWS_SETTING}', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.dext_id IS NOT NULL THEN
+        DELETE FROM {DEXT_ID_TABLE} WHERE tenant_id = OLD.tenant_id AND dext_id = OLD.dext_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.dext_id IS NOT NULL THEN
+        INSERT INTO {DEXT_ID_TABLE} (tenant_id, dext_id) VALUES (NEW.tenant_id, NEW.dext_id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def archive_cutoff(after_months: int, today: Optional[date] = None) -> date:
+    """
+    First day of the oldest open month; earlier months are closed
+    """
+    return add_months(month_start(today or datetime.utcnow()), -after_months)
+
+def partition_name(month: date) -> str:
+    return f"{TABLE}_p{month:%Y_%m}"
+
+def is_partitioned(connection: Connection) -> bool:
+    if connection.dialect.name != "postgresql":
+        return False
+    return connection.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"),
+        {"table": TABLE},
+    ).first() is not None
+
+def partition_months(connection: Connection) -> Dict[date, str]:
+    """
+    Monthly partitions currently attached to invoices, by month
+    """
+    names = connection.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:table)"
+        ),
+        {"table": TABLE},
+    ).scalars()
+    months = {}
+    for name in names:
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            months[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return months
+
+def _moving_rows(connection: Connection):
+    connection.execute(text(f"SET LOCAL {MOVING_ROWS_SETTING} = 'on'"))
+
+def _create_partition(connection: Connection, month: date, source: str):
+    """
+    Create and attach the partition for `month`, first moving its rows out of
+    the default partition, which would otherwise make the attach fail
+    """
+    name = partition_name(month)
+    bounds = {"start": datetime.combine(month, datetime.min.time()),
+              "end": datetime.combine(add_months(month, 1), datetime.min.time())}
+    connection.execute(text(f"CREATE TABLE {name} (LIKE {source} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    if source == TABLE:
+        _moving_rows(connection)
+        connection.execute(
+            text(f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE date >= :start AND date < :end"),
+            bounds,
+        )
+        connection.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE date >= :start AND date < :end"), bounds)
+    connection.execute(
+        text(
+            f"ALTER TABLE {source} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{bounds['start'].isoformat()}') TO ('{bounds['end'].isoformat()}')"
+        )
+    )
+
+def ensure_invoice_partitions(engine: Engine, oldest: date, months_ahead: int = 3) -> List[str]:
+    """
+    Create partitions for the coming months and for any open month (from
+    `oldest` on) with rows in the default partition. Returns the names of
+    partitions created. Holds the migration lock, so instances starting or
+    archiving at the same time never race to create the same month.
+    """
+    if engine.dialect.name != "postgresql":
+        return []
+    created = []
+    with migration_lock(engine):
+        # Computed under the lock, so months another instance just attached are skipped
+        with engine.connect() as connection:
+            if not is_partitioned(connection):
+                return []
+            existing = partition_months(connection)
+            wanted = {add_months(month_start(datetime.utcnow()), offset) for offset in range(months_ahead + 1)}
+            wanted.update(
+                month_start(value) for value in connection.execute(
+                    text(f"SELECT DISTINCT date_trunc('month', date) FROM {DEFAULT_PARTITION} WHERE date >= :oldest"),
+                    {"oldest": oldest},
+                ).scalars()
+            )
+
+        for month in sorted(wanted - set(existing)):
+            with engine.begin() as connection:
+                _create_partition(connection, month, TABLE)
+            created.append(partition_name(month))
+    return created
+
+def retire_partitions(engine: Engine, before: date, lock_timeout: str = "10s") -> List[str]:
+    """
+    Detach and drop the partitions of months before `before`, moving any
+    rows still in them (invoices that were not archived) to the default
+    partition. Run after archiving, when these partitions are nearly empty.
+    Holds the migration lock, like ensure_invoice_partitions.
+    """
+    if engine.dialect.name != "postgresql":
+        return []
+    retired = []
+    with migration_lock(engine):
+        with engine.connect() as connection:
+            if not is_partitioned(connection):
+                return []
+            candidates = [name for month, name in sorted(partition_months(connection).items()) if month < before]
+
+        for name in candidates:
+            with engine.begin() as connection:
+                connection.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+                _moving_rows(connection)
+                connection.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {name}"))
+                # With the month no longer covered, the rows route to the default partition
+                connection.execute(text(f"INSERT INTO {TABLE} SELECT * FROM {name}"))
+                connection.execute(text(f"DROP TABLE {name}"))
+            retired.append(name)
+    return retired
+
+def partition_invoices_table(
+    engine: Engine,
+    oldest: date,
+    months_ahead: int = 3,
+    batch_size: int = 5000,
+    lock_timeout: str = "10s",
+):
+    """
+    Rebuild invoices as a partitioned table without a long outage. Rows are
+    copied into a partitioned shadow table in id batches while the old table
+    stays in use; then, under a short exclusive lock, rows inserted or updated
+    since the copy started are brought over and the tables are swapped.
+    Months before `oldest` are closed and go to the default partition.
+    The shadow table's trigger claims each copied row's Dext id in
+    invoice_dext_ids. Idempotent: does nothing once invoices is partitioned,
+    and a leftover shadow table from an interrupted run is rebuilt.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    shadow = f"{TABLE}_partitioned"
+    with engine.begin() as connection:
+        if is_partitioned(connection):
+            return
+        connection.execute(text(f"DROP TABLE IF EXISTS {shadow} CASCADE"))
+        connection.execute(
+            text(f"CREATE TABLE {shadow} (LIKE {TABLE} INCLUDING DEFAULTS) PARTITION BY RANGE (date)")
+        )
+        connection.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {shadow} DEFAULT"))
+        connection.execute(text(f"DROP TABLE IF EXISTS {DEXT_ID_TABLE}"))
+        connection.execute(text(
+            f"CREATE TABLE {DEXT_ID_TABLE} (tenant_id VARCHAR NOT NULL, dext_id VARCHAR NOT NULL, "
+            f"PRIMARY KEY (tenant_id, dext_id))"
+        ))
+        connection.execute(text(CLAIM_DEXT_ID_FUNCTION))
+        # Cloned onto every partition, present and future
+        connection.execute(text(
+            f"CREATE TRIGGER invoices_claim_dext_id AFTER INSERT OR DELETE OR UPDATE OF tenant_id, dext_id "
+            f"ON {shadow} FOR EACH ROW EXECUTE FUNCTION claim_invoice_dext_id()"
+        ))
+        # Only open months that hold invoices, so a mistyped year does not
+        # create decades of empty partitions
+        months = {add_months(month_start(datetime.utcnow()), offset) for offset in range(months_ahead + 1)}
+        months.update(
+            month_start(value) for value in connection.execute(
+                text(f"SELECT DISTINCT date_trunc('month', date) FROM {TABLE} WHERE date >= :oldest"),
+                {"oldest": oldest},
+            ).scalars()
+        )
+        for month in sorted(months):
+            _create_partition(connection, month, shadow)
+        high = connection.execute(text(f"SELECT MAX(id) FROM {TABLE}")).scalar() or 0
+
+    # Updates made while copying are re-copied at the swap; the margin covers
+    # clock differences between instances writing updated_at
+    copy_started = datetime.utcnow() - timedelta(minutes=5)
+    for start in range(0, high + 1, batch_size):
+        with engine.begin() as connection:
+            connection.execute(
+                text(f"INSERT INTO {shadow} SELECT * FROM {TABLE} WHERE id >= :start AND id < :end"),
+                {"start": start, "end": start + batch_size},
+            )
+
+    # Building indexes after the copy is much faster than maintaining them
+    # during it; the shadow table is not in use yet so nothing is blocked
+    for name, columns, unique in PARTITIONED_INDEXES:
+        with engine.begin() as connection:
+            unique_sql = "UNIQUE " if unique else ""
+            connection.execute(text(f"CREATE {unique_sql}INDEX {name}_new ON {shadow} ({', '.join(columns)})"))
+
+    with engine.begin() as connection:
+        connection.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+        connection.execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+        changed = {"high": high, "since": copy_started}
+        connection.execute(
+            text(f"DELETE FROM {shadow} WHERE id IN (SELECT id FROM {TABLE} WHERE updated_at >= :since)"),
+            changed,
+        )
+        connection.execute(
+            text(f"DELETE FROM {shadow} s WHERE NOT EXISTS (SELECT 1 FROM {TABLE} t WHERE t.id = s.id)")
+        )
+        connection.execute(
+            text(f"INSERT INTO {shadow} SELECT * FROM {TABLE} WHERE id > :high OR updated_at >= :since"),
+            changed,
+        )
+
+        sequence = connection.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": TABLE}).scalar()
+        if sequence:
+            connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+        connection.execute(text(f"DROP TABLE {TABLE}"))
+        connection.execute(text(f"ALTER TABLE {shadow} RENAME TO {TABLE}"))
+        if sequence:
+            connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id"))
+        for name, _, _ in PARTITIONED_INDEXES:
+            connection.execute(text(f"ALTER INDEX {name}_new RENAME TO {name}"))
@@ -0,0 +1,175 @@
+from contextlib import asynccontextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from fastapi import HTTPException, Request
+import asyncio
+import json
+import os
+import re
+import uuid
+from app.core.config import settings
+from app.core.security import is_admin, verify_token
+
+# Send "X-Profile: 1" (or "X-Profile: html") to profile a single request
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+PROFILE_FORMATS = {
+    "speedscope": ".speedscope.json",
+    "html": ".html",
+}
+PROFILE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+# Admins can profile sync runs for a while. The deadline lives in PROFILE_DIR,
+# so every worker sharing the directory sees it and it outlasts restarts.
+SYNC_PROFILE_FILE = "sync-runs.until"
+MAX_SYNC_PROFILE_WINDOW = timedelta(hours=24)
+
+# pyinstrument allows one profiler per thread/async context
+_active_profile: ContextVar[bool] = ContextVar("active_profile", default=False)
+
+
+def _profile_dir() -> str:
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    return settings.PROFILE_DIR
+
+
+def _save_profile(profiler, profile_id: str, label: str, fmt: str):
+    from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+
+    renderer = SpeedscopeRenderer() if fmt == "speedscope" else HTMLRenderer()
+    directory = _profile_dir()
+    filename = profile_id + PROFILE_FORMATS[fmt]
+    with open(os.path.join(directory, filename), "w") as f:
+        f.write(profiler.output(renderer))
+
+    session = profiler.last_session
+    metadata = {
+        "id": profile_id,
+        "label": label,
+        "format": fmt,
+        "file": filename,
+        "created_at": datetime.utcnow().isoformat(),
+        "wall_time": session.duration,
+        "cpu_time": session.cpu_time,
+        "sample_count": session.sample_count,
+    }
+    with open(os.path.join(directory, profile_id + ".meta.json"), "w") as f:
+        json.dump(metadata, f)
+
+
+@asynccontextmanager
+async def profile(label: str, fmt: str = "speedscope"):
+    """
+    Profile the enclosed block (including awaited async tasks) and store the
+    result in PROFILE_DIR. Yields the profile id, or None if a profile is
+    already being captured for this context. Rendering and writing the
+    profile happen in a worker thread.
+    """
+    if _active_profile.get():
+        yield None
+        return
+
+    from pyinstrument import Profiler
+
+    profile_id = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{re.sub(r'[^A-Za-z0-9_-]', '_', label)}-{uuid.uuid4().hex[:8]}"
+    profiler = Profiler(interval=settings.PROFILE_INTERVAL, async_mode="enabled")
+    token = _active_profile.set(True)
+    profiler.start()
+    try:
+        yield profile_id
+    finally:
+        profiler.stop()
+        _active_profile.reset(token)
+        await asyncio.to_thread(_save_profile, profiler, profile_id, label, fmt)
+
+
+def profile_sync_runs_for(window: timedelta) -> Optional[datetime]:
+    """
+    Profile every sync run for `window` from now (at most
+    MAX_SYNC_PROFILE_WINDOW); an empty window stops. Returns the deadline.
+    """
+    path = os.path.join(_profile_dir(), SYNC_PROFILE_FILE)
+    if window <= timedelta(0):
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    until = datetime.utcnow() + min(window, MAX_SYNC_PROFILE_WINDOW)
+    with open(path + ".tmp", "w") as f:
+        f.write(until.isoformat())
+    os.replace(path + ".tmp", path)
+    return until
+
+
+def sync_runs_profiled_until() -> Optional[datetime]:
+    """
+    Deadline of the current sync profiling window, or None if there is none
+    """
+    try:
+        with open(os.path.join(settings.PROFILE_DIR, SYNC_PROFILE_FILE)) as f:
+            until = datetime.fromisoformat(f.read().strip())
+    except (OSError, ValueError):
+        return None
+    return until if until > datetime.utcnow() else None
+
+
+def sync_run_profile():
+    """
+    Context for a sync run: a profile when PROFILE_SYNC_RUNS is on or an
+    admin opened a profiling window, otherwise a no-op
+    """
+    if settings.PROFILING_ENABLED and (settings.PROFILE_SYNC_RUNS or sync_runs_profiled_until()):
+        return profile("sync-run")
+    return nullcontext()
+
+
+def _may_profile(request: Request) -> bool:
+    """
+    Profiles cost CPU and disk, so only admins may ask for one. The request
+    itself is still authenticated by its route as usual.
+    """
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        return is_admin(verify_token(token))
+    except HTTPException:
+        return False
+
+
+async def profiling_middleware(request: Request, call_next):
+    """
+    Profile requests that carry the profile header and an admin token. Only
+    installed when PROFILING_ENABLED is set, so unprofiled deployments pay
+    nothing.
+    """
+    requested = request.headers.get(PROFILE_HEADER)
+    if not requested or not _may_profile(request):
+        return await call_next(request)
+
+    fmt = requested if requested in PROFILE_FORMATS else "speedscope"
+    async with profile(f"{request.method} {request.url.path}", fmt) as profile_id:
+        response = await call_next(request)
+    if profile_id:
+        response.headers[PROFILE_ID_HEADER] = profile_id
+    return response
+
+
+def list_profiles() -> List[Dict]:
+    directory = _profile_dir()
+    profiles = []
+    for filename in os.listdir(directory):
+        if filename.endswith(".meta.json"):
+            with open(os.path.join(directory, filename)) as f:
+                profiles.append(json.load(f))
+    return sorted(profiles, key=lambda p: p["created_at"], reverse=True)
+
+
+def get_profile_path(profile_id: str) -> Optional[str]:
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    directory = _profile_dir()
+    for extension in PROFILE_FORMATS.values():
+        path = os.path.join(directory, profile_id + extension)
+        if os.path.exists(path):
+            return path
+    return None
@@ -1,11 +1,17 @@
-from fastapi import HTTPException, Request
+from fastapi import Depends, HTTPException, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import threading
+import time
+import uuid
 import jwt
-from cryptography.fernet import Fernet
 import os
 from dotenv import load_dotenv
+from app.core.config import settings
 
 load_dotenv()
 
@@ -13,8 +19,38 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")  # Change this in production
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Longest lifetime a token may have. Tokens are rejected if their exp lies
+# further than this from their iat (or, without an iat, from now), so a
+# revocation by jti only has to be kept this long.
+MAX_TOKEN_LIFETIME = int(os.getenv("JWT_MAX_LIFETIME_SECONDS", "86400"))
 RATE_LIMIT_REQUESTS = 100  # requests per minute
 RATE_LIMIT_WINDOW = 60  # seconds
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+# Signing keys by key id ("kid"). JWT_SIGNING_KEYS="2024-01:secret-a,2024-06:secret-b"
+# enables rotation: tokens are verified with the key named in their header and new
+# tokens are signed with JWT_ACTIVE_KID (default: the first key listed)
+def _load_signing_keys() -> Dict[str, str]:
+    raw = os.getenv("JWT_SIGNING_KEYS")
+    if not raw:
+        return {"default": SECRET_KEY}
+    keys = {}
+    for entry in raw.split(","):
+        kid, _, secret = entry.strip().partition(":")
+        if kid and secret:
+            keys[kid] = secret
+    if not keys:
+        raise ValueError("JWT_SIGNING_KEYS has no kid:secret pairs")
+    return keys
+
+def _active_kid(keys: Dict[str, str]) -> str:
+    kid = os.getenv("JWT_ACTIVE_KID") or next(iter(keys))
+    if kid not in keys:
+        raise ValueError(f"JWT_ACTIVE_KID {kid!r} is not one of the JWT_SIGNING_KEYS")
+    return kid
+
+SIGNING_KEYS = _load_signing_keys()
+ACTIVE_KID = _active_kid(SIGNING_KEYS)
 
 # Rate limiting
 class RateLimiter:
@@ -44,6 +80,8 @@ rate_limiter = RateLimiter()
 # API Key encryption
 class APIKeyEncryption:
     def __init__(self):
+        from cryptography.fernet import Fernet
+
         key = os.getenv("ENCRYPTION_KEY")
         if not key:
             key = Fernet.generate_key()
@@ -57,40 +95,199 @@ class APIKeyEncryption:
     def decrypt(self, encrypted_data: str) -> str:
         return self.cipher_suite.decrypt(encrypted_data.encode()).decode()
 
-api_key_encryption = APIKeyEncryption()
+@lru_cache(maxsize=None)
+def get_api_key_encryption() -> APIKeyEncryption:
+    """
+    Shared cipher, built on first use rather than at import time
+    """
+    return APIKeyEncryption()
+
+# Verified token cache
+class TokenCache:
+    """
+    Bounded LRU of verified token payloads keyed by token digest. Entries are
+    only served until the token's exp, so a hit never outlives the token.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[bytes, Tuple[float, dict, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest: bytes, now: float) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return entry[1]
+
+    def put(self, digest: bytes, expires_at: float, payload: dict, kid: str):
+        with self._lock:
+            self._entries[digest] = (expires_at, payload, kid)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, digest: bytes):
+        with self._lock:
+            self._entries.pop(digest, None)
+
+    def discard_matching(self, jti: Optional[str] = None, kid: Optional[str] = None):
+        with self._lock:
+            for digest, (_, payload, entry_kid) in list(self._entries.items()):
+                if (jti is not None and payload.get("jti") == jti) or (kid is not None and entry_kid == kid):
+                    del self._entries[digest]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
+# Revocation list (per process): token digest or jti -> exp, pruned once expired
+revoked_tokens: Dict[bytes, float] = {}
+revoked_token_ids: Dict[str, float] = {}
+
+def _token_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+def _prune_revocations(now: float):
+    for revoked in (revoked_tokens, revoked_token_ids):
+        for key in [key for key, exp in revoked.items() if exp <= now]:
+            del revoked[key]
+
+def revoke_token(token: Optional[str] = None, jti: Optional[str] = None):
+    """
+    Revoke a token, either by its encoded value or by its jti claim
+    """
+    now = time.time()
+    _prune_revocations(now)
+    # No token still accepted can outlive this, whenever it was issued
+    latest_exp = now + MAX_TOKEN_LIFETIME
+    exp = latest_exp
+    if token:
+        try:
+            claims = jwt.decode(token, options={"verify_signature": False})
+        except jwt.InvalidTokenError:
+            claims = {}
+        if "exp" in claims:
+            exp = min(float(claims["exp"]), latest_exp)
+        digest = _token_digest(token)
+        revoked_tokens[digest] = exp
+        token_cache.discard(digest)
+        jti = jti or claims.get("jti")
+    if jti:
+        revoked_token_ids[jti] = max(revoked_token_ids.get(jti, 0.0), exp)
+        token_cache.discard_matching(jti=jti)
+
+def retire_signing_key(kid: str):
+    """
+    Stop accepting tokens signed with `kid` and drop them from the cache
+    """
+    if kid == ACTIVE_KID:
+        raise ValueError("Cannot retire the active signing key")
+    SIGNING_KEYS.pop(kid, None)
+    token_cache.discard_matching(kid=kid)
 
 # JWT token handling
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
+    """
+    Sign a token for `data`. Claims the API looks at besides the standard
+    ones: "role" ("admin" for the admin endpoints and every tenant) and
+    "tenants", the tenant ids the token may act for.
+    """
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    expires_delta = expires_delta or timedelta(minutes=15)
+    if expires_delta.total_seconds() > MAX_TOKEN_LIFETIME:
+        raise ValueError(f"Tokens may live at most {MAX_TOKEN_LIFETIME} seconds")
+    issued = datetime.utcnow()
+    to_encode.update({"iat": issued, "exp": issued + expires_delta})
+    to_encode.setdefault("jti", uuid.uuid4().hex)
+    encoded_jwt = jwt.encode(
+        to_encode,
+        SIGNING_KEYS[ACTIVE_KID],
+        algorithm=ALGORITHM,
+        headers={"kid": ACTIVE_KID}
+    )
     return encoded_jwt
 
 def verify_token(token: str) -> dict:
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    """
+    Verify a bearer token. Hot tokens are served from the verified-token cache;
+    only a cache miss pays for the HMAC check.
+    """
+    digest = _token_digest(token)
+    now = time.time()
+    payload = token_cache.get(digest, now)
+    if payload is not None:
         return payload
+
+    if digest in revoked_tokens:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+
+    try:
+        kid = jwt.get_unverified_header(token).get("kid") or ACTIVE_KID
+        key = SIGNING_KEYS.get(kid)
+        if key is None:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        payload = jwt.decode(token, key, algorithms=[ALGORITHM])
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+    if payload.get("jti") in revoked_token_ids:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+
+    # Revocations are only kept for MAX_TOKEN_LIFETIME, so longer-lived
+    # tokens (or ones that never expire) are not accepted at all
+    if "exp" not in payload:
+        raise HTTPException(status_code=401, detail="Token has no expiry")
+    issued = float(payload.get("iat", now))
+    if float(payload["exp"]) - issued > MAX_TOKEN_LIFETIME:
+        raise HTTPException(status_code=401, detail="Token lifetime is too long")
+
+    token_cache.put(digest, float(payload["exp"]), payload, kid)
+    return payload
+
 # Security middleware
 security = HTTPBearer()
 
-async def verify_api_key(credentials: HTTPAuthorizationCredentials = security):
+async def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
     if not credentials:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    try:
-        payload = verify_token(credentials.credentials)
-        return payload
-    except Exception as e:
-        raise HTTPException(status_code=401, detail=str(e))
+    return verify_token(credentials.credentials)
+
+# Roles
+ADMIN_ROLE = "admin"
+
+def is_admin(claims: dict) -> bool:
+    return claims.get("role") == ADMIN_ROLE
+
+async def require_admin(claims: dict = Depends(verify_api_key)) -> dict:
+    """
+    Only tokens with the admin role get past this
+    """
+    if not is_admin(claims):
+        raise HTTPException(status_code=403, detail="Admin role required")
+    return claims
+
+def token_tenants(claims: dict) -> List[str]:
+    """
+    Tenants a non-admin token may act for: its "tenants" claim, or just the
+    default tenant for tokens issued before there were several
+    """
+    tenants = claims.get("tenants")
+    if tenants is None:
+        return [settings.DEFAULT_TENANT_ID]
+    return [tenants] if isinstance(tenants, str) else list(tenants)
+
+def may_act_for(claims: dict, tenant_id: str) -> bool:
+    return is_admin(claims) or tenant_id in token_tenants(claims)
 
 # Rate limiting middleware
 async def rate_limit_middleware(request: Request, call_next):
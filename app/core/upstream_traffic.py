@@ -0,0 +1,409 @@
+"""
+Record and replay of upstream HTTP traffic.
+
+In "record" mode every request to Dext, Xero and OpenAI goes out as usual and
+is appended, with its response (or failure) and timing, to a gzipped JSON
+lines archive. In "replay" mode nothing goes over the network: each request
+is answered from the archive after its recorded latency, scaled by the
+replay speed. Requests are matched on upstream, method, path, query, a
+digest of the body and a keyed digest of the caller's credentials, so
+recordings replay under any base URL, never hold credentials and never
+answer one tenant with another's responses; a request recorded several
+times gets its responses back in recorded order, then the last one again.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from http import HTTPStatus
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import asyncio
+import base64
+import gzip
+import hashlib
+import hmac
+import threading
+import time
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from app.core.config import settings
+
+OFF, RECORD, REPLAY = "", "record", "replay"
+MODES = (OFF, RECORD, REPLAY)
+
+# Response headers the services look at; nothing else is kept
+KEPT_HEADERS = ("Content-Type", "Retry-After")
+
+# Headers describing a response body as sent, dropped once it is decoded
+DECODED_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+# Failures recorded in place of a response
+TIMEOUT, CONNECTION = "timeout", "connection"
+
+# Connections kept per upstream host; covers the default thread pool the
+# services make their blocking calls from
+POOL_MAXSIZE = 32
+
+# Request headers that tell tenants apart, most stable first: Xero access
+# tokens are refreshed, the organisation id is not
+TENANT_HEADERS = ("xero-tenant-id", "authorization")
+
+RequestKey = Tuple[str, str, str, str, str]
+
+def tenant_digest(headers: Optional[Mapping[str, str]]) -> str:
+    """
+    A keyed digest of the request's tenant header, so recordings of
+    different tenants' identical requests are kept apart without storing
+    anything the header could be recovered from
+    """
+    headers = {name.lower(): value for name, value in (headers or {}).items()}
+    for name in TENANT_HEADERS:
+        if headers.get(name):
+            return hmac.new(
+                settings.UPSTREAM_TRAFFIC_SECRET.encode("utf-8"), headers[name].encode("utf-8"), hashlib.sha256
+            ).hexdigest()[:16]
+    return ""
+
+def request_key(
+    upstream: str,
+    method: str,
+    url: str,
+    body: Optional[bytes],
+    headers: Optional[Mapping[str, str]] = None
+) -> RequestKey:
+    """
+    What a recorded request is matched on: the URL's scheme and host are
+    left out, its query parameters sorted and its tenant header digested
+    """
+    parts = urlsplit(url)
+    target = parts.path
+    if parts.query:
+        target += "?" + urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    digest = hashlib.sha1(body).hexdigest() if body else ""
+    return upstream, method.upper(), target, digest, tenant_digest(headers)
+
+def _as_bytes(body: Union[str, bytes, None]) -> Optional[bytes]:
+    return body.encode("utf-8") if isinstance(body, str) else body
+
+def _reason(status: int) -> str:
+    try:
+        return HTTPStatus(status).phrase
+    except ValueError:
+        return ""
+
+class UpstreamTraffic:
+    """
+    The traffic archive of this process, shared by every upstream client.
+    Recorded entries are written as they arrive; an archive cut short by a
+    killed process still replays up to its last complete entry.
+    """
+    def __init__(self, mode: str = OFF, archive: str = "traffic.jsonl.gz", speed: float = 1.0):
+        self._lock = threading.Lock()
+        self._file = None
+        self.configure(mode, archive, speed)
+
+    @classmethod
+    def from_settings(cls) -> "UpstreamTraffic":
+        return cls(
+            mode=settings.UPSTREAM_TRAFFIC_MODE.lower(),
+            archive=settings.UPSTREAM_TRAFFIC_ARCHIVE,
+            speed=settings.UPSTREAM_REPLAY_SPEED
+        )
+
+    def configure(self, mode: str, archive: str, speed: float = 1.0):
+        """
+        Switch mode, archive or speed, closing the current recording
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown upstream traffic mode: {mode}")
+        self.close()
+        with self._lock:
+            self.mode = mode
+            self.archive = archive
+            self.speed = speed
+            self.stats = {"recorded": 0, "replayed": 0, "misses": 0}
+            self._recorded: Optional[Dict[RequestKey, List[Dict]]] = None
+            self._served: Dict[RequestKey, int] = defaultdict(int)
+
+    @contextmanager
+    def using(self, mode: str, archive: str, speed: float = 1.0) -> Iterator["UpstreamTraffic"]:
+        """
+        Record or replay for the duration of a block, then switch back
+        """
+        saved = (self.mode, self.archive, self.speed)
+        self.configure(mode, archive, speed)
+        try:
+            yield self
+        finally:
+            self.configure(*saved)
+
+    def record(
+        self,
+        upstream: str,
+        method: str,
+        url: str,
+        body: Optional[bytes],
+        request_headers: Optional[Mapping[str, str]],
+        duration: float,
+        status: Optional[int] = None,
+        headers: Optional[Mapping[str, str]] = None,
+        content: bytes = b"",
+        error: Optional[str] = None
+    ):
+        """
+        Append one request and its response, or its failure (TIMEOUT or
+        CONNECTION)
+        """
+        upstream, method, target, digest, tenant = request_key(upstream, method, url, body, request_headers)
+        entry = {
+            "upstream": upstream,
+            "method": method,
+            "target": target,
+            "body_sha1": digest,
+            "tenant": tenant,
+            "duration": round(duration, 6),
+        }
+        if error:
+            entry["error"] = error
+        else:
+            entry["status"] = status
+            entry["headers"] = {name: headers[name] for name in KEPT_HEADERS if name in headers}
+            try:
+                entry["content"] = content.decode("utf-8")
+            except UnicodeDecodeError:
+                entry["content_b64"] = base64.b64encode(content).decode("ascii")
+
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.archive, "ab")
+            self._file.write(orjson.dumps(entry) + b"\n")
+            self.stats["recorded"] += 1
+
+    def lookup(
+        self,
+        upstream: str,
+        method: str,
+        url: str,
+        body: Optional[bytes],
+        headers: Optional[Mapping[str, str]] = None
+    ) -> Optional[Dict]:
+        """
+        The next recorded entry for a request, or None if it was never recorded
+        """
+        key = request_key(upstream, method, url, body, headers)
+        with self._lock:
+            if self._recorded is None:
+                self._recorded = self._load()
+            entries = self._recorded.get(key)
+            if not entries:
+                self.stats["misses"] += 1
+                return None
+            served = self._served[key]
+            self._served[key] = served + 1
+            self.stats["replayed"] += 1
+        return entries[min(served, len(entries) - 1)]
+
+    def delay(self, entry: Dict) -> float:
+        """
+        How long to hold a replayed response back; no time at all at speed 0
+        """
+        return entry["duration"] / self.speed if self.speed > 0 else 0.0
+
+    def _load(self) -> Dict[RequestKey, List[Dict]]:
+        recorded = defaultdict(list)
+        try:
+            with gzip.open(self.archive, "rb") as f:
+                for line in f:
+                    entry = orjson.loads(line)
+                    key = (entry["upstream"], entry["method"], entry["target"], entry["body_sha1"], entry["tenant"])
+                    recorded[key].append(entry)
+        except (EOFError, orjson.JSONDecodeError):
+            # The recording process was stopped mid-write
+            pass
+        except OSError as e:
+            # Every request misses, so nothing is sent anywhere
+            print(f"Error loading upstream traffic archive {self.archive}: {str(e)}")
+        return recorded
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def entry_content(entry: Dict) -> bytes:
+    if "content_b64" in entry:
+        return base64.b64decode(entry["content_b64"])
+    return entry.get("content", "").encode("utf-8")
+
+upstream_traffic = UpstreamTraffic.from_settings()
+
+class TrafficAdapter(HTTPAdapter):
+    """
+    requests transport adapter for one upstream: passes requests through,
+    records them, or answers them from the archive depending on the mode
+    """
+    def __init__(self, upstream: str, traffic: UpstreamTraffic = upstream_traffic, **kwargs):
+        super().__init__(**kwargs)
+        self.upstream = upstream
+        self.traffic = traffic
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if self.traffic.mode == REPLAY:
+            return self._replay(request, kwargs.get("timeout"))
+        if self.traffic.mode != RECORD:
+            return super().send(request, **kwargs)
+
+        body = _as_bytes(request.body)
+        started = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+            content = response.content
+        except requests.exceptions.RequestException as e:
+            error = TIMEOUT if isinstance(e, requests.exceptions.Timeout) else CONNECTION
+            self.traffic.record(
+                self.upstream, request.method, request.url, body, request.headers, time.monotonic() - started,
+                error=error
+            )
+            raise
+        self.traffic.record(
+            self.upstream, request.method, request.url, body, request.headers, time.monotonic() - started,
+            status=response.status_code, headers=response.headers, content=content
+        )
+        return response
+
+    def _replay(self, request: requests.PreparedRequest, timeout) -> requests.Response:
+        entry = self.traffic.lookup(
+            self.upstream, request.method, request.url, _as_bytes(request.body), request.headers
+        )
+        if entry is None:
+            raise requests.exceptions.ConnectionError(
+                f"No recorded {self.upstream} response for {request.method} {request.url}", request=request
+            )
+        if isinstance(timeout, tuple):
+            timeout = timeout[1]
+        delay = self.traffic.delay(entry)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise requests.exceptions.ReadTimeout(f"Replayed {self.upstream} response timed out", request=request)
+        if delay:
+            time.sleep(delay)
+
+        if entry.get("error") == TIMEOUT:
+            raise requests.exceptions.ReadTimeout(f"Recorded {self.upstream} timeout", request=request)
+        if entry.get("error"):
+            raise requests.exceptions.ConnectionError(f"Recorded {self.upstream} connection error", request=request)
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = _reason(entry["status"])
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = entry_content(entry)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+@lru_cache(maxsize=None)
+def upstream_session(upstream: str) -> requests.Session:
+    """
+    Shared requests session for "dext" or "xero". Connections are pooled;
+    cookies are not kept, so nothing leaks between tenants.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = TrafficAdapter(upstream, pool_maxsize=POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@lru_cache(maxsize=None)
+def _httpx_transport_class():
+    # httpx comes with the OpenAI SDK, which is only imported on first use
+    import httpx
+
+    class TrafficTransport(httpx.AsyncBaseTransport):
+        """
+        httpx counterpart of TrafficAdapter, for the OpenAI SDK
+        """
+        def __init__(self, upstream: str, traffic: UpstreamTraffic = upstream_traffic):
+            self.upstream = upstream
+            self.traffic = traffic
+            # The SDK's own connection limits
+            self.transport = httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+
+        async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+            body = await request.aread()
+            url = str(request.url)
+            if self.traffic.mode == REPLAY:
+                return await self._replay(request, url, body)
+            if self.traffic.mode != RECORD:
+                return await self.transport.handle_async_request(request)
+
+            started = time.monotonic()
+            try:
+                response = await self.transport.handle_async_request(request)
+                content = await response.aread()
+            except httpx.TransportError as e:
+                error = TIMEOUT if isinstance(e, httpx.TimeoutException) else CONNECTION
+                self.traffic.record(
+                    self.upstream, request.method, url, body, request.headers, time.monotonic() - started,
+                    error=error
+                )
+                raise
+            self.traffic.record(
+                self.upstream, request.method, url, body, request.headers, time.monotonic() - started,
+                status=response.status_code, headers=response.headers, content=content
+            )
+            # The content is already decoded; left in place, these headers
+            # would have the client decode it again
+            headers = [
+                (name, value) for name, value in response.headers.multi_items()
+                if name.lower() not in DECODED_HEADERS
+            ]
+            return httpx.Response(
+                response.status_code, headers=headers, content=content,
+                extensions=response.extensions, request=request
+            )
+
+        async def _replay(self, request: httpx.Request, url: str, body: bytes) -> httpx.Response:
+            entry = self.traffic.lookup(self.upstream, request.method, url, body, request.headers)
+            if entry is None:
+                raise httpx.ConnectError(f"No recorded {self.upstream} response for {request.method} {url}", request=request)
+            timeout = request.extensions.get("timeout", {}).get("read")
+            delay = self.traffic.delay(entry)
+            if timeout is not None and delay > timeout:
+                await asyncio.sleep(timeout)
+                raise httpx.ReadTimeout(f"Replayed {self.upstream} response timed out", request=request)
+            if delay:
+                await asyncio.sleep(delay)
+
+            if entry.get("error") == TIMEOUT:
+                raise httpx.ReadTimeout(f"Recorded {self.upstream} timeout", request=request)
+            if entry.get("error"):
+                raise httpx.ConnectError(f"Recorded {self.upstream} connection error", request=request)
+            return httpx.Response(
+                entry["status"], headers=entry["headers"], content=entry_content(entry), request=request
+            )
+
+        async def aclose(self):
+            await self.transport.aclose()
+
+    return TrafficTransport
+
+def openai_http_client(timeout: float):
+    """
+    httpx client for the OpenAI SDK that records or replays its traffic, or
+    None to leave the SDK's default client in place while traffic is
+    neither recorded nor replayed
+    """
+    if upstream_traffic.mode == OFF:
+        return None
+    import httpx
+
+    return httpx.AsyncClient(transport=_httpx_transport_class()("openai"), timeout=timeout)
@@ -1,10 +1,18 @@
-from fastapi import FastAPI, Request
+from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from dotenv import load_dotenv
 import os
-from app.api import settings, xero
+from app.api import settings, xero, admin, invoices, sync, webhooks
+from app.core.config import settings as app_settings
+from app.core.database import engine
+from app.core.dependencies import get_invoice_archive, get_sync_scheduler, get_webhook_queue
 from app.core.init_db import init_db
-from app.core.security import rate_limit_middleware, verify_api_key
+from app.core.partitions import archive_cutoff, ensure_invoice_partitions
+from app.core.security import rate_limit_middleware, require_admin, verify_api_key
+from app.core.profiling import profiling_middleware
+from app.core.upstream_traffic import upstream_traffic
+from app.services.ocr_service import shutdown_process_pool
 
 # Load environment variables
 load_dotenv()
@@ -28,13 +36,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger responses; cached invoice reads arrive already compressed
+app.add_middleware(GZipMiddleware, minimum_size=app_settings.GZIP_MINIMUM_SIZE)
+
 # Add rate limiting middleware
 app.middleware("http")(rate_limit_middleware)
 
+# Opt-in request profiling; not installed at all unless enabled
+if app_settings.PROFILING_ENABLED:
+    app.middleware("http")(profiling_middleware)
+
 @app.on_event("startup")
 async def startup_event():
     # Initialize database tables
     init_db()
+    # Invoice partitions for the coming months (Postgres only)
+    ensure_invoice_partitions(
+        engine,
+        archive_cutoff(app_settings.ARCHIVE_AFTER_MONTHS),
+        app_settings.PARTITION_MONTHS_AHEAD
+    )
+    # Start processing queued webhook events
+    await get_webhook_queue().start()
+    # Periodic sync of every tenant, if configured
+    if app_settings.SYNC_INTERVAL_SECONDS > 0:
+        await get_sync_scheduler().start_periodic(app_settings.SYNC_INTERVAL_SECONDS)
+    # Periodic archiving of closed periods, if configured
+    if app_settings.ARCHIVE_INTERVAL_SECONDS > 0:
+        await get_invoice_archive().start_periodic(app_settings.ARCHIVE_INTERVAL_SECONDS)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await get_sync_scheduler().stop()
+    await get_invoice_archive().stop()
+    await get_webhook_queue().stop()
+    shutdown_process_pool()
+    # Finish writing a traffic recording
+    upstream_traffic.close()
 
 # Health check endpoint (no auth required)
 @app.get("/health")
@@ -46,13 +84,38 @@ app.include_router(
     settings.router,
     prefix="/api",
     tags=["settings"],
-    dependencies=[verify_api_key]
+    dependencies=[Depends(verify_api_key)]
 )
 app.include_router(
     xero.router,
     prefix="/api",
     tags=["xero"],
-    dependencies=[verify_api_key]
+    dependencies=[Depends(verify_api_key)]
+)
+app.include_router(
+    invoices.router,
+    prefix="/api",
+    tags=["invoices"],
+    dependencies=[Depends(verify_api_key)]
+)
+app.include_router(
+    sync.router,
+    prefix="/api",
+    tags=["sync"],
+    dependencies=[Depends(verify_api_key)]
+)
+# Webhooks authenticate by signature rather than bearer token
+app.include_router(
+    webhooks.router,
+    prefix="/api",
+    tags=["webhooks"]
+)
+# Admin endpoints act on the whole deployment; they need the admin role
+app.include_router(
+    admin.router,
+    prefix="/api",
+    tags=["admin"],
+    dependencies=[Depends(require_admin)]
 )
 
 # Import and include routers
@@ -0,0 +1,26 @@
+from sqlalchemy import Column, Integer, String, DateTime, Index
+from datetime import datetime
+from app.core.database import Base
+
+class ArchivedInvoice(Base):
+    """
+    Key of an invoice moved to the Parquet archive (see
+    app.services.archive_service) and the file holding it. Keeps archived
+    invoices from being ingested again and tells reads which files to open.
+    """
+    __tablename__ = "archived_invoices"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    tenant_id = Column(String, nullable=False)
+    dext_id = Column(String)
+    date = Column(DateTime)
+    archive_path = Column(String, nullable=False)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_archived_invoices_tenant_dext_id", "tenant_id", "dext_id", unique=True),
+        Index("ix_archived_invoices_tenant_date", "tenant_id", "date"),
+    )
+
+    def __repr__(self):
+        return f"<ArchivedInvoice {self.id} - {self.archive_path}>"
@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON
+from datetime import datetime
+from app.core.database import Base
+
+class DocumentExtraction(Base):
+    """
+    OCR result for a source document, keyed by the SHA-256 of its bytes so
+    the same document is never sent to the OCR backend twice
+    """
+    __tablename__ = "document_extractions"
+
+    document_hash = Column(String(64), primary_key=True)
+    backend = Column(String, primary_key=True)
+    pages = Column(Integer)
+    text = Column(Text)
+    fields = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<DocumentExtraction {self.document_hash[:12]} - {self.backend}>"
@@ -1,21 +1,24 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Enum, JSON
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, String, Float, DateTime, Enum, JSON, Index
 from datetime import datetime
 import enum
-
-Base = declarative_base()
+from app.core.database import Base
 
 class InvoiceStatus(enum.Enum):
     PENDING = "pending"
     VALIDATED = "validated"
     PUSHED_TO_XERO = "pushed_to_xero"
     ERROR = "error"
+    # Valid, but held back from Xero as a likely duplicate or unusual amount
+    ON_HOLD = "on_hold"
 
 class Invoice(Base):
     __tablename__ = "invoices"
 
     id = Column(Integer, primary_key=True, index=True)
-    dext_id = Column(String, unique=True, index=True)
+    tenant_id = Column(String, nullable=True)
+    # Unique per organisation, see ix_invoices_tenant_dext_id (and
+    # invoice_dext_ids once partitioned)
+    dext_id = Column(String)
     supplier_name = Column(String)
     vat_number = Column(String)
     vat_code = Column(String)
@@ -23,10 +26,22 @@ class Invoice(Base):
     date = Column(DateTime)
     status = Column(Enum(InvoiceStatus), default=InvoiceStatus.PENDING)
     confidence_score = Column(Float)
-    validation_errors = Column(JSON, nullable=True)
+    # None is stored as SQL NULL rather than JSON null, whether written
+    # through the ORM or as bulk-inserted rows
+    validation_errors = Column(JSON(none_as_null=True), nullable=True)
     xero_invoice_id = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Existing databases get these through app.core.migrations. On Postgres
+    # the table is partitioned by month (app.core.partitions), whose unique
+    # indexes also include `date`.
+    __table_args__ = (
+        Index("ix_invoices_date", "date"),
+        Index("ix_invoices_status_date", "status", "date"),
+        Index("ix_invoices_tenant_dext_id", "tenant_id", "dext_id", unique=True),
+        Index("ix_invoices_tenant_status_date", "tenant_id", "status", "date"),
+    )
     
     def __repr__(self):
         return f"<Invoice {self.dext_id} - {self.supplier_name}>" 
\ No newline at end of file
@@ -0,0 +1,17 @@
+from sqlalchemy import BigInteger, Column, String
+from app.core.database import Base
+
+class InvoiceGeneration(Base):
+    """
+    Counter per tenant, advanced in the same transaction as any change to
+    the tenant's invoices (see app.core.http_cache). Every worker compares
+    it against its cached responses, so none serves one from before the
+    change once it has committed.
+    """
+    __tablename__ = "invoice_generations"
+
+    tenant_id = Column(String, primary_key=True)
+    generation = Column(BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<InvoiceGeneration {self.tenant_id} - {self.generation}>"
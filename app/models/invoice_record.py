@@ -0,0 +1,84 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Optional, Union
+from app.models.invoice import Invoice, InvoiceStatus
+
+@dataclass(slots=True)
+class InvoiceRecord:
+    """
+    An invoice on its way from Dext to Xero. Sync and webhook ingestion
+    validate and push these plain slotted records and only turn them into
+    Invoice rows (to_row) or ORM objects (to_orm) once they are persisted,
+    so a large backfill does not pay for ORM instrumentation and identity
+    map bookkeeping on every in-flight invoice.
+    """
+    dext_id: str
+    supplier_name: Optional[str]
+    vat_number: Optional[str]
+    vat_code: Optional[str]
+    amount: float
+    date: datetime
+    tenant_id: Optional[str] = None
+    status: InvoiceStatus = InvoiceStatus.PENDING
+    confidence_score: float = 0.0  # Will be updated during validation
+    validation_errors: Optional[Any] = None
+    xero_invoice_id: Optional[str] = None
+    # Where Dext serves the source document, if the payload says
+    document_url: Optional[str] = None
+    # The invoice's row, once it is saved ahead of its push to Xero
+    id: Optional[int] = None
+
+    @classmethod
+    def from_dext(cls, invoice_data: Dict, tenant_id: Optional[str] = None) -> "InvoiceRecord":
+        """
+        Build a record from a Dext invoice payload; raises KeyError or
+        ValueError if it is incomplete or malformed
+        """
+        return cls(
+            dext_id=invoice_data["id"],
+            supplier_name=invoice_data["supplier_name"],
+            vat_number=invoice_data.get("vat_number"),
+            vat_code=invoice_data.get("vat_code"),
+            amount=float(invoice_data["amount"]),
+            date=datetime.fromisoformat(invoice_data["date"]),
+            tenant_id=tenant_id,
+            document_url=invoice_data.get("document_url"),
+        )
+
+    def to_row(self) -> Dict:
+        """
+        Column values for a bulk insert into invoices
+        """
+        now = datetime.utcnow()
+        return {
+            "tenant_id": self.tenant_id,
+            "dext_id": self.dext_id,
+            "supplier_name": self.supplier_name,
+            "vat_number": self.vat_number,
+            "vat_code": self.vat_code,
+            "amount": self.amount,
+            "date": self.date,
+            "status": self.status,
+            "confidence_score": self.confidence_score,
+            "validation_errors": self.validation_errors,
+            "xero_invoice_id": self.xero_invoice_id,
+            "created_at": now,
+            "updated_at": now,
+        }
+
+    def outcome(self) -> Dict:
+        """
+        Column values that processing changes, for updating a saved row
+        """
+        return {
+            "status": self.status,
+            "confidence_score": self.confidence_score,
+            "validation_errors": self.validation_errors,
+            "xero_invoice_id": self.xero_invoice_id,
+        }
+
+    def to_orm(self) -> Invoice:
+        return Invoice(**self.to_row())
+
+# Validation and the push to Xero work on either
+AnyInvoice = Union[Invoice, InvoiceRecord]
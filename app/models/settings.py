@@ -1,13 +1,18 @@
 from sqlalchemy import Column, Integer, String, JSON
-from sqlalchemy.ext.declarative import declarative_base
-from app.core.security import api_key_encryption
-
-Base = declarative_base()
+from app.core.database import Base
+from app.core.security import get_api_key_encryption
 
 class Settings(Base):
     __tablename__ = "settings"
 
     id = Column(Integer, primary_key=True, index=True)
+    # One row per organisation; see app.core.dependencies.get_tenant_id
+    tenant_id = Column(String, unique=True, index=True, nullable=True)
+    # Overrides TENANT_MAX_CONCURRENCY for this organisation
+    max_concurrency = Column(Integer, nullable=True)
+    # The organisation's Xero tenant id: sent as xero-tenant-id on every Xero
+    # call and used to route Xero webhook events
+    xero_tenant_id = Column(String, unique=True, index=True, nullable=True)
     
     # Encrypted fields
     _dext_api_key = Column('dext_api_key', String, nullable=True)
@@ -16,6 +21,7 @@ class Settings(Base):
     _xero_access_token = Column('xero_access_token', String, nullable=True)
     _xero_refresh_token = Column('xero_refresh_token', String, nullable=True)
     _openai_api_key = Column('openai_api_key', String, nullable=True)
+    _dext_webhook_secret = Column('dext_webhook_secret', String, nullable=True)
     
     # Non-encrypted fields
     xero_token_expires_at = Column(String, nullable=True)
@@ -24,77 +30,90 @@ class Settings(Base):
     @property
     def dext_api_key(self):
         if self._dext_api_key:
-            return api_key_encryption.decrypt(self._dext_api_key)
+            return get_api_key_encryption().decrypt(self._dext_api_key)
         return None
 
     @dext_api_key.setter
     def dext_api_key(self, value):
         if value:
-            self._dext_api_key = api_key_encryption.encrypt(value)
+            self._dext_api_key = get_api_key_encryption().encrypt(value)
         else:
             self._dext_api_key = None
 
     @property
     def xero_client_id(self):
         if self._xero_client_id:
-            return api_key_encryption.decrypt(self._xero_client_id)
+            return get_api_key_encryption().decrypt(self._xero_client_id)
         return None
 
     @xero_client_id.setter
     def xero_client_id(self, value):
         if value:
-            self._xero_client_id = api_key_encryption.encrypt(value)
+            self._xero_client_id = get_api_key_encryption().encrypt(value)
         else:
             self._xero_client_id = None
 
     @property
     def xero_client_secret(self):
         if self._xero_client_secret:
-            return api_key_encryption.decrypt(self._xero_client_secret)
+            return get_api_key_encryption().decrypt(self._xero_client_secret)
         return None
 
     @xero_client_secret.setter
     def xero_client_secret(self, value):
         if value:
-            self._xero_client_secret = api_key_encryption.encrypt(value)
+            self._xero_client_secret = get_api_key_encryption().encrypt(value)
         else:
             self._xero_client_secret = None
 
     @property
     def xero_access_token(self):
         if self._xero_access_token:
-            return api_key_encryption.decrypt(self._xero_access_token)
+            return get_api_key_encryption().decrypt(self._xero_access_token)
         return None
 
     @xero_access_token.setter
     def xero_access_token(self, value):
         if value:
-            self._xero_access_token = api_key_encryption.encrypt(value)
+            self._xero_access_token = get_api_key_encryption().encrypt(value)
         else:
             self._xero_access_token = None
 
     @property
     def xero_refresh_token(self):
         if self._xero_refresh_token:
-            return api_key_encryption.decrypt(self._xero_refresh_token)
+            return get_api_key_encryption().decrypt(self._xero_refresh_token)
         return None
 
     @xero_refresh_token.setter
     def xero_refresh_token(self, value):
         if value:
-            self._xero_refresh_token = api_key_encryption.encrypt(value)
+            self._xero_refresh_token = get_api_key_encryption().encrypt(value)
         else:
             self._xero_refresh_token = None
 
     @property
     def openai_api_key(self):
         if self._openai_api_key:
-            return api_key_encryption.decrypt(self._openai_api_key)
+            return get_api_key_encryption().decrypt(self._openai_api_key)
         return None
 
     @openai_api_key.setter
     def openai_api_key(self, value):
         if value:
-            self._openai_api_key = api_key_encryption.encrypt(value)
+            self._openai_api_key = get_api_key_encryption().encrypt(value)
+        else:
+            self._openai_api_key = None
+
+    @property
+    def dext_webhook_secret(self):
+        if self._dext_webhook_secret:
+            return get_api_key_encryption().decrypt(self._dext_webhook_secret)
+        return None
+
+    @dext_webhook_secret.setter
+    def dext_webhook_secret(self, value):
+        if value:
+            self._dext_webhook_secret = get_api_key_encryption().encrypt(value)
         else:
-            self._openai_api_key = None 
\ No newline at end of file
+            self._dext_webhook_secret = None
@@ -0,0 +1,434 @@
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+import re
+import threading
+import time
+from sqlalchemy import or_, select
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.invoice import Invoice
+from app.services.invoice_store import stored_dext_ids
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Duplicate and amount-anomaly detection over invoices held as NumPy
+# columns. Near-duplicates are found by blocking on (supplier, amount
+# bucket), sorting each block by date and joining neighbours that fall
+# inside the date window. Amount outliers use a robust z-score, the
+# deviation from the supplier's median log amount scaled by its MAD. NumPy
+# is imported on first use, keeping it out of the app's startup.
+
+SUPPLIER_SUFFIXES = re.compile(r"\b(ltd|limited|plc|llp|inc|co|company)\b")
+NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+# MAD floor in log-amount space. Without one, a supplier that has always
+# billed the same amount would flag any change at all.
+MIN_MAD = 0.05
+# Scales the MAD to a standard deviation for normally distributed data
+MAD_SCALE = 0.6745
+
+FETCH_CHUNK_SIZE = 50_000
+
+# Ids skipped by an incremental refresh may belong to rows still being
+# committed (concurrent webhook and batch inserts commit out of id order).
+# They are looked up again on later refreshes for this long; longer jumps in
+# the sequence are not tracked. Anything missed is picked up when the
+# tenant is reloaded every ANOMALY_RELOAD_SECONDS.
+GAP_RECHECK_SECONDS = 300
+MAX_TRACKED_GAP = 1000
+
+# Supplier and day packed into one sortable key: supplier * KEY_STRIDE + day
+KEY_STRIDE = 1 << 24
+
+def normalise_supplier(name: Optional[str]) -> str:
+    """
+    "ACME Ltd.", "Acme Limited" and "acme" are the same supplier
+    """
+    words = NON_ALNUM.sub(" ", (name or "").lower())
+    return " ".join(SUPPLIER_SUFFIXES.sub(" ", words).split())
+
+def normalise_vat_number(vat_number: Optional[str]) -> str:
+    return "".join((vat_number or "").split()).upper()
+
+def find_duplicate_pairs(
+    supplier: "np.ndarray",
+    vat: "np.ndarray",
+    cents: "np.ndarray",
+    day: "np.ndarray",
+    window_days: int,
+    tolerance_cents: int,
+) -> "np.ndarray":
+    """
+    Row index pairs (i, j), i < j, of invoices from the same supplier whose
+    amounts differ by at most tolerance_cents and whose dates are at most
+    window_days apart. Pairs with two different VAT numbers are not
+    duplicates; supplier or VAT code 0 means unknown.
+    """
+    import numpy as np
+
+    # Two bucketings offset by half a bucket: any two amounts closer than
+    # half a bucket share a bucket in at least one of them
+    width = 2 * tolerance_cents + 2
+    candidates = [np.empty((0, 2), dtype=np.int64)]
+    for offset in (0, width // 2):
+        bucket = (cents + offset) // width
+        order = np.lexsort((day, bucket, supplier))
+        s, b, d = supplier[order], bucket[order], day[order]
+        # Within a block rows are date-ordered, so if no row has a partner
+        # k places on inside the window, none has one further on either
+        for k in range(1, len(order)):
+            joined = (s[k:] == s[:-k]) & (b[k:] == b[:-k]) & (d[k:] - d[:-k] <= window_days)
+            if not joined.any():
+                break
+            left = np.nonzero(joined)[0]
+            candidates.append(np.stack([order[left], order[left + k]], axis=1))
+
+    pairs = np.concatenate(candidates)
+    first, second = pairs[:, 0], pairs[:, 1]
+    keep = (
+        (supplier[first] != 0)
+        & (np.abs(cents[first] - cents[second]) <= tolerance_cents)
+        & ((vat[first] == 0) | (vat[second] == 0) | (vat[first] == vat[second]))
+    )
+    pairs = np.sort(pairs[keep], axis=1)
+    return np.unique(pairs, axis=0)
+
+def supplier_amount_stats(supplier: "np.ndarray", cents: "np.ndarray") -> Tuple["np.ndarray", ...]:
+    """
+    Per supplier: (codes, median log amount, MAD, invoice count), with
+    codes sorted so they can be looked up with np.searchsorted
+    """
+    import numpy as np
+
+    amounts = np.log(np.maximum(cents, 1))
+    order = np.lexsort((amounts, supplier))
+    grouped, sorted_amounts = supplier[order], amounts[order]
+    codes, starts, counts = np.unique(grouped, return_index=True, return_counts=True)
+
+    def group_median(values: "np.ndarray") -> "np.ndarray":
+        return (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2
+
+    median = group_median(sorted_amounts)
+    deviation = np.abs(sorted_amounts - np.repeat(median, counts))
+    # grouped is already sorted, so this only reorders within each supplier
+    mad = group_median(deviation[np.lexsort((deviation, grouped))])
+    return codes, median, np.maximum(mad, MIN_MAD), counts
+
+def robust_scores(stats: Tuple["np.ndarray", ...], supplier: "np.ndarray", cents: "np.ndarray") -> "np.ndarray":
+    """
+    Robust z-score of each amount against its supplier's history; 0 where
+    the supplier has fewer than OUTLIER_MIN_HISTORY invoices
+    """
+    import numpy as np
+
+    codes, median, mad, counts = stats
+    scores = np.zeros(len(supplier))
+    if not len(codes):
+        return scores
+    position = np.minimum(np.searchsorted(codes, supplier), len(codes) - 1)
+    known = (codes[position] == supplier) & (counts[position] >= settings.OUTLIER_MIN_HISTORY)
+    amounts = np.log(np.maximum(cents, 1))
+    scores[known] = MAD_SCALE * (amounts[known] - median[position[known]]) / mad[position[known]]
+    return scores
+
+class InvoiceColumns:
+    """
+    Columnar copy of one tenant's invoices, one NumPy array per field,
+    grown in place as invoices are added
+    """
+    DTYPES = {"id": "int64", "supplier": "int32", "vat": "int32", "cents": "int64", "day": "int64"}
+
+    def __init__(self, capacity: int = 1024):
+        import numpy as np
+
+        self.size = 0
+        self.last_id = 0
+        self.loaded_at = time.monotonic()
+        # Skipped ids above the rows loaded so far, with when they were skipped
+        self.gaps: Dict[int, float] = {}
+        self._arrays = {name: np.empty(capacity, dtype) for name, dtype in self.DTYPES.items()}
+        self._stats: Optional[Tuple["np.ndarray", ...]] = None
+        self._stats_size = 0
+        self._sorted_keys: Optional["np.ndarray"] = None
+        self._key_order: Optional["np.ndarray"] = None
+        self._keys_size = 0
+
+    def __getitem__(self, name: str) -> "np.ndarray":
+        return self._arrays[name][:self.size]
+
+    def append(self, columns: Dict[str, "np.ndarray"]):
+        import numpy as np
+
+        added = len(columns["id"])
+        if not added:
+            return
+        capacity = len(self._arrays["id"])
+        if self.size + added > capacity:
+            capacity = max(capacity * 2, self.size + added)
+            for name, array in self._arrays.items():
+                grown = np.empty(capacity, array.dtype)
+                grown[:self.size] = array[:self.size]
+                self._arrays[name] = grown
+        for name, array in self._arrays.items():
+            array[self.size:self.size + added] = columns[name]
+        self.size += added
+
+    def seen(self, ids: Sequence[int], now: float):
+        """
+        Note the ids an incremental refresh read, in order: ids skipped
+        between them are gaps to look up again, and gaps read are filled
+        """
+        for row_id in ids:
+            if row_id <= self.last_id:
+                self.gaps.pop(row_id, None)
+                continue
+            if row_id - self.last_id <= MAX_TRACKED_GAP:
+                for missing in range(self.last_id + 1, row_id):
+                    self.gaps[missing] = now
+            self.last_id = row_id
+
+    def open_gaps(self, now: float) -> List[int]:
+        """
+        Gaps still worth looking up; older ones are given up on
+        """
+        self.gaps = {row_id: skipped for row_id, skipped in self.gaps.items() if now - skipped < GAP_RECHECK_SECONDS}
+        return sorted(self.gaps)
+
+    def keys(self) -> "np.ndarray":
+        return self["supplier"].astype("int64") * KEY_STRIDE + self["day"]
+
+    def near(self, keys: "np.ndarray", window: int) -> "np.ndarray":
+        """
+        Positions of rows whose key is within `window` of any of `keys`,
+        i.e. same supplier and at most `window` days apart. Uses a sorted
+        key index, rebuilt once a tenth of the rows are newer than it; the
+        newer rows are compared directly.
+        """
+        import numpy as np
+
+        if self._sorted_keys is None or self.size > self._keys_size * 1.1:
+            all_keys = self.keys()
+            self._key_order = np.argsort(all_keys, kind="stable")
+            self._sorted_keys = all_keys[self._key_order]
+            self._keys_size = self.size
+
+        starts = np.searchsorted(self._sorted_keys, keys - window, side="left")
+        ends = np.searchsorted(self._sorted_keys, keys + window, side="right")
+        lengths = ends - starts
+        # Concatenated ranges starts[i]:ends[i] without a Python loop
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        indexed = self._key_order[offsets + np.arange(lengths.sum())]
+
+        newer_keys = self.keys()[self._keys_size:]
+        sorted_batch = np.sort(keys)
+        nearest = sorted_batch[np.minimum(np.searchsorted(sorted_batch, newer_keys - window), len(keys) - 1)]
+        newer = self._keys_size + np.nonzero(np.abs(nearest - newer_keys) <= window)[0]
+        return np.unique(np.concatenate([indexed, newer]))
+
+    def stats(self) -> Tuple["np.ndarray", ...]:
+        """
+        Supplier amount statistics, recomputed once the table has grown by
+        a tenth since they were last computed
+        """
+        if self._stats is None or self.size > self._stats_size * 1.1:
+            self._stats = supplier_amount_stats(self["supplier"], self["cents"])
+            self._stats_size = self.size
+        return self._stats
+
+class AnomalyDetector:
+    """
+    Flags likely duplicates and unusual amounts so they are held back
+    before being pushed to Xero.
+
+    Each tenant's invoices are loaded into InvoiceColumns on first use and
+    topped up with newer rows (by id) before each check, so checking a
+    sync batch only costs a query for the new rows and a few vectorised
+    passes over the candidate rows. Rows committed out of id order are
+    caught by looking up skipped ids again for a while, and by reloading
+    each tenant every ANOMALY_RELOAD_SECONDS.
+    """
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self._columns: Dict[str, InvoiceColumns] = {}
+        self._suppliers: Dict[str, int] = {"": 0}
+        self._vat_numbers: Dict[str, int] = {"": 0}
+        self._lock = threading.Lock()
+
+    def _code(self, codes: Dict[str, int], value: str) -> int:
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+        return code
+
+    def _encode(self, rows: Sequence[Tuple]) -> Tuple[Dict[str, "np.ndarray"], "np.ndarray"]:
+        """
+        Column arrays for (id, supplier_name, vat_number, amount, date) rows;
+        rows without a usable amount or date are dropped. Also returns the
+        positions of the rows that were kept.
+        """
+        import numpy as np
+
+        supplier_codes, vat_codes, amounts, dates = [], [], [], []
+        for _, supplier_name, vat_number, amount, date in rows:
+            supplier_codes.append(self._code(self._suppliers, normalise_supplier(supplier_name)))
+            vat_codes.append(self._code(self._vat_numbers, normalise_vat_number(vat_number)))
+            amounts.append(np.nan if amount is None else float(amount))
+            dates.append(date)
+
+        amounts = np.array(amounts, dtype=float)
+        days = np.array(dates, dtype="datetime64[D]")
+        kept = np.nonzero(~np.isnan(amounts) & ~np.isnat(days))[0]
+        columns = {
+            "id": np.array([row[0] or 0 for row in rows], dtype=np.int64)[kept],
+            "supplier": np.array(supplier_codes, dtype=np.int32)[kept],
+            "vat": np.array(vat_codes, dtype=np.int32)[kept],
+            "cents": np.round(amounts[kept] * 100).astype(np.int64),
+            "day": days[kept].astype(np.int64),
+        }
+        return columns, kept
+
+    def _refresh(self, tenant_id: str) -> InvoiceColumns:
+        """
+        Load the tenant's invoices added since the last refresh, or all of
+        them on first use and once the last full load is
+        ANOMALY_RELOAD_SECONDS old
+        """
+        now = time.monotonic()
+        columns = self._columns.get(tenant_id)
+        if columns is None or now - columns.loaded_at >= settings.ANOMALY_RELOAD_SECONDS:
+            columns = self._columns[tenant_id] = InvoiceColumns()
+        incremental = columns.last_id > 0
+        query = select(
+            Invoice.id, Invoice.supplier_name, Invoice.vat_number, Invoice.amount, Invoice.date, Invoice.tenant_id
+        ).order_by(Invoice.id)
+        if incremental:
+            # Only a handful of new rows: a primary key range scan, with the
+            # tenant filtered here rather than steering the planner to the
+            # tenant index. Every tenant's rows are read, so any id skipped
+            # is one that was not committed yet.
+            gaps = columns.open_gaps(now)
+            newer = Invoice.id > columns.last_id
+            query = query.where(or_(newer, Invoice.id.in_(gaps)) if gaps else newer)
+        else:
+            query = query.where(Invoice.tenant_id == tenant_id)
+
+        db = self.session_factory()
+        try:
+            result = db.execute(query.execution_options(yield_per=FETCH_CHUNK_SIZE))
+            for rows in result.partitions():
+                columns.append(self._encode([row[:5] for row in rows if row[5] == tenant_id])[0])
+                # Rows dropped for lacking an amount or date still count as seen
+                if incremental:
+                    columns.seen([row[0] for row in rows], now)
+                else:
+                    columns.last_id = max(columns.last_id, rows[-1][0])
+        finally:
+            db.close()
+        return columns
+
+    def reload(self, tenant_id: str) -> InvoiceColumns:
+        with self._lock:
+            self._columns.pop(tenant_id, None)
+            return self._refresh(tenant_id)
+
+    def check_batch(self, tenant_id: str, records: List[Dict]) -> Dict[str, List[Dict]]:
+        """
+        Check new Dext invoice payloads (id, supplier_name, vat_number,
+        amount, date) against the tenant's stored invoices and each other.
+        Returns the reasons to hold each flagged record, keyed by Dext id.
+        Of two duplicates in the same batch, the later one is held.
+        """
+        import numpy as np
+
+        records = self._unstored(tenant_id, records)
+        if not records:
+            return {}
+        with self._lock:
+            columns = self._refresh(tenant_id)
+            batch, kept = self._encode([
+                (None, record.get("supplier_name"), record.get("vat_number"),
+                 record.get("amount"), self._parse_date(record.get("date")))
+                for record in records
+            ])
+            if not len(kept):
+                return {}
+            dext_ids = [str(records[position].get("id")) for position in kept]
+            holds: Dict[str, List[Dict]] = {}
+
+            # Stored invoices that could pair with a batch invoice: same
+            # supplier and within the date window of it
+            window = settings.DUPLICATE_DATE_WINDOW_DAYS
+            in_range = columns.near(batch["supplier"].astype(np.int64) * KEY_STRIDE + batch["day"], window)
+
+            stored = len(in_range)
+            joined = {
+                name: np.concatenate([columns[name][in_range], batch[name]])
+                for name in ("supplier", "vat", "cents", "day")
+            }
+            pairs = find_duplicate_pairs(
+                joined["supplier"], joined["vat"], joined["cents"], joined["day"],
+                window, round(settings.DUPLICATE_AMOUNT_TOLERANCE * 100),
+            )
+            # Pairs are (i, j) with i < j, and batch rows come after stored
+            # ones in batch order, so j is always the row to hold
+            for first, second in pairs[pairs[:, 1] >= stored]:
+                if first < stored:
+                    duplicate_of = {"invoice_id": int(columns["id"][in_range[first]])}
+                else:
+                    duplicate_of = {"dext_id": dext_ids[first - stored]}
+                holds.setdefault(dext_ids[second - stored], []).append({"type": "duplicate", **duplicate_of})
+
+            scores = robust_scores(columns.stats(), batch["supplier"], batch["cents"])
+            for position in np.nonzero(np.abs(scores) > settings.OUTLIER_Z_THRESHOLD)[0]:
+                holds.setdefault(dext_ids[position], []).append(
+                    {"type": "amount_outlier", "score": round(float(scores[position]), 2)}
+                )
+            return holds
+
+    def scan(self, tenant_id: str) -> Dict:
+        """
+        Full pass over the tenant's stored invoices: every duplicate pair
+        and every amount outlier, by invoice id
+        """
+        import numpy as np
+
+        with self._lock:
+            columns = self._refresh(tenant_id)
+            pairs = find_duplicate_pairs(
+                columns["supplier"], columns["vat"], columns["cents"], columns["day"],
+                settings.DUPLICATE_DATE_WINDOW_DAYS, round(settings.DUPLICATE_AMOUNT_TOLERANCE * 100),
+            )
+            scores = robust_scores(columns.stats(), columns["supplier"], columns["cents"])
+            outliers = np.nonzero(np.abs(scores) > settings.OUTLIER_Z_THRESHOLD)[0]
+            ids = columns["id"]
+            return {
+                "invoices": columns.size,
+                "duplicates": ids[pairs].tolist(),
+                "outliers": [
+                    {"invoice_id": int(ids[position]), "score": round(float(scores[position]), 2)}
+                    for position in outliers
+                ],
+            }
+
+    def _unstored(self, tenant_id: str, records: List[Dict]) -> List[Dict]:
+        """
+        Drop records already ingested or archived, which a full sync
+        refetches every time
+        """
+        dext_ids = [str(record.get("id")) for record in records]
+        db = self.session_factory()
+        try:
+            stored = stored_dext_ids(db, tenant_id, dext_ids)
+        finally:
+            db.close()
+        return [record for record, dext_id in zip(records, dext_ids) if dext_id not in stored]
+
+    @staticmethod
+    def _parse_date(value) -> Optional[datetime]:
+        if isinstance(value, str):
+            try:
+                return datetime.fromisoformat(value)
+            except ValueError:
+                return None
+        return value
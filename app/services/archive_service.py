@@ -0,0 +1,332 @@
+from datetime import date, datetime, time, timezone
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from urllib.parse import quote
+import asyncio
+import json
+import logging
+import os
+import threading
+import uuid
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.core.http_cache import bump_invoice_generations
+from app.core.partitions import add_months, archive_cutoff, ensure_invoice_partitions, month_start, retire_partitions
+from app.models.archived_invoice import ArchivedInvoice
+from app.models.invoice import Invoice, InvoiceStatus
+
+logger = logging.getLogger("app.archive")
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from pyarrow import fs
+
+# Cold storage for invoices from closed periods. Invoices pushed to Xero and
+# dated before the archive cutoff are written to zstd-compressed Parquet
+# files, one directory per tenant and month, and removed from the invoices
+# table. archived_invoices keeps each one's key and file, so they are never
+# ingested again and reads only open the files they need. pyarrow is
+# imported on first use.
+
+INVOICES = Invoice.__table__
+
+def _archive_schema() -> "pa.Schema":
+    import pyarrow as pa
+
+    return pa.schema([
+        ("id", pa.int64()),
+        ("tenant_id", pa.string()),
+        ("dext_id", pa.string()),
+        ("supplier_name", pa.string()),
+        ("vat_number", pa.string()),
+        ("vat_code", pa.string()),
+        ("amount", pa.float64()),
+        ("date", pa.timestamp("us")),
+        ("status", pa.string()),
+        ("confidence_score", pa.float64()),
+        ("validation_errors", pa.string()),
+        ("xero_invoice_id", pa.string()),
+        ("created_at", pa.timestamp("us")),
+        ("updated_at", pa.timestamp("us")),
+    ])
+
+def _naive_utc(value: datetime) -> datetime:
+    # Stored timestamps are naive UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+class InvoiceArchive:
+    """
+    Moves invoices from closed periods to Parquet and reads them back.
+    `uri` is a local directory or a filesystem URI pyarrow understands,
+    such as s3://bucket/prefix.
+    """
+    def __init__(self, uri: Optional[str] = None, session_factory=SessionLocal):
+        self.uri = uri or settings.ARCHIVE_URI
+        self.session_factory = session_factory
+        self.last_run: Optional[Dict] = None
+        self._filesystem: Optional[Tuple["fs.FileSystem", str]] = None
+        self._run_lock = threading.Lock()
+        self._periodic_task: Optional[asyncio.Task] = None
+
+    def _fs(self) -> Tuple["fs.FileSystem", str]:
+        if self._filesystem is None:
+            from pyarrow import fs
+
+            if "://" in self.uri:
+                self._filesystem = fs.FileSystem.from_uri(self.uri)
+            else:
+                self._filesystem = (fs.LocalFileSystem(), os.path.abspath(self.uri))
+        return self._filesystem
+
+    @staticmethod
+    def cutoff(today: Optional[date] = None) -> date:
+        """
+        First day of the oldest month that is still kept in the database
+        """
+        return archive_cutoff(settings.ARCHIVE_AFTER_MONTHS, today)
+
+    def is_running(self) -> bool:
+        return self._run_lock.locked()
+
+    def run(self, before: Optional[date] = None) -> Optional[Dict]:
+        """
+        Create upcoming partitions, archive every closed period and retire
+        its partitions. Returns None if a run is already in progress.
+        """
+        if not self._run_lock.acquire(blocking=False):
+            return None
+        try:
+            before = month_start(before) if before else self.cutoff()
+            result = {
+                "before": before.isoformat(),
+                "started_at": datetime.utcnow().isoformat(),
+                "archived": 0,
+                "files": 0,
+                "tenants": {},
+            }
+            db = self.session_factory()
+            try:
+                engine = db.get_bind()
+            finally:
+                db.close()
+
+            result["created_partitions"] = ensure_invoice_partitions(engine, self.cutoff(), settings.PARTITION_MONTHS_AHEAD)
+            for tenant_id, month in self._closed_periods(before):
+                while True:
+                    archived = self._archive_batch(tenant_id, month)
+                    if not archived:
+                        break
+                    result["archived"] += archived
+                    result["files"] += 1
+                    result["tenants"][tenant_id] = result["tenants"].get(tenant_id, 0) + archived
+            result["retired_partitions"] = retire_partitions(engine, before)
+            result["finished_at"] = datetime.utcnow().isoformat()
+            self.last_run = result
+            return result
+        finally:
+            self._run_lock.release()
+
+    def _closed_periods(self, before: date) -> List[Tuple[str, date]]:
+        """
+        (tenant, month) pairs from each tenant's oldest pushed invoice up to
+        the cutoff
+        """
+        db = self.session_factory()
+        try:
+            oldest = db.execute(
+                select(Invoice.tenant_id, func.min(Invoice.date))
+                .where(
+                    Invoice.status == InvoiceStatus.PUSHED_TO_XERO,
+                    Invoice.date < datetime.combine(before, time.min),
+                )
+                .group_by(Invoice.tenant_id)
+            ).all()
+        finally:
+            db.close()
+
+        periods = []
+        for tenant_id, first in oldest:
+            month = month_start(first)
+            while month < before:
+                periods.append((tenant_id, month))
+                month = add_months(month, 1)
+        return periods
+
+    def _archive_batch(self, tenant_id: str, month: date) -> int:
+        """
+        Move up to ARCHIVE_BATCH_SIZE of a tenant's pushed invoices from one
+        month into a new Parquet file. The rows stay locked until their keys
+        are recorded and they are deleted, and the file is removed if that
+        fails, so an invoice is never in both places or in neither.
+        """
+        start = datetime.combine(month, time.min)
+        end = datetime.combine(add_months(month, 1), time.min)
+        in_period = (
+            INVOICES.c.tenant_id == tenant_id,
+            INVOICES.c.status == InvoiceStatus.PUSHED_TO_XERO,
+            INVOICES.c.date >= start,
+            INVOICES.c.date < end,
+        )
+        db = self.session_factory()
+        try:
+            query = select(INVOICES).where(*in_period).order_by(INVOICES.c.id).limit(settings.ARCHIVE_BATCH_SIZE)
+            if db.get_bind().dialect.name == "postgresql":
+                query = query.with_for_update(skip_locked=True)
+            rows = db.execute(query).mappings().all()
+            if not rows:
+                return 0
+
+            path = self._write(tenant_id, month, rows)
+            try:
+                archived_at = datetime.utcnow()
+                db.execute(insert(ArchivedInvoice), [
+                    {
+                        "id": row["id"],
+                        "tenant_id": tenant_id,
+                        "dext_id": row["dext_id"],
+                        "date": row["date"],
+                        "archive_path": path,
+                        "archived_at": archived_at,
+                    }
+                    for row in rows
+                ])
+                ids = [row["id"] for row in rows]
+                for chunk in range(0, len(ids), 500):
+                    db.execute(delete(INVOICES).where(INVOICES.c.id.in_(ids[chunk:chunk + 500]), *in_period))
+                # Bulk deletes bypass the session hook that advances the
+                # tenant's cache generation
+                bump_invoice_generations(db, [tenant_id])
+                db.commit()
+            except SQLAlchemyError:
+                db.rollback()
+                self._remove(path)
+                raise
+            return len(rows)
+        finally:
+            db.close()
+
+    def _write(self, tenant_id: str, month: date, rows) -> str:
+        """
+        Write rows to a new Parquet file; returns its path under the archive root
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        filesystem, root = self._fs()
+        directory = f"tenant_id={quote(tenant_id, safe='')}/month={month:%Y-%m}"
+        path = f"{directory}/{uuid.uuid4().hex}.parquet"
+        filesystem.create_dir(f"{root}/{directory}", recursive=True)
+
+        records = []
+        for row in rows:
+            record = dict(row)
+            record["status"] = row["status"].value if row["status"] is not None else None
+            if row["validation_errors"] is not None:
+                record["validation_errors"] = json.dumps(row["validation_errors"])
+            records.append(record)
+        table = pa.Table.from_pylist(records, schema=_archive_schema())
+        pq.write_table(table, f"{root}/{path}", filesystem=filesystem, compression="zstd")
+        return path
+
+    def _remove(self, path: str):
+        filesystem, root = self._fs()
+        try:
+            filesystem.delete_file(f"{root}/{path}")
+        except OSError as e:
+            logger.warning("Error removing archive file %s: %s", path, e)
+
+    def read(
+        self,
+        tenant_id: str,
+        status: Optional[InvoiceStatus] = None,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+    ) -> List[Dict]:
+        """
+        Archived invoices matching the list filters. Only the files holding
+        invoices in the date range are opened.
+        """
+        if status is not None and status != InvoiceStatus.PUSHED_TO_XERO:
+            return []
+
+        query = select(ArchivedInvoice.archive_path).distinct().where(ArchivedInvoice.tenant_id == tenant_id)
+        if start_date:
+            query = query.where(ArchivedInvoice.date >= start_date)
+        if end_date:
+            query = query.where(ArchivedInvoice.date <= end_date)
+        db = self.session_factory()
+        try:
+            paths = list(db.scalars(query))
+        finally:
+            db.close()
+        if not paths:
+            return []
+
+        import pyarrow.dataset as ds
+
+        condition = ds.field("tenant_id") == tenant_id
+        if start_date:
+            condition &= ds.field("date") >= _naive_utc(start_date)
+        if end_date:
+            condition &= ds.field("date") <= _naive_utc(end_date)
+        return self._scan(paths, condition)
+
+    def get(self, tenant_id: str, invoice_id: int) -> Optional[Dict]:
+        """
+        One archived invoice, or None if it is not in the archive
+        """
+        db = self.session_factory()
+        try:
+            path = db.scalar(select(ArchivedInvoice.archive_path).where(
+                ArchivedInvoice.id == invoice_id,
+                ArchivedInvoice.tenant_id == tenant_id
+            ))
+        finally:
+            db.close()
+        if path is None:
+            return None
+
+        import pyarrow.dataset as ds
+
+        invoices = self._scan([path], ds.field("id") == invoice_id)
+        return invoices[0] if invoices else None
+
+    def _scan(self, paths: List[str], condition) -> List[Dict]:
+        import pyarrow.dataset as ds
+
+        filesystem, root = self._fs()
+        dataset = ds.dataset(
+            [f"{root}/{path}" for path in paths],
+            schema=_archive_schema(),
+            format="parquet",
+            filesystem=filesystem,
+        )
+        invoices = dataset.to_table(filter=condition).to_pylist()
+        for invoice in invoices:
+            if invoice["validation_errors"] is not None:
+                invoice["validation_errors"] = json.loads(invoice["validation_errors"])
+            invoice["archived"] = True
+        return invoices
+
+    async def start_periodic(self, interval: int):
+        """
+        Archive closed periods every `interval` seconds in the background
+        """
+        async def loop():
+            while True:
+                try:
+                    await asyncio.to_thread(self.run)
+                except Exception as e:
+                    logger.exception("Scheduled archive run failed: %s", e)
+                await asyncio.sleep(interval)
+
+        self._periodic_task = asyncio.create_task(loop())
+
+    async def stop(self):
+        if self._periodic_task:
+            self._periodic_task.cancel()
+            await asyncio.gather(self._periodic_task, return_exceptions=True)
+            self._periodic_task = None
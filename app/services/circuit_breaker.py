@@ -0,0 +1,278 @@
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+import asyncio
+import time
+import requests
+from app.core.config import settings
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an upstream whose circuit is open
+    """
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+@lru_cache(maxsize=None)
+def _transport_errors() -> Tuple[type, ...]:
+    """
+    Timeout and connection errors of the HTTP clients upstream calls go
+    through. httpx and openai are imported here so neither is needed to
+    load this module.
+    """
+    errors: List[type] = [
+        asyncio.TimeoutError,
+        TimeoutError,
+        ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ConnectionError,
+    ]
+    try:
+        import httpx
+
+        errors.append(httpx.TransportError)
+    except ImportError:
+        pass
+    try:
+        # Also covers APITimeoutError, its subclass
+        from openai import APIConnectionError
+
+        errors.append(APIConnectionError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """
+    Whether an error says the upstream itself is unhealthy: timeouts,
+    connection errors, 5xx and 429. Other client errors, such as one
+    tenant's expired token, do not count against the upstream, and neither
+    do errors from our own code.
+    """
+    if isinstance(error, CircuitOpenError):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status >= 500 or status == 429
+    return isinstance(error, _transport_errors())
+
+class CircuitBreaker:
+    """
+    Fails calls to an unhealthy upstream fast instead of letting every
+    caller wait out a slow failure.
+
+    Closed: calls go through, each under a strict `timeout`. Once at least
+    `min_calls` calls were made in the last `window_seconds`, the circuit
+    opens if `failure_rate` of them failed or `slow_call_rate` of them took
+    longer than `slow_call_seconds`.
+    Open: calls raise CircuitOpenError without touching the upstream, for
+    `open_seconds`.
+    Half-open: up to `half_open_calls` trial calls go through; the circuit
+    closes once they all succeed and opens again on the first failed or
+    slow one.
+
+    With `enabled` false the timeout still applies but the circuit never
+    opens.
+    """
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        slow_call_seconds: float,
+        failure_rate: float = 0.5,
+        slow_call_rate: float = 0.8,
+        min_calls: int = 10,
+        window_seconds: float = 30.0,
+        open_seconds: float = 30.0,
+        half_open_calls: int = 3,
+        enabled: bool = True,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.slow_call_seconds = slow_call_seconds
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.enabled = enabled
+        self.state = CLOSED
+        self.changed_at = datetime.utcnow()
+        # (finished at, failed, slow) for calls in the window
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        self._opened_at = 0.0
+        # Bumped on every state change, so results of calls started in an
+        # earlier state are not mistaken for trial results
+        self._epoch = 0
+        self._trials = 0
+        self._trial_successes = 0
+        self.stats = {"calls": 0, "failures": 0, "slow": 0, "timeouts": 0, "rejected": 0, "opened": 0}
+
+    def retry_after(self) -> float:
+        """
+        Seconds until an open circuit lets trial calls through; 0 otherwise
+        """
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def available(self) -> bool:
+        """
+        Whether a call now would reach the upstream (possibly as a trial)
+        """
+        if self.state == OPEN:
+            return self.retry_after() == 0
+        if self.state == HALF_OPEN:
+            return self._trials < self.half_open_calls
+        return True
+
+    async def call(self, factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        Await `factory()` through the breaker. Raises CircuitOpenError while
+        the circuit is open and TimeoutError when the call overruns.
+        """
+        epoch, trial = self._admit()
+        start = time.monotonic()
+        failed: Optional[bool] = True
+        try:
+            result = await asyncio.wait_for(factory(), self.timeout)
+            failed = False
+            return result
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise TimeoutError(f"{self.name} did not respond within {self.timeout:g}s") from None
+        except asyncio.CancelledError:
+            # The caller gave up; says nothing about the upstream
+            failed = None
+            raise
+        except Exception as e:
+            failed = is_upstream_failure(e)
+            raise
+        finally:
+            self._record(epoch, trial, start, failed)
+
+    def _admit(self) -> Tuple[int, bool]:
+        if self.state == OPEN:
+            if self.retry_after() > 0:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(self.name, self.retry_after())
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._trials >= self.half_open_calls:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(self.name, 0.0)
+            self._trials += 1
+            return self._epoch, True
+        return self._epoch, False
+
+    def _record(self, epoch: int, trial: bool, start: float, failed: Optional[bool]):
+        now = time.monotonic()
+        if epoch != self._epoch:
+            return
+        if failed is None:
+            if trial:
+                self._trials -= 1
+            return
+
+        slow = now - start >= self.slow_call_seconds
+        self.stats["calls"] += 1
+        self.stats["failures"] += failed
+        self.stats["slow"] += slow
+
+        if trial:
+            self._trials -= 1
+            if failed or slow:
+                self._open(now)
+            else:
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_calls:
+                    self._transition(CLOSED)
+            return
+
+        self._calls.append((now, failed, slow))
+        while self._calls and self._calls[0][0] < now - self.window_seconds:
+            self._calls.popleft()
+        if not self.enabled or len(self._calls) < self.min_calls:
+            return
+        failures = sum(1 for _, call_failed, _ in self._calls if call_failed)
+        slow_calls = sum(1 for _, _, call_slow in self._calls if call_slow)
+        if failures >= self.failure_rate * len(self._calls) or slow_calls >= self.slow_call_rate * len(self._calls):
+            self._open(now)
+
+    def _open(self, now: float):
+        self._opened_at = now
+        self.stats["opened"] += 1
+        self._transition(OPEN)
+        print(f"Circuit for {self.name} opened for {self.open_seconds:g}s")
+
+    def _transition(self, state: str):
+        self.state = state
+        self.changed_at = datetime.utcnow()
+        self._epoch += 1
+        self._calls.clear()
+        self._trials = 0
+        self._trial_successes = 0
+
+    def reset(self):
+        self._transition(CLOSED)
+
+    def snapshot(self) -> Dict:
+        return {
+            "state": self.state,
+            "changedAt": self.changed_at.isoformat(),
+            "retryAfter": self.retry_after(),
+            "windowCalls": len(self._calls),
+            "timeout": self.timeout,
+            "slowCallSeconds": self.slow_call_seconds,
+            **self.stats,
+        }
+
+class CircuitBreakers:
+    """
+    One breaker per upstream, shared by every tenant's services so that all
+    callers see the same view of an upstream's health
+    """
+    def __init__(self, breakers: Dict[str, CircuitBreaker]):
+        self.breakers = breakers
+
+    @classmethod
+    def from_settings(cls) -> "CircuitBreakers":
+        def breaker(name: str, timeout: float, slow_call_seconds: float) -> CircuitBreaker:
+            return CircuitBreaker(
+                name,
+                timeout=timeout,
+                slow_call_seconds=slow_call_seconds,
+                failure_rate=settings.CIRCUIT_FAILURE_RATE,
+                slow_call_rate=settings.CIRCUIT_SLOW_CALL_RATE,
+                min_calls=settings.CIRCUIT_MIN_CALLS,
+                window_seconds=settings.CIRCUIT_WINDOW_SECONDS,
+                open_seconds=settings.CIRCUIT_OPEN_SECONDS,
+                half_open_calls=settings.CIRCUIT_HALF_OPEN_CALLS,
+                enabled=settings.CIRCUIT_BREAKERS_ENABLED,
+            )
+
+        return cls({
+            "dext": breaker("dext", settings.DEXT_TIMEOUT_SECONDS, settings.DEXT_SLOW_CALL_SECONDS),
+            "xero": breaker("xero", settings.XERO_TIMEOUT_SECONDS, settings.XERO_SLOW_CALL_SECONDS),
+            "openai": breaker("openai", settings.OPENAI_TIMEOUT_SECONDS, settings.OPENAI_SLOW_CALL_SECONDS),
+        })
+
+    def __getitem__(self, name: str) -> CircuitBreaker:
+        return self.breakers[name]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {name: breaker.snapshot() for name, breaker in self.breakers.items()}
+
+circuit_breakers = CircuitBreakers.from_settings()
@@ -0,0 +1,62 @@
+from typing import TYPE_CHECKING, List
+import io
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# CPU-bound document preparation for OCR. This runs in worker processes
+# (see app.services.ocr_service.get_process_pool), so it imports nothing
+# from the app and only pulls in Pillow and pypdfium2 when called.
+
+# Text recognition degrades quickly on small scans and gains nothing from
+# very large ones; pages are scaled into this range
+MIN_SHORT_SIDE = 1200
+MAX_LONG_SIDE = 4000
+
+def rasterize(content: bytes, content_type: str, dpi: int, max_pages: int) -> List["Image.Image"]:
+    """
+    Render the first `max_pages` pages of a PDF, or frames of an image
+    """
+    from PIL import Image, ImageOps, ImageSequence
+
+    if content_type == "application/pdf" or content.startswith(b"%PDF"):
+        import pypdfium2 as pdfium
+
+        pdf = pdfium.PdfDocument(content)
+        try:
+            return [pdf[i].render(scale=dpi / 72).to_pil() for i in range(min(len(pdf), max_pages))]
+        finally:
+            pdf.close()
+
+    image = Image.open(io.BytesIO(content))
+    frames = []
+    for frame in ImageSequence.Iterator(image):
+        frames.append(ImageOps.exif_transpose(frame.copy()))
+        if len(frames) >= max_pages:
+            break
+    return frames
+
+def preprocess_page(image: "Image.Image") -> bytes:
+    """
+    Grayscale, stretch contrast and normalise the size of one page; returns PNG bytes
+    """
+    from PIL import Image, ImageOps
+
+    image = ImageOps.autocontrast(ImageOps.grayscale(image), cutoff=1)
+    scale = 1.0
+    if min(image.size) < MIN_SHORT_SIDE:
+        scale = MIN_SHORT_SIDE / min(image.size)
+    if max(image.size) * scale > MAX_LONG_SIDE:
+        scale = MAX_LONG_SIDE / max(image.size)
+    if scale != 1.0:
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def prepare_document(content: bytes, content_type: str, dpi: int = 200, max_pages: int = 5) -> List[bytes]:
+    """
+    Rasterize a PDF or image document into OCR-ready PNG pages
+    """
+    return [preprocess_page(page) for page in rasterize(content, content_type, dpi, max_pages)]
@@ -0,0 +1,190 @@
+from typing import Awaitable, Callable, Dict, List, Optional
+import asyncio
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.core.config import settings
+from app.models.archived_invoice import ArchivedInvoice
+from app.models.invoice import Invoice, InvoiceStatus
+from app.models.invoice_record import AnyInvoice, InvoiceRecord
+from app.services.anomaly_service import AnomalyDetector
+from app.services.dext_service import DextService
+from app.services.invoice_store import in_progress_row
+from app.services.ocr_service import OCRService
+from app.services.upstream_budget import UpstreamBudget
+from app.services.validation_service import ValidationService
+from app.services.xero_service import XeroService
+
+class IngestionService:
+    """
+    Takes one Dext invoice payload through validation and the push to Xero.
+    Shared by the full sync and webhook-driven ingestion. Invoices are
+    processed as InvoiceRecords; the caller persists them, saving those
+    about to be pushed before the push (see process). With an OCR
+    service, invoices that fail validation with low confidence are
+    revalidated against their source document. With an anomaly detector,
+    likely duplicates and unusual amounts are put on hold instead of being
+    pushed. Pushes that Xero cannot take right now are deferred: the
+    invoice stays validated and a later sync pushes it.
+    """
+    def __init__(
+        self,
+        dext_service: DextService,
+        validation_service: ValidationService,
+        xero_service: XeroService,
+        budget: Optional[UpstreamBudget] = None,
+        ocr_service: Optional[OCRService] = None,
+        anomaly_detector: Optional[AnomalyDetector] = None
+    ):
+        self.dext_service = dext_service
+        self.validation_service = validation_service
+        self.xero_service = xero_service
+        self.budget = budget or UpstreamBudget()
+        self.ocr_service = ocr_service
+        self.anomaly_detector = anomaly_detector
+
+    async def ingest(
+        self,
+        db: Session,
+        invoice_data: Dict,
+        tenant_id: Optional[str] = None,
+        holds: Optional[List[Dict]] = None
+    ) -> Optional[Invoice]:
+        """
+        Process a Dext payload and add the resulting invoice to the session.
+        Returns None if the invoice is already stored. An invoice about to
+        be pushed to Xero is committed first, marked as in progress; the
+        caller commits the outcome. `holds` are the anomaly detector's
+        findings when the caller already checked the invoice as part of a
+        batch.
+        """
+        # Process invoice data
+        record = self.dext_service.process_invoice(invoice_data, tenant_id or settings.DEFAULT_TENANT_ID)
+
+        # Check if invoice already exists
+        if self.is_stored(db, record.tenant_id, record.dext_id):
+            return None
+
+        invoice = None
+
+        async def save(record: InvoiceRecord) -> bool:
+            nonlocal invoice
+            invoice = Invoice(**in_progress_row(record))
+            db.add(invoice)
+            try:
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+                invoice = None
+                return False
+            return True
+
+        if await self.process(record, holds, before_push=save) is None:
+            return None
+        if invoice is None:
+            invoice = record.to_orm()
+            db.add(invoice)
+        else:
+            for column, value in record.outcome().items():
+                setattr(invoice, column, value)
+        return invoice
+
+    def is_stored(self, db: Session, tenant_id: str, dext_id: str) -> bool:
+        """
+        Whether the tenant already has the Dext invoice, stored or archived
+        """
+        for model in (Invoice, ArchivedInvoice):
+            if db.query(model.id).filter(model.tenant_id == tenant_id, model.dext_id == dext_id).first():
+                return True
+        return False
+
+    async def process(
+        self,
+        record: InvoiceRecord,
+        holds: Optional[List[Dict]] = None,
+        before_push: Optional[Callable[[InvoiceRecord], Awaitable[bool]]] = None
+    ) -> Optional[InvoiceRecord]:
+        """
+        Validate a new invoice and push it to Xero unless it is invalid or
+        held, recording the outcome on the record. Nothing is persisted here;
+        `before_push` should save the record ahead of the push, so a pushed
+        invoice is never lost. If it returns False (the invoice was stored
+        meanwhile) there is no push and None is returned.
+        """
+        # Validate invoice
+        async with self.budget.slot("openai"):
+            validation_result = await self.validation_service.validate_invoice(record)
+        if self.ocr_service and validation_result["confidence_score"] < settings.MIN_CONFIDENCE_SCORE:
+            validation_result = await self._revalidate_from_document(record, validation_result)
+        record.confidence_score = validation_result["confidence_score"]
+
+        if validation_result["is_valid"]:
+            record.status = InvoiceStatus.VALIDATED
+
+            if holds is None and self.anomaly_detector:
+                invoice_data = {
+                    "id": record.dext_id,
+                    "supplier_name": record.supplier_name,
+                    "vat_number": record.vat_number,
+                    "amount": record.amount,
+                    "date": record.date,
+                }
+                findings = await asyncio.to_thread(self.anomaly_detector.check_batch, record.tenant_id, [invoice_data])
+                holds = findings.get(str(record.dext_id))
+            if holds:
+                record.status = InvoiceStatus.ON_HOLD
+                record.validation_errors = {"holds": holds}
+                return record
+
+            # Push to Xero
+            if before_push and not await before_push(record):
+                return None
+            await self.push(record)
+        else:
+            record.status = InvoiceStatus.ERROR
+            record.validation_errors = validation_result["errors"]
+
+        return record
+
+    async def push(self, invoice: AnyInvoice) -> Dict:
+        """
+        Push a validated invoice to Xero and record the outcome on it. If
+        the push is deferred the invoice stays validated, marked with the
+        reason under validation_errors["deferred"], and with
+        validation_errors["unconfirmed"] if Xero may have created it anyway;
+        the next push of such an invoice looks for it in Xero first.
+        """
+        previous = invoice.validation_errors if isinstance(invoice.validation_errors, dict) else {}
+        async with self.budget.slot("xero"):
+            xero_result = await self.xero_service.push_invoice(
+                invoice, check_existing=bool(previous.get("unconfirmed"))
+            )
+        if xero_result["success"]:
+            invoice.xero_invoice_id = xero_result["xero_invoice_id"]
+            invoice.status = InvoiceStatus.PUSHED_TO_XERO
+            invoice.validation_errors = None
+        elif xero_result.get("deferred"):
+            invoice.status = InvoiceStatus.VALIDATED
+            invoice.validation_errors = {"deferred": xero_result["error"]}
+            if xero_result.get("unconfirmed"):
+                invoice.validation_errors["unconfirmed"] = True
+        else:
+            invoice.status = InvoiceStatus.ERROR
+            invoice.validation_errors = {"xero_error": xero_result["error"]}
+        return xero_result
+
+    async def _revalidate_from_document(self, record: InvoiceRecord, validation_result: Dict) -> Dict:
+        """
+        OCR the invoice's source document and validate again with what it
+        shows; the original result stands if there is no usable document
+        """
+        async with self.budget.slot("dext"):
+            document = await self.dext_service.get_document(record.dext_id, record.document_url)
+        if document is None:
+            return validation_result
+
+        extraction = await self.ocr_service.extract(*document)
+        if extraction is None:
+            return validation_result
+
+        async with self.budget.slot("openai"):
+            return await self.validation_service.validate_invoice(record, extraction)
@@ -0,0 +1,180 @@
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+import asyncio
+import time
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from app.core.database import SessionLocal
+from app.core.http_cache import bump_invoice_generations
+from app.models.archived_invoice import ArchivedInvoice
+from app.models.invoice import Invoice
+from app.models.invoice_record import InvoiceRecord
+
+INVOICES = Invoice.__table__
+
+# Pushed invoices are saved with this deferral reason just before the push,
+# and marked unconfirmed so a later push looks for them in Xero first
+PUSH_IN_PROGRESS = "Push to Xero in progress"
+# A push normally settles within seconds; reconciling an in-progress
+# invoice sooner than this could race the push itself
+PUSH_IN_PROGRESS_GRACE = timedelta(minutes=10)
+
+def in_progress_row(record: InvoiceRecord) -> Dict:
+    """
+    Column values for saving a validated record just before its push
+    """
+    row = record.to_row()
+    row["validation_errors"] = {"deferred": PUSH_IN_PROGRESS, "unconfirmed": True}
+    return row
+
+def push_in_progress(invoice: Invoice) -> bool:
+    """
+    Whether the invoice was saved for a push that has not settled yet and
+    may still be running
+    """
+    errors = invoice.validation_errors
+    return (
+        isinstance(errors, dict)
+        and errors.get("deferred") == PUSH_IN_PROGRESS
+        and invoice.updated_at is not None
+        and invoice.updated_at > datetime.utcnow() - PUSH_IN_PROGRESS_GRACE
+    )
+
+def stored_dext_ids(db: Session, tenant_id: str, dext_ids: Iterable[str], chunk_size: int = 500) -> Set[str]:
+    """
+    The given Dext ids the tenant already has, stored or archived
+    """
+    dext_ids = list(dext_ids)
+    stored = set()
+    for start in range(0, len(dext_ids), chunk_size):
+        for model in (Invoice, ArchivedInvoice):
+            stored.update(db.scalars(
+                select(model.dext_id).where(
+                    model.tenant_id == tenant_id,
+                    model.dext_id.in_(dext_ids[start:start + chunk_size])
+                )
+            ))
+    return stored
+
+class InvoiceBatchWriter:
+    """
+    Collects one tenant's processed invoice records and bulk-writes them.
+
+    An invoice about to be pushed to Xero is saved first (save), marked as
+    in progress, so a crash or failed write after the push leaves a row the
+    next sync reconciles instead of pushing the invoice again. Its outcome
+    and every other processed record are then written once `batch_size`
+    are waiting or the oldest has waited `max_age` seconds. All database
+    work runs in a thread. If an invoice in a batch was stored meanwhile
+    (say by a webhook), the rest of the batch is inserted one at a time.
+    """
+    def __init__(self, tenant_id: str, session_factory=SessionLocal, batch_size: int = 100, max_age: float = 1.0):
+        self.tenant_id = tenant_id
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.written = 0
+        self._records: List[InvoiceRecord] = []
+        self._oldest = 0.0
+
+    async def save(self, record: InvoiceRecord) -> bool:
+        """
+        Insert a validated record as in progress ahead of its push, setting
+        its id. Returns False if the tenant already has the invoice.
+        """
+        record.id = await asyncio.to_thread(self._insert, in_progress_row(record))
+        if record.id is None:
+            return False
+        self.written += 1
+        return True
+
+    async def add(self, record: InvoiceRecord):
+        """
+        Queue a processed record: saved ones have their outcome updated,
+        others are inserted
+        """
+        if not self._records:
+            self._oldest = time.monotonic()
+        self._records.append(record)
+        if len(self._records) >= self.batch_size or time.monotonic() - self._oldest >= self.max_age:
+            await self.flush()
+
+    async def flush(self) -> int:
+        """
+        Write the waiting records; returns how many rows were new. On a
+        database error the records are kept for the next flush.
+        """
+        records, self._records = self._records, []
+        if not records:
+            return 0
+        try:
+            written = await asyncio.to_thread(self._write, records)
+        except SQLAlchemyError:
+            self._records = records + self._records
+            raise
+        self.written += written
+        return written
+
+    def _insert(self, row: Dict) -> Optional[int]:
+        db = self.session_factory()
+        try:
+            invoice_id = db.execute(insert(INVOICES).returning(INVOICES.c.id), row).scalar_one()
+            bump_invoice_generations(db, [self.tenant_id])
+            db.commit()
+            return invoice_id
+        except IntegrityError:
+            db.rollback()
+            return None
+        except SQLAlchemyError:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _write(self, records: List[InvoiceRecord]) -> int:
+        now = datetime.utcnow()
+        rows = [record.to_row() for record in records if record.id is None]
+        # `date` too, so Postgres only looks in the row's own partition
+        outcomes = [
+            {**record.outcome(), "updated_at": now, "_id": record.id, "_date": record.date}
+            for record in records if record.id is not None
+        ]
+        db = self.session_factory()
+        try:
+            # Core statements bypass the session hook that advances the
+            # tenant's cache generation, so each transaction does it itself
+            try:
+                self._update(db, outcomes)
+                if rows:
+                    db.execute(insert(INVOICES), rows)
+                bump_invoice_generations(db, [self.tenant_id])
+                db.commit()
+                return len(rows)
+            except IntegrityError:
+                db.rollback()
+            self._update(db, outcomes)
+            bump_invoice_generations(db, [self.tenant_id])
+            db.commit()
+            written = 0
+            for row in rows:
+                try:
+                    db.execute(insert(INVOICES), row)
+                    bump_invoice_generations(db, [self.tenant_id])
+                    db.commit()
+                    written += 1
+                except IntegrityError:
+                    db.rollback()
+            return written
+        except SQLAlchemyError:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _update(self, db: Session, outcomes: List[Dict]):
+        if outcomes:
+            db.execute(
+                update(INVOICES).where(INVOICES.c.id == bindparam("_id"), INVOICES.c.date == bindparam("_date")),
+                outcomes
+            )
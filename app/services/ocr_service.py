@@ -0,0 +1,384 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import hashlib
+import importlib
+import importlib.util
+import multiprocessing
+import re
+import shutil
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.document_extraction import DocumentExtraction
+from app.services.document_preprocessing import prepare_document
+from app.services.upstream_budget import UpstreamBudget
+
+# Document extraction for invoices that fail validation with low confidence.
+# The source image or PDF is rasterized and cleaned up in a process pool,
+# pages are sent to the OCR backend in batches, and the fields parsed from
+# the text are cached by document hash.
+
+# Process pool
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Shared pool for rasterizing and preprocessing documents. Workers are
+    spawned rather than forked, since the parent runs an event loop and
+    threads.
+    """
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=settings.OCR_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+
+# Backends
+
+class OCRBackend(ABC):
+    """
+    Turns page images into text. `annotate` gets at most `batch_size` PNG
+    pages and returns one text per page.
+    """
+    name = "base"
+    batch_size = 1
+
+    @abstractmethod
+    async def annotate(self, pages: List[bytes]) -> List[str]:
+        ...
+
+class VisionOCRBackend(OCRBackend):
+    """
+    Google Cloud Vision document text detection. Pages go out in one
+    batch_annotate_images request of up to 16 images.
+    """
+    name = "vision"
+    batch_size = 16
+
+    def __init__(self, credentials: Optional[Dict] = None):
+        self.credentials = credentials
+        self._client = None
+
+    def _get_client(self):
+        # Imported here: the Vision SDK is slow to import and only needed once OCR runs
+        from google.cloud import vision
+        from google.oauth2 import service_account
+
+        if self._client is None:
+            credentials = None
+            if self.credentials:
+                credentials = service_account.Credentials.from_service_account_info(self.credentials)
+            elif settings.GOOGLE_CLOUD_VISION_CREDENTIALS:
+                credentials = service_account.Credentials.from_service_account_file(
+                    settings.GOOGLE_CLOUD_VISION_CREDENTIALS
+                )
+            self._client = vision.ImageAnnotatorClient(credentials=credentials)
+        return self._client
+
+    def _annotate(self, pages: List[bytes]) -> List[str]:
+        from google.cloud import vision
+
+        client = self._get_client()
+        response = client.batch_annotate_images(requests=[
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=page),
+                features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+            )
+            for page in pages
+        ])
+        texts = []
+        for page_response in response.responses:
+            if page_response.error.message:
+                raise RuntimeError(f"Vision API error: {page_response.error.message}")
+            texts.append(page_response.full_text_annotation.text)
+        return texts
+
+    async def annotate(self, pages: List[bytes]) -> List[str]:
+        return await asyncio.to_thread(self._annotate, pages)
+
+class TesseractOCRBackend(OCRBackend):
+    """
+    Local Tesseract OCR for offline use. Needs the tesseract binary and
+    `pip install pytesseract`, which are not in requirements.txt; choosing
+    this backend without them fails straight away.
+    """
+    name = "tesseract"
+    batch_size = 4
+
+    def __init__(self, credentials: Optional[Dict] = None):
+        if importlib.util.find_spec("pytesseract") is None:
+            raise RuntimeError("OCR_BACKEND=tesseract needs the pytesseract package (pip install pytesseract)")
+        if shutil.which("tesseract") is None:
+            raise RuntimeError("OCR_BACKEND=tesseract needs the tesseract binary on PATH")
+
+    def _annotate(self, pages: List[bytes]) -> List[str]:
+        import io
+        import pytesseract
+        from PIL import Image
+
+        return [pytesseract.image_to_string(Image.open(io.BytesIO(page))) for page in pages]
+
+    async def annotate(self, pages: List[bytes]) -> List[str]:
+        return await asyncio.to_thread(self._annotate, pages)
+
+OCR_BACKENDS: Dict[str, Callable[..., OCRBackend]] = {
+    "vision": VisionOCRBackend,
+    "tesseract": TesseractOCRBackend,
+}
+
+def get_ocr_backend(name: str, credentials: Optional[Dict] = None) -> OCRBackend:
+    """
+    Build a backend by registered name, or from a "module:factory" path for
+    custom backends; the factory is called with credentials=...
+    """
+    if name in OCR_BACKENDS:
+        factory = OCR_BACKENDS[name]
+    elif ":" in name:
+        module_name, attribute = name.split(":", 1)
+        factory = getattr(importlib.import_module(module_name), attribute)
+    else:
+        raise ValueError(f"Unknown OCR backend: {name}")
+    return factory(credentials=credentials)
+
+# Field extraction
+
+VAT_NUMBER_PATTERN = re.compile(r"\bGB[\s-]?(\d{3})\s?(\d{4})\s?(\d{2})\b", re.IGNORECASE)
+AMOUNT_PATTERN = re.compile(r"(?<![\d.])(\d{1,3}(?:,\d{3})+|\d+)\.(\d{2})(?![\d.])")
+TOTAL_LINE_PATTERN = re.compile(r"\b(total|amount due|balance due)\b", re.IGNORECASE)
+SUBTOTAL_LINE_PATTERN = re.compile(r"\bsub[\s-]?total\b", re.IGNORECASE)
+VAT_RATE_PATTERN = re.compile(r"\bVAT\b[^\n%]{0,12}?(\d{1,2}(?:\.\d+)?)\s*%", re.IGNORECASE)
+ISO_DATE_PATTERN = re.compile(r"\b(\d{4})-(\d{2})-(\d{2})\b")
+NUMERIC_DATE_PATTERN = re.compile(r"\b(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})\b")
+TEXT_DATE_PATTERN = re.compile(
+    r"\b(\d{1,2})(?:st|nd|rd|th)?\s+(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?,?\s+(\d{4})\b",
+    re.IGNORECASE,
+)
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+
+# VAT rates as printed on invoices, mapped to the VAT codes Dext exports
+VAT_CODES_BY_RATE = {
+    20.0: "20% (VAT on Expenses)",
+    5.0: "5% (VAT on Expenses)",
+    0.0: "Zero Rated Expenses",
+}
+
+def _amounts(text: str) -> List[float]:
+    return [float(f"{whole.replace(',', '')}.{pence}") for whole, pence in AMOUNT_PATTERN.findall(text)]
+
+def _find_date(text: str) -> Optional[datetime]:
+    # UK invoices: numeric dates are day first
+    candidates = []
+    for match in ISO_DATE_PATTERN.finditer(text):
+        year, month, day = map(int, match.groups())
+        candidates.append((match.start(), year, month, day))
+    for match in NUMERIC_DATE_PATTERN.finditer(text):
+        day, month, year = map(int, match.groups())
+        candidates.append((match.start(), year, month, day))
+    for match in TEXT_DATE_PATTERN.finditer(text):
+        day, month, year = match.groups()
+        candidates.append((match.start(), int(year), MONTHS.index(month[:3].lower()) + 1, int(day)))
+
+    for _, year, month, day in sorted(candidates):
+        try:
+            return datetime(year, month, day)
+        except ValueError:
+            continue
+    return None
+
+def parse_invoice_text(text: str) -> Dict:
+    """
+    Pull the fields validation cares about out of OCR text. Only fields
+    that were found are returned.
+    """
+    fields = {}
+
+    vat_number = VAT_NUMBER_PATTERN.search(text)
+    if vat_number:
+        fields["vat_number"] = "GB" + "".join(vat_number.groups())
+
+    total_lines = [
+        line for line in text.splitlines()
+        if TOTAL_LINE_PATTERN.search(line) and not SUBTOTAL_LINE_PATTERN.search(line)
+    ]
+    # "Total" is normally the largest figure among the total lines ("Total VAT" is not)
+    amounts = _amounts("\n".join(total_lines)) or _amounts(text)
+    if amounts:
+        fields["amount"] = max(amounts)
+
+    vat_rate = VAT_RATE_PATTERN.search(text)
+    if vat_rate and float(vat_rate.group(1)) in VAT_CODES_BY_RATE:
+        fields["vat_code"] = VAT_CODES_BY_RATE[float(vat_rate.group(1))]
+
+    date_lines = "\n".join(line for line in text.splitlines() if "date" in line.lower())
+    date = _find_date(date_lines) or _find_date(text)
+    if date:
+        fields["date"] = date.isoformat()
+
+    return fields
+
+# Pipeline
+
+class _PageBatcher:
+    """
+    Collects pages from concurrent extractions and sends them to the backend
+    in batches of up to `backend.batch_size`, waiting at most `window`
+    seconds for a batch to fill
+    """
+    def __init__(self, backend: OCRBackend, budget: UpstreamBudget, window: float):
+        self.backend = backend
+        self.budget = budget
+        self.window = window
+        self._pending: List[Tuple[bytes, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def annotate(self, pages: List[bytes]) -> List[str]:
+        loop = asyncio.get_running_loop()
+        futures = []
+        for page in pages:
+            future = loop.create_future()
+            self._pending.append((page, future))
+            futures.append(future)
+            if len(self._pending) >= self.backend.batch_size:
+                self._flush()
+        if self._pending and self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._pending:
+            batch = self._pending[:self.backend.batch_size]
+            self._pending = self._pending[self.backend.batch_size:]
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[bytes, asyncio.Future]]):
+        try:
+            async with self.budget.slot("vision"):
+                texts = await self.backend.annotate([page for page, _ in batch])
+            if len(texts) != len(batch):
+                raise RuntimeError(f"OCR backend returned {len(texts)} results for {len(batch)} pages")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), text in zip(batch, texts):
+            if not future.done():
+                future.set_result(text)
+
+class OCRService:
+    """
+    Extracts invoice fields from a source document: cache lookup by
+    document hash, preprocessing in the process pool, batched OCR, parsing
+    """
+    def __init__(self, backend: OCRBackend, session_factory=SessionLocal, budget: Optional[UpstreamBudget] = None):
+        self.backend = backend
+        self.session_factory = session_factory
+        self._batcher = _PageBatcher(backend, budget or UpstreamBudget(), settings.OCR_BATCH_WINDOW_MS / 1000)
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def extract(self, content: bytes, content_type: str) -> Optional[Dict]:
+        """
+        Returns {"document_hash", "backend", "pages", "fields", "cached"},
+        or None if the document could not be processed
+        """
+        document_hash = hashlib.sha256(content).hexdigest()
+
+        cached = await asyncio.to_thread(self._load, document_hash)
+        if cached is not None:
+            return self._result(cached, cached=True)
+
+        # The same document arriving twice at once is only processed once
+        if document_hash in self._in_flight:
+            extraction = await asyncio.shield(self._in_flight[document_hash])
+            return self._result(extraction, cached=True) if extraction else None
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[document_hash] = future
+        extraction = None
+        try:
+            extraction = await self._process(document_hash, content, content_type)
+        except Exception as e:
+            print(f"Error extracting document {document_hash[:12]}: {str(e)}")
+        finally:
+            future.set_result(extraction)
+            del self._in_flight[document_hash]
+
+        return self._result(extraction, cached=False) if extraction else None
+
+    async def _process(self, document_hash: str, content: bytes, content_type: str) -> DocumentExtraction:
+        loop = asyncio.get_running_loop()
+        pages = await loop.run_in_executor(
+            get_process_pool(),
+            partial(
+                prepare_document, content, content_type,
+                dpi=settings.OCR_DPI, max_pages=settings.OCR_MAX_PAGES
+            )
+        )
+        if not pages:
+            raise ValueError("Document has no pages")
+
+        text = "\n".join(await self._batcher.annotate(pages))
+        extraction = DocumentExtraction(
+            document_hash=document_hash,
+            backend=self.backend.name,
+            pages=len(pages),
+            text=text,
+            fields=parse_invoice_text(text),
+        )
+        await asyncio.to_thread(self._store, extraction)
+        return extraction
+
+    def _load(self, document_hash: str) -> Optional[DocumentExtraction]:
+        db = self.session_factory()
+        try:
+            return db.get(DocumentExtraction, (document_hash, self.backend.name))
+        finally:
+            db.close()
+
+    def _store(self, extraction: DocumentExtraction):
+        db = self.session_factory(expire_on_commit=False)
+        try:
+            db.add(extraction)
+            db.commit()
+        except IntegrityError:
+            # Another instance extracted the same document first
+            db.rollback()
+        except SQLAlchemyError as e:
+            # The extraction is still usable; it just is not cached
+            db.rollback()
+            print(f"Error caching extraction {extraction.document_hash[:12]}: {str(e)}")
+        finally:
+            db.close()
+
+    def _result(self, extraction: DocumentExtraction, cached: bool) -> Dict:
+        return {
+            "document_hash": extraction.document_hash,
+            "backend": extraction.backend,
+            "pages": extraction.pages,
+            "fields": dict(extraction.fields or {}),
+            "cached": cached,
+        }
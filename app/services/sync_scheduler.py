@@ -0,0 +1,400 @@
+from collections import Counter, deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Set
+import asyncio
+import json
+import time
+from sqlalchemy.orm import Session
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.invoice import Invoice, InvoiceStatus
+from app.models.invoice_record import InvoiceRecord
+from app.models.settings import Settings
+from app.services.anomaly_service import AnomalyDetector
+from app.services.circuit_breaker import CircuitOpenError, circuit_breakers
+from app.services.dext_service import DextService
+from app.services.ingestion_service import IngestionService
+from app.services.invoice_store import InvoiceBatchWriter, push_in_progress, stored_dext_ids
+from app.services.ocr_service import OCRService, get_ocr_backend
+from app.services.upstream_budget import UpstreamBudget
+from app.services.validation_service import ValidationService
+from app.services.xero_service import XeroService
+
+# Attempts at saving a tenant's last processed invoices before giving up
+FLUSH_ATTEMPTS = 3
+
+class UnknownTenantError(Exception):
+    """
+    Raised for a tenant that has no settings and is not the default tenant
+    """
+    def __init__(self, tenant_id: str):
+        super().__init__(f"Tenant {tenant_id} is not configured")
+        self.tenant_id = tenant_id
+
+@dataclass
+class TenantContext:
+    tenant_id: str
+    ingestion: IngestionService
+    max_concurrency: int
+    # Anomaly findings for the fetched batch, by Dext id
+    holds: Optional[Dict[str, List[Dict]]] = None
+    # Persists the tenant's processed invoices in batches
+    writer: Optional[InvoiceBatchWriter] = None
+
+class SyncScheduler:
+    """
+    Runs invoice syncs for many organisations at once.
+
+    Each tenant's Dext invoices are fetched, parsed into InvoiceRecords and
+    then processed as individual work items; invoices are saved just before
+    their push to Xero and processed records are bulk-written in batches.
+    Free worker slots are handed out round-robin across tenants that still
+    have work, so a tenant with a huge backlog gets the same share as one
+    with a handful of invoices. Each tenant is also capped at
+    max_concurrency in-flight items. All tenants draw on one UpstreamBudget,
+    so total load on Dext, OpenAI and Xero stays bounded whatever the tenant
+    count.
+
+    Calls to an upstream whose circuit breaker is open fail fast: pushes to
+    Xero are deferred and retried at the start of the tenant's next sync,
+    and a tenant whose Dext fetch is refused is simply skipped this run.
+    """
+    def __init__(
+        self,
+        validation_service: ValidationService,
+        session_factory=SessionLocal,
+        budget: Optional[UpstreamBudget] = None,
+        workers: Optional[int] = None,
+        tenant_concurrency: Optional[int] = None,
+    ):
+        self.validation_service = validation_service
+        self.session_factory = session_factory
+        self.budget = budget or UpstreamBudget.from_settings()
+        self.workers = workers or settings.SYNC_WORKERS
+        self.tenant_concurrency = tenant_concurrency or settings.TENANT_MAX_CONCURRENCY
+        self.anomaly_detector = AnomalyDetector(session_factory) if settings.ANOMALY_DETECTION_ENABLED else None
+        self.metrics: Dict[str, Dict] = {}
+        self._started: Dict[str, float] = {}
+        self._running: Set[str] = set()
+        self._ocr_services: Dict[str, OCRService] = {}
+        self._periodic_task: Optional[asyncio.Task] = None
+
+    def tenant_ids(self, db: Session) -> List[str]:
+        tenant_ids = [row.tenant_id for row in db.query(Settings.tenant_id).filter(Settings.tenant_id.isnot(None))]
+        return tenant_ids or [settings.DEFAULT_TENANT_ID]
+
+    def tenant_settings(self, db: Session, tenant_id: str) -> Optional[Settings]:
+        """
+        The tenant's settings row. Only the default tenant may have none;
+        any other tenant without one raises UnknownTenantError.
+        """
+        tenant_settings = db.query(Settings).filter(Settings.tenant_id == tenant_id).first()
+        if tenant_settings is None and tenant_id != settings.DEFAULT_TENANT_ID:
+            raise UnknownTenantError(tenant_id)
+        return tenant_settings
+
+    def tenant_context(self, db: Session, tenant_id: str) -> TenantContext:
+        """
+        Services bound to the tenant's own credentials. Only the default
+        tenant falls back to the deployment-wide keys.
+        """
+        tenant_settings = self.tenant_settings(db, tenant_id)
+        is_default = tenant_id == settings.DEFAULT_TENANT_ID
+        dext_service = DextService()
+        xero_service = XeroService(xero_tenant_id=settings.XERO_TENANT_ID or None)
+        max_concurrency = self.tenant_concurrency
+        vision_credentials = None
+        if tenant_settings:
+            dext_api_key = tenant_settings.dext_api_key
+            dext_service = DextService(api_key=dext_api_key if dext_api_key or is_default else "")
+            expires_at = tenant_settings.xero_token_expires_at
+            xero_tenant_id = tenant_settings.xero_tenant_id
+            if xero_tenant_id is None and is_default:
+                xero_tenant_id = settings.XERO_TENANT_ID or None
+            xero_service = XeroService(
+                access_token=tenant_settings.xero_access_token,
+                token_expires_at=datetime.fromisoformat(expires_at) if expires_at else None,
+                xero_tenant_id=xero_tenant_id,
+            )
+            max_concurrency = tenant_settings.max_concurrency or max_concurrency
+            vision_credentials = tenant_settings.google_cloud_vision_credentials
+
+        ingestion = IngestionService(
+            dext_service, self.validation_service, xero_service, self.budget,
+            ocr_service=self.ocr_service(vision_credentials),
+            anomaly_detector=self.anomaly_detector
+        )
+        writer = InvoiceBatchWriter(tenant_id, self.session_factory, settings.SYNC_PERSIST_BATCH_SIZE)
+        return TenantContext(tenant_id, ingestion, max_concurrency, writer=writer)
+
+    def ocr_service(self, credentials: Optional[Dict] = None) -> Optional[OCRService]:
+        """
+        OCR service for the given Vision credentials, or None if OCR is not
+        configured. Tenants with the same credentials share one service, so
+        their pages are batched together.
+        """
+        backend_name = settings.OCR_BACKEND
+        if not backend_name:
+            if not (credentials or settings.GOOGLE_CLOUD_VISION_CREDENTIALS):
+                return None
+            backend_name = "vision"
+
+        key = json.dumps([backend_name, credentials], sort_keys=True)
+        if key not in self._ocr_services:
+            backend = get_ocr_backend(backend_name, credentials=credentials)
+            self._ocr_services[key] = OCRService(backend, self.session_factory, self.budget)
+        return self._ocr_services[key]
+
+    def is_running(self, tenant_id: str) -> bool:
+        return tenant_id in self._running
+
+    async def run(self, tenant_ids: Optional[List[str]] = None) -> Dict[str, Dict]:
+        """
+        Sync the given tenants (default: all) and return their metrics.
+        Tenants that are already being synced or are not configured are
+        skipped.
+        """
+        db = self.session_factory()
+        try:
+            requested = tenant_ids or self.tenant_ids(db)
+            contexts = {}
+            for tenant_id in requested:
+                if tenant_id in self._running:
+                    continue
+                try:
+                    contexts[tenant_id] = self.tenant_context(db, tenant_id)
+                except UnknownTenantError as e:
+                    print(f"Skipping sync: {str(e)}")
+            tenant_ids = list(contexts)
+        finally:
+            db.close()
+
+        self._running.update(tenant_ids)
+        try:
+            for tenant_id in tenant_ids:
+                self.metrics[tenant_id] = self._new_metrics()
+                self._started[tenant_id] = time.perf_counter()
+
+            await asyncio.gather(*(self._push_deferred(contexts[tenant_id]) for tenant_id in tenant_ids))
+            fetched = await asyncio.gather(*(self._fetch(contexts[tenant_id]) for tenant_id in tenant_ids))
+            queues = {
+                tenant_id: deque(records)
+                for tenant_id, records in zip(tenant_ids, fetched)
+                if records
+            }
+            for tenant_id in tenant_ids:
+                if tenant_id not in queues:
+                    self._finish(tenant_id)
+            await self._dispatch(queues, contexts)
+        finally:
+            for tenant_id in tenant_ids:
+                if tenant_id in self._started:
+                    await self._flush(contexts[tenant_id])
+                    self._finish(tenant_id)
+
+        return {tenant_id: self.metrics[tenant_id] for tenant_id in tenant_ids}
+
+    async def _fetch(self, context: TenantContext) -> List[InvoiceRecord]:
+        metrics = self.metrics[context.tenant_id]
+        try:
+            async with self.budget.slot("dext"):
+                invoices = await context.ingestion.dext_service.fetch_invoices()
+        except CircuitOpenError as e:
+            print(f"Skipping fetch for tenant {context.tenant_id}: {str(e)}")
+            metrics["errors"] += 1
+            return []
+        except Exception as e:
+            print(f"Error fetching invoices for tenant {context.tenant_id}: {str(e)}")
+            metrics["errors"] += 1
+            return []
+        metrics["fetched"] = len(invoices)
+        if self.anomaly_detector:
+            # The whole batch at once, so duplicates within it are caught too.
+            # In a thread: the first check loads the tenant's invoice columns.
+            context.holds = await asyncio.to_thread(self.anomaly_detector.check_batch, context.tenant_id, invoices)
+            metrics["flagged"] = len(context.holds)
+
+        records = []
+        for invoice_data in invoices:
+            try:
+                records.append(context.ingestion.dext_service.process_invoice(invoice_data, context.tenant_id))
+            except (KeyError, ValueError):
+                metrics["errors"] += 1
+        # A full sync refetches every invoice; drop the stored ones up front
+        # with a few batched lookups instead of two queries per invoice
+        stored = await asyncio.to_thread(self._stored, context.tenant_id, [record.dext_id for record in records])
+        unstored = [record for record in records if record.dext_id not in stored]
+        metrics["skipped"] = len(records) - len(unstored)
+        metrics["processed"] = metrics["skipped"]
+        metrics["queued"] = len(unstored)
+        return unstored
+
+    def _stored(self, tenant_id: str, dext_ids: List[str]) -> Set[str]:
+        db = self.session_factory()
+        try:
+            return stored_dext_ids(db, tenant_id, dext_ids)
+        finally:
+            db.close()
+
+    async def _push_deferred(self, context: TenantContext):
+        """
+        Push the tenant's invoices whose push to Xero was deferred, oldest
+        first and up to max_concurrency at a time. Stops as soon as a push
+        is deferred again. This also reconciles invoices saved for a push
+        whose outcome was never written, once they are old enough that the
+        push cannot still be running.
+        """
+        if not circuit_breakers["xero"].available():
+            return
+        metrics = self.metrics[context.tenant_id]
+        db = self.session_factory()
+        try:
+            invoices = [
+                invoice for invoice in db.query(Invoice).filter(
+                    Invoice.tenant_id == context.tenant_id,
+                    Invoice.status == InvoiceStatus.VALIDATED,
+                    Invoice.xero_invoice_id.is_(None)
+                ).order_by(Invoice.id)
+                if isinstance(invoice.validation_errors, dict) and "deferred" in invoice.validation_errors
+                and not push_in_progress(invoice)
+            ]
+            for start in range(0, len(invoices), context.max_concurrency):
+                batch = invoices[start:start + context.max_concurrency]
+                results = await asyncio.gather(*(context.ingestion.push(invoice) for invoice in batch))
+                db.commit()
+                metrics["resumed"] += sum(1 for result in results if result["success"])
+                if any(result.get("deferred") for result in results):
+                    break
+        except Exception as e:
+            db.rollback()
+            metrics["errors"] += 1
+            print(f"Error pushing deferred invoices for tenant {context.tenant_id}: {str(e)}")
+        finally:
+            db.close()
+
+    async def _dispatch(self, queues: Dict[str, Deque[InvoiceRecord]], contexts: Dict[str, TenantContext]):
+        active: Deque[str] = deque(queues)
+        in_flight: Counter = Counter()
+        running: Dict[asyncio.Task, str] = {}
+
+        while active or running:
+            # Hand free worker slots to tenants in turn, skipping any at their cap
+            while len(running) < self.workers and active:
+                for _ in range(len(active)):
+                    tenant_id = active[0]
+                    active.rotate(-1)
+                    if in_flight[tenant_id] < contexts[tenant_id].max_concurrency:
+                        break
+                else:
+                    break
+
+                queue = queues[tenant_id]
+                record = queue.popleft()
+                if not queue:
+                    active.remove(tenant_id)
+                in_flight[tenant_id] += 1
+                self.metrics[tenant_id]["in_flight"] = in_flight[tenant_id]
+                self.metrics[tenant_id]["queued"] = len(queue)
+                task = asyncio.create_task(self._process(contexts[tenant_id], record))
+                running[task] = tenant_id
+
+            if not running:
+                break
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tenant_id = running.pop(task)
+                in_flight[tenant_id] -= 1
+                self.metrics[tenant_id]["in_flight"] = in_flight[tenant_id]
+                if not in_flight[tenant_id] and not queues[tenant_id]:
+                    await self._flush(contexts[tenant_id])
+                    self._finish(tenant_id)
+
+    async def _process(self, context: TenantContext, record: InvoiceRecord):
+        metrics = self.metrics[context.tenant_id]
+        try:
+            holds = None
+            if context.holds is not None:
+                holds = context.holds.get(str(record.dext_id), [])
+            if await context.ingestion.process(record, holds, before_push=context.writer.save) is None:
+                # Stored meanwhile, say by a webhook
+                metrics["skipped"] += 1
+                metrics["processed"] += 1
+                return
+            await context.writer.add(record)
+            if record.status == InvoiceStatus.VALIDATED and "deferred" in (record.validation_errors or {}):
+                metrics["deferred"] += 1
+            metrics["by_status"][record.status.value] = metrics["by_status"].get(record.status.value, 0) + 1
+            metrics["processed"] += 1
+        except Exception as e:
+            metrics["errors"] += 1
+            print(f"Error processing invoice for tenant {context.tenant_id}: {str(e)}")
+
+    async def _flush(self, context: TenantContext):
+        """
+        Persist the tenant's remaining processed invoices, retrying a few
+        times. Pushed invoices were saved before their push, so an outcome
+        that still cannot be written is reconciled by a later sync.
+        """
+        for attempt in range(FLUSH_ATTEMPTS):
+            try:
+                await context.writer.flush()
+                return
+            except Exception as e:
+                error = e
+                if attempt + 1 < FLUSH_ATTEMPTS:
+                    await asyncio.sleep(2 ** attempt)
+        self.metrics[context.tenant_id]["errors"] += 1
+        print(f"Error saving invoices for tenant {context.tenant_id}: {str(error)}")
+
+    def _new_metrics(self) -> Dict:
+        return {
+            "status": "running",
+            "started_at": datetime.utcnow().isoformat(),
+            "finished_at": None,
+            "fetched": 0,
+            "queued": 0,
+            "in_flight": 0,
+            "processed": 0,
+            "skipped": 0,
+            "flagged": 0,
+            "deferred": 0,
+            "resumed": 0,
+            "errors": 0,
+            "by_status": {},
+            "duration_s": None,
+            "invoices_per_s": None,
+        }
+
+    def _finish(self, tenant_id: str):
+        """
+        Record a tenant's completion as soon as its own work is done, so its
+        throughput is not diluted by other tenants still running
+        """
+        duration = time.perf_counter() - self._started.pop(tenant_id)
+        self._running.discard(tenant_id)
+        metrics = self.metrics[tenant_id]
+        metrics["status"] = "finished"
+        metrics["finished_at"] = datetime.utcnow().isoformat()
+        metrics["duration_s"] = duration
+        metrics["invoices_per_s"] = metrics["processed"] / duration if duration else None
+
+    async def start_periodic(self, interval: int):
+        """
+        Sync every tenant every `interval` seconds in the background
+        """
+        async def loop():
+            while True:
+                try:
+                    await self.run()
+                except Exception as e:
+                    print(f"Scheduled sync failed: {str(e)}")
+                await asyncio.sleep(interval)
+
+        self._periodic_task = asyncio.create_task(loop())
+
+    async def stop(self):
+        if self._periodic_task:
+            self._periodic_task.cancel()
+            await asyncio.gather(self._periodic_task, return_exceptions=True)
+            self._periodic_task = None
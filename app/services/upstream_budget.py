@@ -0,0 +1,44 @@
+from contextlib import asynccontextmanager, nullcontext
+from typing import Dict, Optional
+import asyncio
+from app.core.config import settings
+
+class UpstreamBudget:
+    """
+    Global concurrency budget per upstream API, shared by every tenant's work
+    so that adding organisations never multiplies the load on Dext, OpenAI,
+    Xero or Vision. Upstreams without a limit are unrestricted.
+    """
+    def __init__(self, limits: Optional[Dict[str, int]] = None):
+        self.limits = dict(limits or {})
+        self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.limits.items()}
+        self._in_use = {name: 0 for name in self.limits}
+
+    @classmethod
+    def from_settings(cls) -> "UpstreamBudget":
+        return cls({
+            "dext": settings.DEXT_CONCURRENCY,
+            "openai": settings.OPENAI_CONCURRENCY,
+            "xero": settings.XERO_CONCURRENCY,
+            "vision": settings.VISION_CONCURRENCY,
+        })
+
+    def slot(self, upstream: str):
+        """
+        Async context manager holding one of the upstream's slots
+        """
+        if upstream not in self._semaphores:
+            return nullcontext()
+        return self._acquire(upstream)
+
+    @asynccontextmanager
+    async def _acquire(self, upstream: str):
+        async with self._semaphores[upstream]:
+            self._in_use[upstream] += 1
+            try:
+                yield
+            finally:
+                self._in_use[upstream] -= 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {name: {"limit": self.limits[name], "in_use": self._in_use[name]} for name in self.limits}
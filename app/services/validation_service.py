@@ -1,15 +1,51 @@
-from typing import Dict, List, Optional
-import openai
+from typing import TYPE_CHECKING, Dict, List, Optional
+from datetime import datetime
+import asyncio
+import importlib
 from app.core.config import settings
-from app.models.invoice import Invoice, InvoiceStatus
+from app.core.upstream_traffic import openai_http_client
+from app.models.invoice_record import AnyInvoice
+from app.services.circuit_breaker import CircuitBreaker, CircuitOpenError, circuit_breakers, is_upstream_failure
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# VAT codes Dext exports. While OpenAI is unavailable VAT codes are checked
+# against these instead.
+DEXT_VAT_CODES = {
+    "20% (VAT on Expenses)",
+    "5% (VAT on Expenses)",
+    "Zero Rated Expenses",
+    "Exempt Expenses",
+    "No VAT",
+}
 
 class ValidationService:
-    def __init__(self):
-        openai.api_key = settings.OPENAI_API_KEY
+    def __init__(self, breaker: Optional[CircuitBreaker] = None):
+        self._client: Optional["AsyncOpenAI"] = None
+        self.breaker = breaker or circuit_breakers["openai"]
 
-    async def validate_invoice(self, invoice: Invoice) -> Dict:
+    async def get_client(self) -> "AsyncOpenAI":
         """
-        Validate invoice data using AI
+        OpenAI client, created on first use so a missing key only fails AI
+        validation and the SDK import stays off the startup path. The import
+        runs in a thread so it does not stall the event loop either.
+        """
+        if self._client is None:
+            openai = await asyncio.to_thread(importlib.import_module, "openai")
+            self._client = openai.AsyncOpenAI(
+                api_key=settings.OPENAI_API_KEY,
+                base_url=settings.OPENAI_BASE_URL,
+                timeout=self.breaker.timeout,
+                http_client=openai_http_client(self.breaker.timeout)
+            )
+        return self._client
+
+    async def validate_invoice(self, invoice: AnyInvoice, extraction: Optional[Dict] = None) -> Dict:
+        """
+        Validate invoice data using AI. `extraction` is an OCR result from
+        OCRService; fields read from the source document fill in or correct
+        the invoice before it is checked.
         """
         validation_result = {
             "is_valid": False,
@@ -19,6 +55,9 @@ class ValidationService:
         }
 
         try:
+            if extraction:
+                validation_result["suggestions"].extend(self._apply_extraction(invoice, extraction["fields"]))
+
             # Validate VAT number format
             vat_validation = self._validate_vat_number(invoice.vat_number)
             if not vat_validation["is_valid"]:
@@ -32,6 +71,8 @@ class ValidationService:
                 validation_result["errors"].append(vat_code_validation["error"])
             else:
                 validation_result["confidence_score"] += 0.4
+            if vat_code_validation.get("note"):
+                validation_result["suggestions"].append(vat_code_validation["note"])
 
             # Validate amount format
             amount_validation = self._validate_amount(invoice.amount)
@@ -52,6 +93,30 @@ class ValidationService:
             validation_result["errors"].append(f"Validation error: {str(e)}")
             return validation_result
 
+    def _apply_extraction(self, invoice: AnyInvoice, fields: Dict) -> List[str]:
+        """
+        Fill missing or invalid invoice fields from the document. Fields that
+        are valid but differ from the document are left alone and reported.
+        """
+        suggestions = []
+
+        def apply(name: str, value, usable: bool):
+            current = getattr(invoice, name)
+            if value is None or value == current:
+                return
+            if usable:
+                suggestions.append(f"Document shows {name} {value}, invoice has {current}")
+            else:
+                setattr(invoice, name, value)
+                suggestions.append(f"{name} read from document: {value}")
+
+        apply("vat_number", fields.get("vat_number"), self._validate_vat_number(invoice.vat_number)["is_valid"])
+        apply("vat_code", fields.get("vat_code"), bool(invoice.vat_code))
+        apply("amount", fields.get("amount"), invoice.amount is not None and invoice.amount > 0)
+        if fields.get("date"):
+            apply("date", datetime.fromisoformat(fields["date"]), invoice.date is not None)
+        return suggestions
+
     def _validate_vat_number(self, vat_number: str) -> Dict:
         """
         Validate VAT number format
@@ -67,28 +132,46 @@ class ValidationService:
 
     async def _validate_vat_code(self, vat_code: str) -> Dict:
         """
-        Validate VAT code using AI
+        Validate VAT code using AI, or by rules alone while OpenAI is
+        unavailable or failing
         """
         if not vat_code:
             return {"is_valid": False, "error": "VAT code is missing"}
 
+        try:
+            client = await self.get_client()
+        except Exception as e:
+            return {"is_valid": False, "error": f"AI validation error: {str(e)}"}
+
         try:
             # Use OpenAI to validate and categorize VAT code
-            response = await openai.ChatCompletion.acreate(
+            response = await self.breaker.call(lambda: client.chat.completions.create(
                 model="gpt-4",
                 messages=[
                     {"role": "system", "content": "You are a VAT code validation expert."},
                     {"role": "user", "content": f"Validate and categorize this VAT code: {vat_code}"}
                 ]
-            )
+            ))
 
             # Process the AI response
             # This is a simplified example - you would need to implement proper response parsing
             return {"is_valid": True}
 
         except Exception as e:
+            if is_upstream_failure(e):
+                return self._validate_vat_code_by_rules(vat_code, e)
             return {"is_valid": False, "error": f"AI validation error: {str(e)}"}
 
+    def _validate_vat_code_by_rules(self, vat_code: str, error: Exception) -> Dict:
+        """
+        Fallback check against the VAT codes Dext exports
+        """
+        reason = "OpenAI circuit open" if isinstance(error, CircuitOpenError) else str(error)
+        note = f"VAT code checked by rules only ({reason})"
+        if vat_code.strip() not in DEXT_VAT_CODES:
+            return {"is_valid": False, "error": f"Unrecognised VAT code: {vat_code}", "note": note}
+        return {"is_valid": True, "note": note}
+
     def _validate_amount(self, amount: float) -> Dict:
         """
         Validate invoice amount
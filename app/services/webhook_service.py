@@ -0,0 +1,267 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import logging
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.invoice import Invoice, InvoiceStatus
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.sync_scheduler import SyncScheduler
+
+logger = logging.getLogger("app.webhooks")
+
+# (tenant_id, source, category, resource_id)
+Key = Tuple[str, str, str, str]
+
+@dataclass
+class WebhookEvent:
+    source: str           # "dext" or "xero"
+    category: str         # "document" or "INVOICE"
+    resource_id: str
+    event_id: str         # delivery identifier, used to drop redeliveries
+    occurred_at: datetime
+    tenant_id: str = settings.DEFAULT_TENANT_ID
+    attempts: int = 0
+    # Older deliveries for the same resource folded into this one
+    coalesced_ids: List[str] = field(default_factory=list)
+
+    @property
+    def key(self) -> Key:
+        return (self.tenant_id, self.source, self.category, self.resource_id)
+
+    @property
+    def event_ids(self) -> List[str]:
+        return [self.event_id, *self.coalesced_ids]
+
+class WebhookQueue:
+    """
+    In-process queue between the webhook receivers and the handlers.
+
+    - Redelivered events (same event_id) are dropped while the event is
+      queued or being handled, and once it has been handled successfully.
+      An event that is given up on is forgotten, so its redelivery is
+      accepted again.
+    - Events for a resource that is already queued are coalesced into one
+      entry carrying the newest event, since handlers re-fetch current state.
+    - Events older than the last one processed for the resource are dropped,
+      so out-of-order deliveries never roll state back.
+    - A resource is only ever handled by one worker at a time.
+    - Failed events are retried with exponential backoff up to max_attempts.
+    - Events refused by an open circuit breaker wait until it lets calls
+      through again, without using up an attempt.
+    """
+    def __init__(
+        self,
+        handler: Callable[[WebhookEvent], Awaitable[None]],
+        workers: int = 2,
+        max_attempts: int = 5,
+        history_size: int = 100_000,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.history_size = history_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: Dict[Key, WebhookEvent] = {}
+        self._in_flight: Set[Key] = set()
+        self._blocked: Set[Key] = set()
+        self._seen_event_ids: "OrderedDict[str, None]" = OrderedDict()
+        self._active_event_ids: Set[str] = set()
+        self._last_processed: "OrderedDict[Key, datetime]" = OrderedDict()
+        self._tasks: List[asyncio.Task] = []
+        self._scheduled_retries = 0
+        self.stats = {"received": 0, "duplicates": 0, "stale": 0, "coalesced": 0, "processed": 0, "failed": 0, "deferred": 0}
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    def _remember(self, history: OrderedDict, key, value):
+        history[key] = value
+        history.move_to_end(key)
+        while len(history) > self.history_size:
+            history.popitem(last=False)
+
+    def enqueue(self, event: WebhookEvent) -> bool:
+        """
+        Queue an event; returns False if it was dropped as a duplicate or stale
+        """
+        self.stats["received"] += 1
+        if event.event_id in self._seen_event_ids or event.event_id in self._active_event_ids:
+            self.stats["duplicates"] += 1
+            return False
+
+        last = self._last_processed.get(event.key)
+        if last is not None and event.occurred_at <= last:
+            # A newer event for the resource has already been handled
+            self.stats["stale"] += 1
+            self._remember(self._seen_event_ids, event.event_id, None)
+            return False
+
+        self._active_event_ids.add(event.event_id)
+        pending = self._pending.get(event.key)
+        if pending is not None:
+            self.stats["coalesced"] += 1
+            self._pending[event.key] = self._coalesce(pending, event)
+            return True
+
+        self._pending[event.key] = event
+        self.queue.put_nowait(event.key)
+        return True
+
+    def _coalesce(self, pending: WebhookEvent, event: WebhookEvent) -> WebhookEvent:
+        """
+        Keep the newer of two events for a resource, carrying the other's ids
+        so they are settled together
+        """
+        newer, older = (event, pending) if event.occurred_at > pending.occurred_at else (pending, event)
+        newer.coalesced_ids.extend(older.event_ids)
+        return newer
+
+    def _settle(self, event: WebhookEvent, handled: bool):
+        """
+        Stop tracking an event's ids as active; handled ones are remembered
+        so their redeliveries are dropped
+        """
+        for event_id in event.event_ids:
+            self._active_event_ids.discard(event_id)
+            if handled:
+                self._remember(self._seen_event_ids, event_id, None)
+
+    async def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def drain(self):
+        """
+        Wait until everything queued so far, including retries, has been handled
+        """
+        while True:
+            await self.queue.join()
+            if not self._scheduled_retries:
+                return
+            await asyncio.sleep(0.05)
+
+    def _retry(self, event: WebhookEvent):
+        event.attempts += 1
+        if event.attempts >= self.max_attempts:
+            self.stats["failed"] += 1
+            logger.error("Giving up on webhook event %s after %s attempts", event.event_id, event.attempts)
+            self._settle(event, handled=False)
+            return
+        self._schedule(event, 2 ** event.attempts)
+
+    def _defer(self, event: WebhookEvent, delay: float):
+        self.stats["deferred"] += 1
+        self._schedule(event, max(delay, 1.0))
+
+    def _schedule(self, event: WebhookEvent, delay: float):
+        self._scheduled_retries += 1
+        asyncio.get_running_loop().call_later(delay, self._requeue, event)
+
+    def _requeue(self, event: WebhookEvent):
+        self._scheduled_retries -= 1
+        # A newer event for the resource supersedes the retry
+        pending = self._pending.get(event.key)
+        if pending is not None:
+            self._pending[event.key] = self._coalesce(pending, event)
+            return
+        self._pending[event.key] = event
+        self.queue.put_nowait(event.key)
+
+    async def _worker(self):
+        while True:
+            key = await self.queue.get()
+            try:
+                if key in self._in_flight:
+                    # Another worker has this resource; pick it up when it finishes
+                    self._blocked.add(key)
+                    continue
+                event = self._pending.pop(key, None)
+                if event is None:
+                    continue
+
+                self._in_flight.add(key)
+                try:
+                    await self.handler(event)
+                    self.stats["processed"] += 1
+                    self._remember(self._last_processed, key, event.occurred_at)
+                    self._settle(event, handled=True)
+                except CircuitOpenError as e:
+                    self._defer(event, e.retry_after)
+                except Exception:
+                    logger.exception("Error handling webhook event %s", event.event_id)
+                    self._retry(event)
+                finally:
+                    self._in_flight.discard(key)
+                    if key in self._blocked:
+                        self._blocked.discard(key)
+                        self.queue.put_nowait(key)
+            finally:
+                self.queue.task_done()
+
+class WebhookProcessor:
+    """
+    Handles queued webhook events: Dext documents are fetched and ingested
+    individually, Xero invoice events update the matching local invoice. Both use
+    the event tenant's services and share the scheduler's upstream budget.
+    """
+    def __init__(self, scheduler: SyncScheduler, session_factory=SessionLocal):
+        self.scheduler = scheduler
+        self.session_factory = session_factory
+
+    async def handle(self, event: WebhookEvent):
+        if event.source == "dext":
+            await self._ingest_document(event)
+        elif event.source == "xero":
+            await self._apply_xero_event(event)
+
+    async def _ingest_document(self, event: WebhookEvent):
+        db = self.session_factory()
+        try:
+            ingestion = self.scheduler.tenant_context(db, event.tenant_id).ingestion
+            async with self.scheduler.budget.slot("dext"):
+                invoice_data = await ingestion.dext_service.get_invoice_details(event.resource_id)
+            if invoice_data is None:
+                raise RuntimeError(f"Dext document {event.resource_id} could not be fetched")
+
+            await ingestion.ingest(db, invoice_data, tenant_id=event.tenant_id)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _apply_xero_event(self, event: WebhookEvent):
+        db = self.session_factory()
+        try:
+            xero_service = self.scheduler.tenant_context(db, event.tenant_id).ingestion.xero_service
+            invoice = db.query(Invoice).filter(
+                Invoice.tenant_id == event.tenant_id,
+                Invoice.xero_invoice_id == event.resource_id
+            ).first()
+            if invoice:
+                async with self.scheduler.budget.slot("xero"):
+                    xero_invoice = await xero_service.get_resource("Invoices", event.resource_id)
+                xero_status = (xero_invoice or {}).get("Status")
+                if xero_status in ("VOIDED", "DELETED"):
+                    invoice.status = InvoiceStatus.ERROR
+                    invoice.validation_errors = {"xero_error": f"Invoice {xero_status.lower()} in Xero"}
+                invoice.updated_at = datetime.utcnow()
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
@@ -1,16 +1,59 @@
+import asyncio
 import requests
 from typing import Dict, Optional
+from urllib3.exceptions import NewConnectionError
 from datetime import datetime, timedelta
 from app.core.config import settings
-from app.models.invoice import Invoice, InvoiceStatus
+from app.core.upstream_traffic import upstream_session
+from app.models.invoice import Invoice
+from app.models.invoice_record import AnyInvoice
+from app.services.circuit_breaker import CircuitBreaker, CircuitOpenError, circuit_breakers, is_upstream_failure
+
+def _not_sent(error: BaseException) -> bool:
+    """
+    Whether a failed request certainly never reached Xero (or was refused
+    unprocessed), so repeating it cannot create anything twice
+    """
+    if isinstance(error, (CircuitOpenError, requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code == 429
 
 class XeroService:
-    def __init__(self):
+    def __init__(
+        self,
+        access_token: Optional[str] = None,
+        token_expires_at: Optional[datetime] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        xero_tenant_id: Optional[str] = None
+    ):
         self.client_id = settings.XERO_CLIENT_ID
         self.client_secret = settings.XERO_CLIENT_SECRET
-        self.base_url = "https://api.xero.com/api.xro/2.0"  # Replace with actual Xero API URL
-        self.access_token = None
-        self.token_expires_at = None
+        self.base_url = settings.XERO_API_URL
+        # Organisation every call acts on; one token can reach several
+        self.xero_tenant_id = xero_tenant_id
+        self.access_token = access_token
+        self.token_expires_at = (token_expires_at or datetime.max) if access_token else None
+        self.breaker = breaker or circuit_breakers["xero"]
+
+    async def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Request through the Xero circuit breaker, on behalf of the service's
+        Xero organisation. Raises CircuitOpenError while Xero is unavailable
+        and TimeoutError past XERO_TIMEOUT_SECONDS.
+        """
+        if self.xero_tenant_id:
+            kwargs["headers"] = {**kwargs.get("headers", {}), "xero-tenant-id": self.xero_tenant_id}
+
+        def send():
+            response = upstream_session("xero").request(method, url, timeout=self.breaker.timeout, **kwargs)
+            response.raise_for_status()
+            return response
+
+        return await self.breaker.call(lambda: asyncio.to_thread(send))
 
     async def authenticate(self):
         """
@@ -25,27 +68,46 @@ class XeroService:
             print(f"Authentication error: {str(e)}")
             raise
 
-    async def push_invoice(self, invoice: Invoice) -> Dict:
+    async def push_invoice(self, invoice: AnyInvoice, check_existing: bool = False) -> Dict:
         """
-        Push invoice to Xero
+        Push invoice to Xero. When Xero is unavailable, overloaded or too
+        slow the result is marked `deferred`: the push can be retried later.
+
+        Creating an invoice is not idempotent, so a deferred result is also
+        marked `unconfirmed` when Xero may have created it anyway (a read
+        timeout or 5xx after the request went out). Retries of such a push
+        pass `check_existing` to look the invoice up by its reference first.
+        Every push carries the same Idempotency-Key for the invoice as well.
         """
+        reference = f"DEXT-{invoice.dext_id}"
+        unconfirmed = check_existing
         try:
             if not self.access_token or datetime.now() >= self.token_expires_at:
                 await self.authenticate()
 
+            if check_existing:
+                existing = await self.find_invoice(reference)
+                if existing is not None:
+                    return {
+                        "success": True,
+                        "xero_invoice_id": existing["InvoiceID"]
+                    }
+
             # Prepare invoice data for Xero
             xero_invoice = self._prepare_xero_invoice(invoice)
 
             # Send invoice to Xero
-            response = requests.post(
+            unconfirmed = True
+            response = await self._request(
+                "POST",
                 f"{self.base_url}/Invoices",
                 headers={
                     "Authorization": f"Bearer {self.access_token}",
-                    "Content-Type": "application/json"
+                    "Content-Type": "application/json",
+                    "Idempotency-Key": f"{invoice.tenant_id}:{invoice.dext_id}"
                 },
                 json=xero_invoice
             )
-            response.raise_for_status()
 
             xero_response = response.json()
             return {
@@ -53,13 +115,26 @@ class XeroService:
                 "xero_invoice_id": xero_response["InvoiceID"]
             }
 
+        except (CircuitOpenError, TimeoutError, requests.exceptions.RequestException) as e:
+            if not is_upstream_failure(e):
+                return {
+                    "success": False,
+                    "error": str(e)
+                }
+            return {
+                "success": False,
+                "deferred": True,
+                # Whether Xero may hold the invoice despite the failure
+                "unconfirmed": unconfirmed and not _not_sent(e),
+                "error": str(e)
+            }
         except Exception as e:
             return {
                 "success": False,
                 "error": str(e)
             }
 
-    def _prepare_xero_invoice(self, invoice: Invoice) -> Dict:
+    def _prepare_xero_invoice(self, invoice: AnyInvoice) -> Dict:
         """
         Prepare invoice data for Xero format
         """
@@ -82,6 +157,50 @@ class XeroService:
             "Status": "AUTHORISED"
         }
 
+    async def find_invoice(self, reference: str) -> Optional[Dict]:
+        """
+        The Xero invoice with the given reference, or None. Raises on errors,
+        so a failed lookup is never mistaken for a missing invoice.
+        """
+        response = await self._request(
+            "GET",
+            f"{self.base_url}/Invoices",
+            headers={
+                "Authorization": f"Bearer {self.access_token}",
+                "Accept": "application/json"
+            },
+            params={"where": f'Reference=="{reference}"'}
+        )
+        invoices = response.json().get("Invoices", [])
+        return invoices[0] if invoices else None
+
+    async def get_resource(self, resource: str, resource_id: str) -> Optional[Dict]:
+        """
+        Fetch a single Xero resource (e.g. "Invoices", "Contacts") by
+        ID, or None if Xero does not have it. Raises CircuitOpenError while
+        Xero is unavailable and any other error the request hits, so callers
+        can retry rather than treat a failed fetch as a missing resource.
+        """
+        if not self.access_token or datetime.now() >= self.token_expires_at:
+            await self.authenticate()
+
+        try:
+            response = await self._request(
+                "GET",
+                f"{self.base_url}/{resource}/{resource_id}",
+                headers={
+                    "Authorization": f"Bearer {self.access_token}",
+                    "Accept": "application/json"
+                }
+            )
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+        items = response.json().get(resource, [])
+        return items[0] if items else None
+
     async def verify_bank_transaction(self, invoice: Invoice) -> bool:
         """
         Verify if there's a matching bank transaction in Xero
@@ -91,7 +210,8 @@ class XeroService:
                 await self.authenticate()
 
             # Search for matching bank transaction
-            response = requests.get(
+            response = await self._request(
+                "GET",
                 f"{self.base_url}/BankTransactions",
                 headers={
                     "Authorization": f"Bearer {self.access_token}",
@@ -101,7 +221,6 @@ class XeroService:
                     "where": f"Reference==DEXT-{invoice.dext_id}"
                 }
             )
-            response.raise_for_status()
 
             transactions = response.json().get("BankTransactions", [])
             return len(transactions) > 0
@@ -0,0 +1,34 @@
+"""
+Synthetic Dext invoice corpora for benchmarks.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List
+
+SUPPLIERS = [f"Supplier {i:04d} Ltd" for i in range(500)]
+VAT_CODES = ["20% (VAT on Expenses)", "5% (VAT on Expenses)", "Zero Rated Expenses", "No VAT"]
+
+
+def iter_invoices(count: int, seed: int = 0, invalid_rate: float = 0.05, start: datetime = datetime(2020, 1, 1)) -> Iterator[Dict]:
+    """
+    Yield `count` invoices in Dext's JSON shape; deterministic for a given seed.
+    A fraction of invoices (invalid_rate) carries a non-UK VAT number so the
+    validation failure path is exercised too.
+    """
+    rng = random.Random(seed)
+    span_days = 5 * 365
+    for i in range(count):
+        supplier = rng.randrange(len(SUPPLIERS))
+        invalid = rng.random() < invalid_rate
+        yield {
+            "id": f"dext-{seed}-{i:07d}",
+            "supplier_name": SUPPLIERS[supplier],
+            "vat_number": f"{'FR' if invalid else 'GB'}{100000000 + supplier * 7919 % 899999999}",
+            "vat_code": rng.choice(VAT_CODES),
+            "amount": f"{rng.lognormvariate(4.5, 1.0):.2f}",
+            "date": (start + timedelta(days=rng.randrange(span_days))).isoformat(),
+        }
+
+
+def generate_invoices(count: int, seed: int = 0, invalid_rate: float = 0.05) -> List[Dict]:
+    return list(iter_invoices(count, seed=seed, invalid_rate=invalid_rate))
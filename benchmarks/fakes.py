@@ -0,0 +1,219 @@
+"""
+In-process stand-ins for the Dext, Xero and OpenAI HTTP APIs.
+
+Each fake runs a real HTTP server on a background thread so the services talk
+to it exactly as they would to the upstream, with configurable latency, error
+rate and rate limiting (429 with Retry-After).
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+# (status, payload) returned by a route handler
+RouteResult = Tuple[int, object]
+Route = Callable[[str, Dict[str, List[str]], bytes], RouteResult]
+
+
+class FakeUpstream:
+    def __init__(
+        self,
+        name: str,
+        routes: Dict[Tuple[str, str], Route],
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit: Optional[int] = None,
+        retry_after: int = 1,
+        seed: int = 0,
+    ):
+        """
+        routes maps (method, path prefix) to a handler; rate_limit is the number
+        of requests allowed per one-second window before answering 429
+        """
+        self.name = name
+        self.routes = routes
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.stats = {"requests": 0, "errors": 0, "throttled": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = 0.0
+        self._window_count = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeUpstream":
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                upstream._handle(self, "GET")
+
+            def do_POST(self):
+                upstream._handle(self, "POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "FakeUpstream":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _admit(self) -> Tuple[bool, bool, float]:
+        """
+        Decide throttling, injected failure and latency for one request
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            if self.rate_limit is not None:
+                if now - self._window_start >= 1.0:
+                    self._window_start = now
+                    self._window_count = 0
+                self._window_count += 1
+                if self._window_count > self.rate_limit:
+                    self.stats["throttled"] += 1
+                    return True, False, 0.0
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.stats["errors"] += 1
+            delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+            return False, failed, delay / 1000.0
+
+    def _handle(self, request: BaseHTTPRequestHandler, method: str):
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        parsed = urlparse(request.path)
+
+        throttled, failed, delay = self._admit()
+        if throttled:
+            self._send(request, 429, {"error": "rate limited"}, {"Retry-After": str(self.retry_after)})
+            return
+        if delay:
+            time.sleep(delay)
+        if failed:
+            self._send(request, 503, {"error": f"injected {self.name} failure"})
+            return
+
+        for (route_method, prefix), route in self.routes.items():
+            if route_method == method and parsed.path.startswith(prefix):
+                status, payload = route(parsed.path[len(prefix):], parse_qs(parsed.query), body)
+                self._send(request, status, payload)
+                return
+        self._send(request, 404, {"error": f"no route for {method} {parsed.path}"})
+
+    def _send(self, request: BaseHTTPRequestHandler, status: int, payload: object, headers: Optional[Dict[str, str]] = None):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        try:
+            request.send_response(status)
+            request.send_header("Content-Type", "application/json")
+            request.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                request.send_header(key, value)
+            request.end_headers()
+            request.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client timed out and hung up
+            pass
+
+
+def fake_dext(invoices: List[Dict], **options) -> FakeUpstream:
+    """
+    Dext stand-in serving the given invoice corpus
+    """
+    by_id = {invoice["id"]: invoice for invoice in invoices}
+    # Serialise the listing once; re-encoding a large corpus per request would
+    # dominate the measurement
+    listing = json.dumps({"invoices": invoices}).encode()
+
+    def get_invoice(rest: str, query, body) -> RouteResult:
+        if not rest.strip("/"):
+            return 200, listing
+        invoice = by_id.get(rest.strip("/"))
+        return (200, invoice) if invoice else (404, {"error": "not found"})
+
+    return FakeUpstream("dext", {("GET", "/invoices"): get_invoice}, **options)
+
+
+def fake_xero(**options) -> FakeUpstream:
+    """
+    Xero stand-in accepting invoices, finding them by reference and
+    answering bank transaction searches
+    """
+    by_reference: Dict[str, Dict] = {}
+
+    def post_invoice(rest: str, query, body) -> RouteResult:
+        invoice = {**json.loads(body or b"{}"), "InvoiceID": str(uuid.uuid4())}
+        by_reference[invoice.get("Reference", invoice["InvoiceID"])] = invoice
+        return 200, {"InvoiceID": invoice["InvoiceID"]}
+
+    def get_invoices(rest: str, query, body) -> RouteResult:
+        # Only the Reference=="..." filter the app uses
+        where = query.get("where", [""])[0]
+        reference = where.partition("==")[2].strip('"')
+        invoice = by_reference.get(reference)
+        return 200, {"Invoices": [invoice] if invoice else []}
+
+    def get_bank_transactions(rest: str, query, body) -> RouteResult:
+        return 200, {"BankTransactions": []}
+
+    return FakeUpstream(
+        "xero",
+        {
+            ("POST", "/Invoices"): post_invoice,
+            ("GET", "/Invoices"): get_invoices,
+            ("GET", "/BankTransactions"): get_bank_transactions,
+        },
+        **options
+    )
+
+
+def fake_openai(**options) -> FakeUpstream:
+    """
+    OpenAI stand-in answering chat completions with a fixed verdict
+    """
+    def chat_completion(rest: str, query, body) -> RouteResult:
+        request = json.loads(body or b"{}")
+        return 200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "VALID"},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    return FakeUpstream("openai", {("POST", "/v1/chat/completions"): chat_completion}, **options)
@@ -0,0 +1,57 @@
+"""
+Cold-start benchmark: how long a fresh interpreter takes to import the app.
+
+Each run is a separate process so nothing is already in sys.modules. The
+module's cumulative time comes from `python -X importtime`.
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+
+def _parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """
+    (module, self_us, cumulative_us) for every line of -X importtime output
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        entries.append((name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def measure_import(module: str = "app.main", runs: int = 5, top: int = 10) -> Dict:
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "sqlite://")
+
+    import_ms, process_ms = [], []
+    heaviest: List[Tuple[str, int, int]] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True, text=True, env=env, check=True,
+        )
+        process_ms.append((time.perf_counter() - start) * 1000)
+        entries = _parse_importtime(completed.stderr)
+        total = next(cumulative for name, _, cumulative in entries if name == module)
+        import_ms.append(total / 1000)
+        heaviest = entries
+
+    heaviest = sorted(heaviest, key=lambda entry: entry[1], reverse=True)[:top]
+    return {
+        "scenario": "startup_import_time",
+        "params": {"module": module, "runs": runs},
+        "metrics": {
+            "import_ms": statistics.median(import_ms),
+            "process_ms": statistics.median(process_ms),
+        },
+        "outcome": {
+            "heaviest_self_ms": {name: self_us / 1000 for name, self_us, _ in heaviest},
+        },
+    }
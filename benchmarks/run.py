@@ -0,0 +1,199 @@
+"""
+Benchmark runner.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare baseline.json --threshold 0.1
+    python -m benchmarks.run --scenarios replay --replay-archive traffic.jsonl.gz
+
+Writes a JSON report (stdout unless --output is given). With --compare, each
+metric is checked against the matching result in the baseline report and the
+process exits non-zero if any regressed by more than the threshold. The
+startup scenario also fails the run when importing the app takes longer than
+--startup-target-ms.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+SCENARIOS = ["startup", "sync", "list", "archive", "anomaly", "degraded", "replay", "ratelimit", "auth"]
+REPORT_SCHEMA_VERSION = 1
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def _float_list(value: str) -> List[float]:
+    return [float(v) for v in value.split(",") if v]
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args: argparse.Namespace) -> Dict:
+    results = []
+    if "startup" in args.scenarios:
+        # Measured first, in subprocesses, before this process imports the app
+        from benchmarks.import_time import measure_import
+
+        results.append(measure_import(runs=args.startup_runs))
+
+    from benchmarks import scenarios
+
+    for name in args.scenarios:
+        if name == "sync":
+            for size in args.sync_sizes:
+                results.append(scenarios.sync_throughput(
+                    size,
+                    latency_ms=args.latency_ms,
+                    error_rate=args.error_rate,
+                    rate_limit=args.rate_limit,
+                ))
+        elif name == "list":
+            for size in args.table_sizes:
+                results.extend(scenarios.list_invoices_latency(size, repeat=args.repeat))
+        elif name == "archive":
+            for size in args.archive_sizes:
+                results.append(scenarios.archive_hot_path(size, repeat=args.repeat))
+        elif name == "anomaly":
+            for size in args.anomaly_sizes:
+                results.append(scenarios.anomaly_detection(size, repeat=args.repeat))
+        elif name == "degraded":
+            for size in args.degraded_sizes:
+                for upstream in ("xero", "openai"):
+                    for breakers in (True, False):
+                        results.append(scenarios.degraded_sync(size, upstream=upstream, breakers=breakers))
+        elif name == "replay":
+            if args.replay_archive:
+                for speed in args.replay_speeds:
+                    results.append(scenarios.replay_sync(args.replay_archive, speed=speed))
+            else:
+                for size in args.replay_sizes:
+                    with tempfile.TemporaryDirectory() as tmp:
+                        archive = os.path.join(tmp, f"sync-{size}.jsonl.gz")
+                        base_urls = scenarios.record_traffic(size, archive, latency_ms=args.latency_ms or 50.0)
+                        for speed in args.replay_speeds:
+                            results.append(scenarios.replay_sync(archive, speed=speed, base_urls=base_urls))
+        elif name == "ratelimit":
+            for clients in (1, 1000):
+                results.append(scenarios.rate_limiter_overhead(clients=clients))
+        elif name == "auth":
+            for hot in (True, False):
+                results.append(scenarios.auth_cost(hot=hot))
+
+    return {
+        "schema_version": REPORT_SCHEMA_VERSION,
+        "created_at": datetime.utcnow().isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def _result_key(result: Dict) -> Tuple[str, str]:
+    return result["scenario"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare(report: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """
+    Return a description of every metric that regressed beyond `threshold`
+    (a fraction, e.g. 0.1 for 10%)
+    """
+    previous = {_result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(_result_key(result))
+        if not old:
+            continue
+        for metric, value in result["metrics"].items():
+            before = old["metrics"].get(metric)
+            if not before or metric == "rows":
+                continue
+            change = (value - before) / before
+            worse = -change if metric.endswith("_per_s") else change
+            if worse > threshold:
+                regressions.append(
+                    f"{result['scenario']} {result['params']} {metric}: "
+                    f"{before:.4g} -> {value:.4g} ({change:+.1%})"
+                )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run the Dext/Xero integration benchmarks")
+    parser.add_argument("--scenarios", type=lambda v: v.split(","), default=SCENARIOS,
+                        help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--sync-sizes", type=_int_list, default=[1000],
+                        help="invoice corpus sizes for the sync scenario")
+    parser.add_argument("--table-sizes", type=_int_list, default=[1000, 10_000, 100_000],
+                        help="invoice table sizes for the list scenario")
+    parser.add_argument("--archive-sizes", type=_int_list, default=[100_000],
+                        help="invoice table sizes for the archive scenario")
+    parser.add_argument("--anomaly-sizes", type=_int_list, default=[100_000],
+                        help="invoice table sizes for the anomaly detection scenario")
+    parser.add_argument("--degraded-sizes", type=_int_list, default=[200],
+                        help="invoice corpus sizes for the degraded-upstream sync scenario")
+    parser.add_argument("--replay-archive",
+                        help="upstream traffic recorded with UPSTREAM_TRAFFIC_MODE=record to replay; "
+                             "by default a sync against the fake upstreams is recorded first")
+    parser.add_argument("--replay-sizes", type=_int_list, default=[1000],
+                        help="invoice corpus sizes to record for the replay scenario")
+    parser.add_argument("--replay-speeds", type=_float_list, default=[1.0, 0.0],
+                        help="replay speeds: 1 at recorded latency, 0 as fast as possible")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fake upstream latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake upstream failure rate")
+    parser.add_argument("--rate-limit", type=int, default=None,
+                        help="fake upstream requests per second before answering 429")
+    parser.add_argument("--repeat", type=int, default=20, help="samples per latency measurement")
+    parser.add_argument("--startup-runs", type=int, default=5, help="fresh interpreters for the startup scenario")
+    parser.add_argument("--startup-target-ms", type=float, default=None,
+                        help="fail if importing app.main takes longer than this")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON report to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed regression as a fraction of the baseline")
+    args = parser.parse_args(argv)
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = run(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    failures = []
+    if args.startup_target_ms is not None:
+        for result in report["results"]:
+            if result["scenario"] == "startup_import_time" and result["metrics"]["import_ms"] > args.startup_target_ms:
+                failures.append(
+                    f"startup import took {result['metrics']['import_ms']:.0f} ms "
+                    f"(target {args.startup_target_ms:.0f} ms)"
+                )
+    if args.compare:
+        with open(args.compare) as f:
+            failures.extend(f"REGRESSION {line}" for line in compare(report, json.load(f), args.threshold))
+    for line in failures:
+        print(line, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,491 @@
+"""
+Benchmark scenarios. Each returns a result dict of the form
+{"scenario": ..., "params": {...}, "metrics": {...}}.
+
+Metric names ending in `_per_s` are throughputs (higher is better); every
+other metric is a cost (lower is better).
+"""
+import asyncio
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional
+
+# app.core.database builds its engine at import time
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from fastapi import FastAPI, HTTPException  # noqa: E402
+from fastapi.security import HTTPAuthorizationCredentials  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import create_engine, func, insert, update  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.api import invoices as invoices_api  # noqa: E402
+from app.core.config import Settings, settings  # noqa: E402
+from app.core.database import get_db  # noqa: E402
+from app.core.http_cache import response_cache  # noqa: E402
+from app.core.dependencies import get_invoice_archive, get_validation_service  # noqa: E402
+from app.core.security import RateLimiter, create_access_token, token_cache, verify_api_key  # noqa: E402
+from app.core.upstream_traffic import RECORD, REPLAY, upstream_traffic  # noqa: E402
+from app.models.invoice import Invoice, InvoiceStatus  # noqa: E402
+from app.services.anomaly_service import AnomalyDetector  # noqa: E402
+from app.services.archive_service import InvoiceArchive  # noqa: E402
+from app.services.circuit_breaker import circuit_breakers  # noqa: E402
+from app.services.sync_scheduler import SyncScheduler  # noqa: E402
+from benchmarks.corpus import generate_invoices, iter_invoices  # noqa: E402
+from benchmarks.fakes import FakeUpstream, fake_dext, fake_openai, fake_xero  # noqa: E402
+
+
+def _summarise(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+
+    def pick(q: float) -> float:
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+    return {
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def _measure(fn: Callable[[], object], repeat: int, warmup: int = 3) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return _summarise(samples)
+
+
+@contextmanager
+def _database() -> Iterator[sessionmaker]:
+    """
+    Throwaway SQLite database with the invoice schema
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+        Invoice.metadata.create_all(bind=engine)
+        try:
+            yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        finally:
+            engine.dispose()
+
+
+def _load_table(SessionLocal: sessionmaker, size: int, chunk_size: int = 10_000):
+    statuses = list(InvoiceStatus)
+    db = SessionLocal()
+    try:
+        rows = []
+        for i, data in enumerate(iter_invoices(size)):
+            rows.append({
+                "dext_id": data["id"],
+                "supplier_name": data["supplier_name"],
+                "vat_number": data["vat_number"],
+                "vat_code": data["vat_code"],
+                "amount": float(data["amount"]),
+                "date": datetime.fromisoformat(data["date"]),
+                "status": statuses[i % len(statuses)],
+                "confidence_score": 1.0,
+                "tenant_id": settings.DEFAULT_TENANT_ID,
+            })
+            if len(rows) >= chunk_size:
+                db.execute(insert(Invoice.__table__), rows)
+                rows = []
+        if rows:
+            db.execute(insert(Invoice.__table__), rows)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _point_services_at(dext: FakeUpstream, xero: FakeUpstream, openai: FakeUpstream):
+    settings.DEXT_API_URL = dext.url
+    settings.XERO_API_URL = xero.url
+    settings.OPENAI_API_KEY = settings.OPENAI_API_KEY or "benchmark"
+    settings.OPENAI_BASE_URL = f"{openai.url}/v1"
+    get_validation_service()._client = None
+
+
+def sync_throughput(
+    size: int,
+    latency_ms: float = 0.0,
+    error_rate: float = 0.0,
+    rate_limit: Optional[int] = None,
+    seed: int = 0,
+) -> Dict:
+    """
+    End-to-end `POST /invoices/sync` against the fake upstreams
+    """
+    corpus = generate_invoices(size, seed=seed)
+    options = {"latency_ms": latency_ms, "error_rate": error_rate, "rate_limit": rate_limit, "seed": seed}
+
+    with fake_dext(corpus, **options) as dext, fake_xero(**options) as xero, \
+            fake_openai(**options) as openai, _database() as SessionLocal:
+        _point_services_at(dext, xero, openai)
+        scheduler = SyncScheduler(get_validation_service(), session_factory=SessionLocal)
+        error = None
+        start = time.perf_counter()
+        db = SessionLocal()
+        try:
+            asyncio.run(invoices_api.sync_invoices(
+                db=db,
+                tenant_id=settings.DEFAULT_TENANT_ID,
+                scheduler=scheduler,
+            ))
+        except HTTPException as e:
+            error = e.detail
+        elapsed = time.perf_counter() - start
+
+        by_status = {
+            status.value: count
+            for status, count in db.query(Invoice.status, func.count()).group_by(Invoice.status).all()
+        }
+        db.close()
+
+        return {
+            "scenario": "sync_throughput",
+            "params": {"size": size, **options},
+            "metrics": {
+                "elapsed_s": elapsed,
+                "invoices_per_s": size / elapsed if elapsed else 0.0,
+                "upstream_requests": dext.stats["requests"] + xero.stats["requests"] + openai.stats["requests"],
+                "upstream_throttled": dext.stats["throttled"] + xero.stats["throttled"] + openai.stats["throttled"],
+            },
+            "outcome": {"by_status": by_status, "error": error},
+        }
+
+
+LIST_QUERIES = {
+    "by_status": {"status": InvoiceStatus.VALIDATED.value},
+    "one_month": {"start_date": "2023-06-01T00:00:00", "end_date": "2023-06-30T23:59:59"},
+    "all": {},
+}
+
+
+def list_invoices_latency(size: int, repeat: int = 20, max_rows_for_all: int = 10_000) -> List[Dict]:
+    """
+    `GET /invoices` latency for a table of `size` rows; the unfiltered query
+    is skipped above `max_rows_for_all` rows. Measured with the response
+    cache cleared before every request, then served from the cache, then
+    as a conditional GET answered with 304.
+    """
+    results = []
+    with _database() as SessionLocal:
+        _load_table(SessionLocal, size)
+        # The table was bulk loaded, which the cache does not see
+        response_cache.clear()
+
+        def override_get_db():
+            db = SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app = FastAPI()
+        app.include_router(invoices_api.router, prefix="/api")
+        app.dependency_overrides[get_db] = override_get_db
+        app.dependency_overrides[verify_api_key] = lambda: {"sub": "benchmark"}
+
+        with TestClient(app) as client:
+            for name, params in LIST_QUERIES.items():
+                if not params and size > max_rows_for_all:
+                    continue
+                response = client.get("/api/invoices", params=params)
+                rows = len(response.json())
+                etag = response.headers["etag"]
+
+                def uncached():
+                    response_cache.clear()
+                    client.get("/api/invoices", params=params)
+
+                for cache, request in (
+                    (None, uncached),
+                    ("hit", lambda: client.get("/api/invoices", params=params)),
+                    ("revalidate", lambda: client.get("/api/invoices", params=params, headers={"If-None-Match": etag})),
+                ):
+                    metrics = _measure(request, repeat)
+                    metrics["rows"] = rows
+                    results.append({
+                        "scenario": "list_invoices_latency",
+                        "params": {"size": size, "query": name, **({"cache": cache} if cache else {})},
+                        "metrics": metrics,
+                    })
+        response_cache.clear()
+    return results
+
+
+def archive_hot_path(size: int, repeat: int = 20, before: datetime = datetime(2024, 1, 1)) -> Dict:
+    """
+    Uncached `GET /invoices` latency on a table of `size` invoices spread
+    over 2020-2024, before and after archiving the pushed invoices dated
+    before `before` (90% of that history), plus the archive run itself and
+    reading one archived month back
+    """
+    with _database() as SessionLocal, tempfile.TemporaryDirectory() as archive_dir:
+        _load_table(SessionLocal, size)
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(Invoice)
+                .where(Invoice.date < before, Invoice.id % 10 != 0)
+                .values(status=InvoiceStatus.PUSHED_TO_XERO)
+            )
+            db.commit()
+        finally:
+            db.close()
+        archive = InvoiceArchive(archive_dir, session_factory=SessionLocal)
+
+        def override_get_db():
+            db = SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app = FastAPI()
+        app.include_router(invoices_api.router, prefix="/api")
+        app.dependency_overrides[get_db] = override_get_db
+        app.dependency_overrides[verify_api_key] = lambda: {"sub": "benchmark"}
+        app.dependency_overrides[get_invoice_archive] = lambda: archive
+        queries = {
+            "by_status": {"status": InvoiceStatus.VALIDATED.value},
+            "recent_month": {"start_date": "2024-06-01T00:00:00", "end_date": "2024-06-30T23:59:59"},
+        }
+
+        def uncached(params):
+            response_cache.clear()
+            return client.get("/api/invoices", params=params)
+
+        metrics = {}
+        with TestClient(app) as client:
+            for name, params in queries.items():
+                metrics[f"{name}_before_ms"] = _measure(lambda: uncached(params), repeat)["p50_ms"]
+
+            start = time.perf_counter()
+            result = archive.run(before.date())
+            metrics["archive_s"] = time.perf_counter() - start
+            metrics["archived_rows_per_s"] = result["archived"] / metrics["archive_s"]
+
+            for name, params in queries.items():
+                metrics[f"{name}_after_ms"] = _measure(lambda: uncached(params), repeat)["p50_ms"]
+            archived_month = {"start_date": "2022-06-01T00:00:00", "end_date": "2022-06-30T23:59:59", "include_archived": True}
+            metrics["archived_month_ms"] = _measure(lambda: uncached(archived_month), repeat)["p50_ms"]
+        response_cache.clear()
+
+    return {
+        "scenario": "archive_hot_path",
+        "params": {"size": size},
+        "metrics": metrics,
+        "outcome": {"archived": result["archived"], "files": result["files"]},
+    }
+
+
+def anomaly_detection(size: int, batch_size: int = 100, repeat: int = 20) -> Dict:
+    """
+    Loading and fully scanning a table of `size` invoices for duplicates
+    and outliers, and checking one sync batch of `batch_size` new invoices
+    against it
+    """
+    tenant_id = settings.DEFAULT_TENANT_ID
+    with _database() as SessionLocal:
+        _load_table(SessionLocal, size)
+        detector = AnomalyDetector(SessionLocal)
+
+        start = time.perf_counter()
+        detector.reload(tenant_id)
+        load_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        report = detector.scan(tenant_id)
+        scan_s = time.perf_counter() - start
+
+        batch = generate_invoices(batch_size, seed=size + 1)
+        metrics = {f"batch_{name}": value for name, value in _measure(
+            lambda: detector.check_batch(tenant_id, batch), repeat
+        ).items()}
+
+    return {
+        "scenario": "anomaly_detection",
+        "params": {"size": size, "batch_size": batch_size},
+        "metrics": {
+            "load_s": load_s,
+            "scan_s": scan_s,
+            "scan_rows_per_s": size / scan_s if scan_s else 0.0,
+            **metrics,
+        },
+        "outcome": {"duplicate_pairs": len(report["duplicates"]), "outliers": len(report["outliers"])},
+    }
+
+
+def degraded_sync(
+    size: int,
+    upstream: str = "xero",
+    breakers: bool = True,
+    stall_ms: float = 2000.0,
+    timeout: float = 0.5,
+    seed: int = 0,
+) -> Dict:
+    """
+    Sync while Xero or OpenAI stalls past its timeout. With `breakers` the
+    circuit opens and the remaining calls fail fast (pushes deferred,
+    rule-only validation); without, every call waits out the timeout.
+    """
+    corpus = generate_invoices(size, seed=seed)
+    stalled = {upstream: {"latency_ms": stall_ms}}
+    breaker = circuit_breakers[upstream]
+    saved = (breaker.timeout, breaker.enabled)
+    breaker.timeout, breaker.enabled = timeout, breakers
+    breaker.reset()
+    stats = dict(breaker.stats)
+    try:
+        with fake_dext(corpus) as dext, fake_xero(**stalled.get("xero", {})) as xero, \
+                fake_openai(**stalled.get("openai", {})) as openai, _database() as SessionLocal:
+            _point_services_at(dext, xero, openai)
+            scheduler = SyncScheduler(get_validation_service(), session_factory=SessionLocal)
+            start = time.perf_counter()
+            metrics = asyncio.run(scheduler.run([settings.DEFAULT_TENANT_ID]))[settings.DEFAULT_TENANT_ID]
+            elapsed = time.perf_counter() - start
+
+            db = SessionLocal()
+            by_status = {
+                status.value: count
+                for status, count in db.query(Invoice.status, func.count()).group_by(Invoice.status).all()
+            }
+            db.close()
+        calls = {name: breaker.stats[name] - stats[name] for name in ("timeouts", "rejected")}
+    finally:
+        breaker.timeout, breaker.enabled = saved
+        breaker.reset()
+
+    return {
+        "scenario": "degraded_sync",
+        "params": {"size": size, "upstream": upstream, "breakers": breakers, "stall_ms": stall_ms, "timeout": timeout},
+        "metrics": {
+            "elapsed_s": elapsed,
+            "invoices_per_s": size / elapsed if elapsed else 0.0,
+        },
+        "outcome": {
+            "by_status": by_status,
+            "deferred": metrics["deferred"],
+            **calls,
+        },
+    }
+
+
+def record_traffic(
+    size: int,
+    archive: str,
+    latency_ms: float = 50.0,
+    jitter_ms: float = 25.0,
+    seed: int = 0,
+) -> Dict[str, str]:
+    """
+    Record the upstream traffic of a sync against the fake upstreams to
+    `archive`; returns the base URLs it was recorded under
+    """
+    corpus = generate_invoices(size, seed=seed)
+    options = {"latency_ms": latency_ms, "jitter_ms": jitter_ms, "seed": seed}
+    with fake_dext(corpus, **options) as dext, fake_xero(**options) as xero, \
+            fake_openai(**options) as openai, _database() as SessionLocal, \
+            upstream_traffic.using(RECORD, archive):
+        _point_services_at(dext, xero, openai)
+        scheduler = SyncScheduler(get_validation_service(), session_factory=SessionLocal)
+        asyncio.run(scheduler.run([settings.DEFAULT_TENANT_ID]))
+    return {
+        "DEXT_API_URL": settings.DEXT_API_URL,
+        "XERO_API_URL": settings.XERO_API_URL,
+        "OPENAI_BASE_URL": settings.OPENAI_BASE_URL,
+    }
+
+
+def replay_sync(archive: str, speed: float = 0.0, base_urls: Optional[Dict[str, str]] = None) -> Dict:
+    """
+    Sync with every upstream request answered from a recorded archive, at
+    `speed` times the recorded latencies (0: no delay). `base_urls` are the
+    API URLs the archive was recorded under; by default those configured in
+    the environment, as for a recording made in production.
+    """
+    defaults = Settings()
+    for name, url in (base_urls or {
+        "DEXT_API_URL": defaults.DEXT_API_URL,
+        "XERO_API_URL": defaults.XERO_API_URL,
+        "OPENAI_BASE_URL": defaults.OPENAI_BASE_URL,
+    }).items():
+        setattr(settings, name, url)
+    settings.OPENAI_API_KEY = settings.OPENAI_API_KEY or "benchmark"
+    for upstream in ("dext", "xero", "openai"):
+        circuit_breakers[upstream].reset()
+
+    with _database() as SessionLocal, upstream_traffic.using(REPLAY, archive, speed) as traffic:
+        get_validation_service()._client = None
+        scheduler = SyncScheduler(get_validation_service(), session_factory=SessionLocal)
+        start = time.perf_counter()
+        metrics = asyncio.run(scheduler.run([settings.DEFAULT_TENANT_ID]))[settings.DEFAULT_TENANT_ID]
+        elapsed = time.perf_counter() - start
+        stats = dict(traffic.stats)
+    get_validation_service()._client = None
+
+    return {
+        "scenario": "replay_sync",
+        "params": {"archive": os.path.basename(archive), "speed": speed},
+        "metrics": {
+            "elapsed_s": elapsed,
+            "invoices_per_s": metrics["processed"] / elapsed if elapsed else 0.0,
+        },
+        "outcome": {
+            "by_status": metrics["by_status"],
+            "replayed": stats["replayed"],
+            "misses": stats["misses"],
+        },
+    }
+
+
+def rate_limiter_overhead(clients: int = 1, calls: int = 100_000) -> Dict:
+    """
+    Per-call cost of `RateLimiter.is_rate_limited` with `clients` distinct IPs
+    """
+    limiter = RateLimiter()
+    ips = [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(clients)]
+    start = time.perf_counter()
+    for i in range(calls):
+        limiter.is_rate_limited(ips[i % clients])
+    elapsed = time.perf_counter() - start
+    return {
+        "scenario": "rate_limiter_overhead",
+        "params": {"clients": clients, "calls": calls},
+        "metrics": {"mean_us": elapsed / calls * 1e6, "calls_per_s": calls / elapsed},
+    }
+
+
+def auth_cost(calls: int = 20_000, hot: bool = True) -> Dict:
+    """
+    Per-request cost of the bearer-token dependency, either for one hot token
+    or for a distinct (never cached) token per request
+    """
+    token_cache.clear()
+    tokens = [
+        create_access_token({"sub": f"benchmark-{i}"}, timedelta(minutes=30))
+        for i in range(1 if hot else calls)
+    ]
+    credentials = [HTTPAuthorizationCredentials(scheme="Bearer", credentials=token) for token in tokens]
+
+    async def run():
+        for i in range(calls):
+            await verify_api_key(credentials[i % len(credentials)])
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    return {
+        "scenario": "auth_cost",
+        "params": {"calls": calls, "hot": hot},
+        "metrics": {"mean_us": elapsed / calls * 1e6, "calls_per_s": calls / elapsed},
+    }
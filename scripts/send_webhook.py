@@ -0,0 +1,92 @@
+"""
+Send a signed Dext or Xero webhook to a local server, for testing the
+webhook receivers without the real services.
+
+    python scripts/send_webhook.py dext DOC-123
+    python scripts/send_webhook.py xero <xero-invoice-id> --category INVOICE
+    python scripts/send_webhook.py dext DOC-123 --repeat 3   # redeliveries
+    python scripts/send_webhook.py dext DOC-123 --tenant acme --secret <acme's secret>
+    python scripts/send_webhook.py xero <xero-invoice-id> --xero-tenant <xero tenant id>
+
+Secrets default to DEXT_WEBHOOK_SECRET / XERO_WEBHOOK_KEY from the environment,
+and the Xero organisation to XERO_TENANT_ID.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import uuid
+from datetime import datetime, timezone
+
+import requests
+from dotenv import load_dotenv
+
+
+def build_dext(resource_id: str, event_id: str, occurred_at: str) -> dict:
+    return {
+        "id": event_id,
+        "event": "document.published",
+        "occurred_at": occurred_at,
+        "data": {"id": resource_id},
+    }
+
+
+def build_xero(resource_id: str, category: str, occurred_at: str, xero_tenant_id: str) -> dict:
+    return {
+        "events": [{
+            "resourceUrl": f"https://api.xero.com/api.xro/2.0/{category.title()}s/{resource_id}",
+            "resourceId": resource_id,
+            "eventDateUtc": occurred_at,
+            "eventType": "UPDATE",
+            "eventCategory": category,
+            "tenantId": xero_tenant_id,
+            "tenantType": "ORGANISATION",
+        }],
+        "firstEventSequence": 1,
+        "lastEventSequence": 1,
+        "entropy": uuid.uuid4().hex,
+    }
+
+
+def main() -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", choices=["dext", "xero"])
+    parser.add_argument("resource_id")
+    parser.add_argument("--category", default="INVOICE", choices=["INVOICE"], help="Xero event category")
+    parser.add_argument("--url", default="http://localhost:8000", help="server base URL")
+    parser.add_argument("--secret", help="signing secret (defaults to the environment)")
+    parser.add_argument("--tenant", help="tenant id the Dext webhook URL is registered for")
+    parser.add_argument("--xero-tenant", help="Xero organisation (tenantId) of the event")
+    parser.add_argument("--repeat", type=int, default=1, help="deliver the same event this many times")
+    args = parser.parse_args()
+
+    occurred_at = datetime.now(timezone.utc).isoformat()
+    if args.source == "dext":
+        secret = args.secret or os.getenv("DEXT_WEBHOOK_SECRET", "")
+        payload = build_dext(args.resource_id, uuid.uuid4().hex, occurred_at)
+    else:
+        secret = args.secret or os.getenv("XERO_WEBHOOK_KEY", "")
+        xero_tenant_id = args.xero_tenant or os.getenv("XERO_TENANT_ID") or str(uuid.uuid4())
+        payload = build_xero(args.resource_id, args.category, occurred_at, xero_tenant_id)
+
+    body = json.dumps(payload).encode()
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).digest()
+    if args.source == "dext":
+        headers = {"X-Dext-Signature": digest.hex()}
+    else:
+        headers = {"x-xero-signature": base64.b64encode(digest).decode()}
+    headers["Content-Type"] = "application/json"
+
+    params = {"tenant": args.tenant} if args.tenant and args.source == "dext" else None
+    for _ in range(args.repeat):
+        response = requests.post(f"{args.url}/api/webhooks/{args.source}", params=params, data=body, headers=headers)
+        print(f"{response.status_code} {response.elapsed.total_seconds() * 1000:.1f} ms {response.text}")
+    return 0 if response.ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import uuid
+
+# app.core.database builds its engine at import time; tests that need a
+# database get their own through the session_factory fixture
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "tests.db"))
+os.environ.setdefault("ENCRYPTION_KEY", "ZmDfcTF7_60GrrY167zsiPd67pEvs0aGOv2oasOM1Pg=")
+
+import pytest  # noqa: E402
+from sqlalchemy import create_engine, make_url, text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from app.core.http_cache import response_cache  # noqa: E402
+from app.core.migrations import run_migrations  # noqa: E402
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """
+    A migrated SQLite database of the test's own
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'app.db'}")
+    run_migrations(engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "postgres: needs a Postgres server at TEST_DATABASE_URL")
+
+@pytest.fixture
+def postgres_engine():
+    """
+    A fresh Postgres database of the test's own, created on the server at
+    TEST_DATABASE_URL; tests using it are skipped without one
+    """
+    url = os.environ.get("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    server = create_engine(url, isolation_level="AUTOCOMMIT")
+    name = f"test_{uuid.uuid4().hex[:12]}"
+    with server.connect() as connection:
+        connection.execute(text(f"CREATE DATABASE {name}"))
+    engine = create_engine(make_url(url).set(database=name))
+    yield engine
+    engine.dispose()
+    with server.connect() as connection:
+        connection.execute(text(f"DROP DATABASE {name} WITH (FORCE)"))
+    server.dispose()
+
+@pytest.fixture(autouse=True)
+def empty_response_cache():
+    """
+    Cached responses are keyed by tenant and generation, which every test
+    database starts afresh
+    """
+    response_cache.clear()
+    yield
+    response_cache.clear()
@@ -0,0 +1,173 @@
+from datetime import datetime
+import os
+import subprocess
+import sys
+import numpy as np
+from sqlalchemy import insert
+from app.services import anomaly_service
+from app.models.invoice import Invoice, InvoiceStatus
+from app.services.anomaly_service import (
+    AnomalyDetector, find_duplicate_pairs, normalise_supplier, normalise_vat_number, robust_scores,
+    supplier_amount_stats
+)
+
+TENANT = "tenant-a"
+
+def payload(dext_id, amount, date, supplier="Acme Ltd", vat_number="GB123456789"):
+    return {"id": dext_id, "supplier_name": supplier, "vat_number": vat_number, "amount": amount, "date": date}
+
+def store(session_factory, rows, tenant_id=TENANT, ids=None):
+    db = session_factory()
+    db.execute(insert(Invoice.__table__), [
+        {
+            **({"id": ids[i]} if ids else {}),
+            "tenant_id": tenant_id,
+            "dext_id": row["id"],
+            "supplier_name": row["supplier_name"],
+            "vat_number": row["vat_number"],
+            "amount": row["amount"],
+            "date": datetime.fromisoformat(row["date"]),
+            "status": InvoiceStatus.PUSHED_TO_XERO,
+        }
+        for i, row in enumerate(rows)
+    ])
+    db.commit()
+    db.close()
+
+def history(count=30):
+    return [payload(f"h{i}", 100.0 + i % 7, f"2024-01-{i % 28 + 1:02d}") for i in range(count)]
+
+def test_supplier_and_vat_number_normalisation():
+    assert normalise_supplier("ACME  Ltd.") == normalise_supplier("acme limited") == "acme"
+    assert normalise_supplier(None) == ""
+    assert normalise_vat_number(" gb 123 456 789 ") == "GB123456789"
+
+def test_duplicate_pairs_respect_amount_date_and_vat():
+    supplier = np.array([1, 1, 1, 1, 2], dtype=np.int32)
+    vat = np.array([5, 0, 6, 5, 5], dtype=np.int32)
+    cents = np.array([10000, 10001, 10000, 10000, 10000], dtype=np.int64)
+    day = np.array([0, 2, 1, 10, 0], dtype=np.int64)
+
+    pairs = find_duplicate_pairs(supplier, vat, cents, day, window_days=3, tolerance_cents=1)
+
+    # 0-1: unknown VAT matches; 0-2: different VAT numbers; 0-3: too far
+    # apart; 0-4: another supplier. 1-2 pair through 1's unknown VAT.
+    assert pairs.tolist() == [[0, 1], [1, 2]]
+
+def test_duplicate_pairs_ignore_unknown_supplier():
+    supplier = np.zeros(2, dtype=np.int32)
+    pairs = find_duplicate_pairs(
+        supplier, np.zeros(2, dtype=np.int32), np.array([100, 100]), np.array([0, 0]), 3, 1
+    )
+    assert pairs.tolist() == []
+
+def test_robust_scores_need_enough_history(monkeypatch):
+    monkeypatch.setattr("app.core.config.settings.OUTLIER_MIN_HISTORY", 5)
+    supplier = np.array([1] * 10 + [2] * 3, dtype=np.int32)
+    cents = np.array([10000 + 100 * (i % 3) for i in range(10)] + [10000] * 3, dtype=np.int64)
+    stats = supplier_amount_stats(supplier, cents)
+
+    scores = robust_scores(stats, np.array([1, 1, 2], dtype=np.int32), np.array([10100, 500000, 500000]))
+
+    assert abs(scores[0]) < 1
+    assert scores[1] > 3.5
+    # Supplier 2 has only three invoices
+    assert scores[2] == 0
+
+def test_check_batch_holds_duplicates_of_stored_invoices(session_factory):
+    store(session_factory, history())
+    detector = AnomalyDetector(session_factory)
+
+    holds = detector.check_batch(TENANT, [
+        payload("dup", 100.0, "2024-01-02", supplier="ACME limited", vat_number="gb 123456789"),
+        payload("fine", 103.0, "2024-05-01"),
+    ])
+
+    assert list(holds) == ["dup"]
+    assert all(hold["type"] == "duplicate" and "invoice_id" in hold for hold in holds["dup"])
+
+def test_check_batch_holds_the_later_of_two_new_duplicates(session_factory):
+    detector = AnomalyDetector(session_factory)
+
+    holds = detector.check_batch(TENANT, [
+        payload("first", 50.0, "2024-05-01", supplier="Other Ltd"),
+        payload("second", 50.0, "2024-05-03", supplier="Other Ltd"),
+    ])
+
+    assert holds == {"second": [{"type": "duplicate", "dext_id": "first"}]}
+
+def test_check_batch_holds_amount_outliers(session_factory):
+    store(session_factory, history())
+    detector = AnomalyDetector(session_factory)
+
+    holds = detector.check_batch(TENANT, [payload("big", 25000.0, "2024-03-01")])
+
+    assert [hold["type"] for hold in holds["big"]] == ["amount_outlier"]
+    assert holds["big"][0]["score"] > 3.5
+
+def test_check_batch_skips_stored_invoices_and_other_tenants(session_factory):
+    store(session_factory, history())
+    store(session_factory, [payload("theirs", 100.0, "2024-06-01")], tenant_id="tenant-b")
+    detector = AnomalyDetector(session_factory)
+
+    # h1 is already stored, so a sync refetching it does not flag it
+    assert detector.check_batch(TENANT, [payload("h1", 101.0, "2024-01-02")]) == {}
+    # Only the other tenant has a matching invoice
+    assert detector.check_batch(TENANT, [payload("mine", 100.0, "2024-06-01")]) == {}
+
+def test_new_rows_are_picked_up_between_checks(session_factory):
+    detector = AnomalyDetector(session_factory)
+    assert detector.check_batch(TENANT, [payload("a", 80.0, "2024-07-01")]) == {}
+
+    store(session_factory, [payload("a", 80.0, "2024-07-01")])
+    holds = detector.check_batch(TENANT, [payload("b", 80.0, "2024-07-02")])
+
+    assert [hold["type"] for hold in holds["b"]] == ["duplicate"]
+
+def test_rows_committed_out_of_id_order_are_picked_up(session_factory):
+    detector = AnomalyDetector(session_factory)
+    store(session_factory, [payload("a", 10.0, "2024-07-01")], ids=[1])
+    detector.check_batch(TENANT, [payload("x", 99.0, "2024-01-01")])
+
+    # Id 2 is taken by a transaction that has not committed yet when id 3,
+    # another tenant's, is read
+    store(session_factory, [payload("theirs", 10.0, "2024-07-01")], tenant_id="tenant-b", ids=[3])
+    detector.check_batch(TENANT, [payload("x", 99.0, "2024-01-01")])
+    assert detector._columns[TENANT].gaps.keys() == {2}
+
+    store(session_factory, [payload("late", 80.0, "2024-07-01")], ids=[2])
+    holds = detector.check_batch(TENANT, [payload("b", 80.0, "2024-07-02")])
+
+    assert holds["b"] == [{"type": "duplicate", "invoice_id": 2}]
+    assert detector._columns[TENANT].gaps == {}
+
+def test_gaps_are_given_up_on_but_reloads_catch_up(session_factory, monkeypatch):
+    detector = AnomalyDetector(session_factory)
+    store(session_factory, [payload("a", 10.0, "2024-07-01")], ids=[1])
+    detector.check_batch(TENANT, [payload("x", 99.0, "2024-01-01")])
+    store(session_factory, [payload("c", 10.0, "2024-03-01")], ids=[3])
+    detector.check_batch(TENANT, [payload("x", 99.0, "2024-01-01")])
+
+    monkeypatch.setattr(anomaly_service, "GAP_RECHECK_SECONDS", 0)
+    store(session_factory, [payload("late", 80.0, "2024-07-01")], ids=[2])
+    assert detector.check_batch(TENANT, [payload("b", 80.0, "2024-07-02")]) == {}
+
+    monkeypatch.setattr(anomaly_service.settings, "ANOMALY_RELOAD_SECONDS", 0)
+    holds = detector.check_batch(TENANT, [payload("b", 80.0, "2024-07-02")])
+    assert holds["b"] == [{"type": "duplicate", "invoice_id": 2}]
+
+def test_numpy_is_not_imported_at_startup():
+    # Imported on first use, so it stays out of the app's cold start
+    probe = "import sys, app.main; print('numpy' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, env=os.environ, check=True)
+    assert result.stdout.strip() == "False"
+
+def test_scan_reports_duplicate_pairs_and_outliers(session_factory):
+    rows = history() + [payload("dup", 100.0, "2024-01-01"), payload("big", 25000.0, "2024-03-01")]
+    store(session_factory, rows)
+
+    report = AnomalyDetector(session_factory).scan(TENANT)
+
+    assert report["invoices"] == len(rows)
+    assert report["duplicates"]
+    assert len(report["outliers"]) == 1
@@ -0,0 +1,95 @@
+from datetime import date, datetime
+import pytest
+from sqlalchemy import func, insert, select
+from app.core.config import settings
+from app.models.archived_invoice import ArchivedInvoice
+from app.models.invoice import Invoice, InvoiceStatus
+from app.services.archive_service import InvoiceArchive
+
+def invoice(tenant_id, dext_id, when, status=InvoiceStatus.PUSHED_TO_XERO, **fields):
+    return {
+        "tenant_id": tenant_id, "dext_id": dext_id, "supplier_name": "Acme", "amount": 10.0, "date": when,
+        "status": status, "validation_errors": None, "created_at": datetime(2024, 1, 1),
+        "updated_at": datetime(2024, 1, 2), **fields,
+    }
+
+@pytest.fixture
+def archive(session_factory, tmp_path):
+    db = session_factory()
+    db.execute(insert(Invoice.__table__), [
+        invoice("acme", "a1", datetime(2023, 1, 5), validation_errors=["VAT number is missing"]),
+        invoice("acme", "a2", datetime(2023, 1, 20)),
+        invoice("acme", "a3", datetime(2023, 3, 1)),
+        # Not pushed yet, or in an open month: both stay
+        invoice("acme", "a4", datetime(2023, 1, 7), status=InvoiceStatus.VALIDATED),
+        invoice("acme", "a5", datetime(2024, 6, 1)),
+        invoice("globex", "g1", datetime(2023, 1, 9)),
+    ])
+    db.commit()
+    db.close()
+    return InvoiceArchive(str(tmp_path / "archive"), session_factory)
+
+def stored(session_factory, model=Invoice):
+    db = session_factory()
+    try:
+        return set(db.scalars(select(model.dext_id)))
+    finally:
+        db.close()
+
+def test_run_moves_pushed_invoices_from_closed_months(archive, session_factory):
+    result = archive.run(before=date(2024, 1, 1))
+
+    assert result["archived"] == 4
+    assert result["tenants"] == {"acme": 3, "globex": 1}
+    # One file per tenant and month
+    assert result["files"] == 3
+    assert stored(session_factory) == {"a4", "a5"}
+    assert stored(session_factory, ArchivedInvoice) == {"a1", "a2", "a3", "g1"}
+    assert archive.last_run is result
+
+def test_archived_invoices_read_back_with_their_fields(archive):
+    archive.run(before=date(2024, 1, 1))
+
+    invoices = archive.read("acme")
+
+    assert sorted(invoice["dext_id"] for invoice in invoices) == ["a1", "a2", "a3"]
+    first = next(invoice for invoice in invoices if invoice["dext_id"] == "a1")
+    assert first["status"] == InvoiceStatus.PUSHED_TO_XERO.value
+    assert first["date"] == datetime(2023, 1, 5)
+    assert first["validation_errors"] == ["VAT number is missing"]
+    assert first["archived"] is True
+
+def test_read_applies_the_list_filters(archive):
+    archive.run(before=date(2024, 1, 1))
+
+    january = archive.read("acme", start_date=datetime(2023, 1, 1), end_date=datetime(2023, 1, 10))
+    assert [invoice["dext_id"] for invoice in january] == ["a1"]
+    assert archive.read("acme", status=InvoiceStatus.PENDING) == []
+    assert [invoice["dext_id"] for invoice in archive.read("globex")] == ["g1"]
+    assert archive.read("initech") == []
+
+def test_get_finds_one_archived_invoice_of_the_tenant(archive, session_factory):
+    db = session_factory()
+    invoice_id = db.scalar(select(Invoice.id).where(Invoice.dext_id == "a2"))
+    db.close()
+    archive.run(before=date(2024, 1, 1))
+
+    assert archive.get("acme", invoice_id)["dext_id"] == "a2"
+    assert archive.get("globex", invoice_id) is None
+    assert archive.get("acme", invoice_id + 1000) is None
+
+def test_batches_split_a_month_across_files(archive, session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "ARCHIVE_BATCH_SIZE", 1)
+
+    result = archive.run(before=date(2023, 2, 1))
+
+    assert result["archived"] == 3
+    assert result["files"] == 3
+    db = session_factory()
+    assert db.scalar(select(func.count(func.distinct(ArchivedInvoice.archive_path)))) == 3
+    db.close()
+    assert sorted(invoice["dext_id"] for invoice in archive.read("acme")) == ["a1", "a2"]
+
+def test_a_second_run_is_refused_while_one_is_in_progress(archive):
+    with archive._run_lock:
+        assert archive.run(before=date(2024, 1, 1)) is None
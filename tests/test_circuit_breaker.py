@@ -0,0 +1,267 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import asyncio
+import json
+import httpx
+import openai
+import pytest
+import requests
+from app.models.invoice_record import InvoiceRecord
+from app.services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, is_upstream_failure
+from app.services.validation_service import ValidationService
+from app.services.xero_service import XeroService
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+def breaker(**options):
+    defaults = {
+        "timeout": 0.2, "slow_call_seconds": 0.1, "min_calls": 3, "half_open_calls": 2, "open_seconds": 0.05
+    }
+    return CircuitBreaker("test", **{**defaults, **options})
+
+async def ok():
+    return "ok"
+
+async def fail():
+    raise ConnectionError("down")
+
+async def slow():
+    await asyncio.sleep(0.15)
+
+async def hang():
+    await asyncio.sleep(1)
+
+async def fail_with(error):
+    raise error
+
+async def call(circuit, factory):
+    try:
+        return await circuit.call(factory)
+    except Exception as e:
+        return e
+
+async def trip(circuit, factory=fail):
+    for _ in range(circuit.min_calls):
+        await call(circuit, factory)
+
+def test_opens_once_enough_calls_fail_and_then_rejects():
+    async def main():
+        circuit = breaker()
+        await call(circuit, fail)
+        await call(circuit, fail)
+        # Below min_calls nothing happens yet
+        assert circuit.state == CLOSED
+        await call(circuit, fail)
+        assert circuit.state == OPEN
+        assert not circuit.available()
+        with pytest.raises(CircuitOpenError) as rejected:
+            await circuit.call(ok)
+        assert 0 < rejected.value.retry_after <= circuit.open_seconds
+        assert circuit.stats["rejected"] == 1
+    asyncio.run(main())
+
+def test_client_errors_do_not_count_against_the_upstream():
+    async def not_found():
+        raise StatusError(404)
+
+    async def main():
+        circuit = breaker()
+        await trip(circuit, not_found)
+        assert circuit.state == CLOSED
+        await trip(circuit, lambda: fail_with(StatusError(503)))
+        assert circuit.state == OPEN
+    asyncio.run(main())
+
+def upstream_request():
+    return httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+@pytest.mark.parametrize("error", [
+    TimeoutError("slow"),
+    ConnectionError("reset"),
+    requests.exceptions.ReadTimeout("slow"),
+    requests.exceptions.ConnectionError("refused"),
+    httpx.ConnectError("refused"),
+    httpx.ReadTimeout("slow"),
+    openai.APIConnectionError(request=upstream_request()),
+    openai.APITimeoutError(request=upstream_request()),
+    StatusError(500),
+    StatusError(429),
+])
+def test_upstream_failures(error):
+    assert is_upstream_failure(error)
+
+@pytest.mark.parametrize("error", [
+    KeyError("choices"),
+    TypeError("'NoneType' object is not subscriptable"),
+    ValueError("bad"),
+    StatusError(401),
+    requests.exceptions.InvalidURL("no host"),
+])
+def test_other_errors_are_not_upstream_failures(error):
+    assert not is_upstream_failure(error)
+
+def test_bugs_in_our_code_propagate_without_opening_the_circuit():
+    async def broken():
+        return {}["choices"]
+
+    async def main():
+        circuit = breaker()
+        for _ in range(circuit.min_calls):
+            with pytest.raises(KeyError):
+                await circuit.call(broken)
+        assert circuit.state == CLOSED
+        assert circuit.stats["failures"] == 0
+    asyncio.run(main())
+
+def test_vat_code_validation_only_falls_back_to_rules_when_openai_is_down():
+    class Completions:
+        def __init__(self, error):
+            self.error = error
+
+        async def create(self, **kwargs):
+            raise self.error
+
+    def validate(error):
+        service = ValidationService(breaker())
+        completions = Completions(error)
+        service._client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        return asyncio.run(service._validate_vat_code("20% (VAT on Expenses)"))
+
+    assert "rules only" in validate(openai.APITimeoutError(request=upstream_request()))["note"]
+    result = validate(KeyError("choices"))
+    assert result == {"is_valid": False, "error": "AI validation error: 'choices'"}
+
+def test_opens_when_most_calls_are_slow():
+    async def main():
+        circuit = breaker()
+        await trip(circuit, slow)
+        assert circuit.state == OPEN
+    asyncio.run(main())
+
+def test_timeouts_fail_the_call_and_count_as_failures():
+    async def main():
+        circuit = breaker()
+        with pytest.raises(TimeoutError):
+            await circuit.call(hang)
+        assert circuit.stats["timeouts"] == 1
+        assert circuit.stats["failures"] == 1
+    asyncio.run(main())
+
+def test_half_open_closes_after_successful_trials():
+    async def main():
+        circuit = breaker()
+        await trip(circuit)
+        await asyncio.sleep(circuit.open_seconds)
+        assert circuit.available()
+
+        gate = asyncio.Event()
+
+        async def held():
+            await gate.wait()
+            return "ok"
+
+        trials = [asyncio.create_task(call(circuit, held)) for _ in range(circuit.half_open_calls)]
+        await asyncio.sleep(0)
+        # Only half_open_calls trials at a time
+        assert isinstance(await call(circuit, ok), CircuitOpenError)
+        assert circuit.state == HALF_OPEN
+
+        gate.set()
+        assert await asyncio.gather(*trials) == ["ok", "ok"]
+        assert circuit.state == CLOSED
+    asyncio.run(main())
+
+@pytest.mark.parametrize("trial", [fail, slow])
+def test_half_open_reopens_on_a_failed_or_slow_trial(trial):
+    async def main():
+        circuit = breaker()
+        await trip(circuit)
+        await asyncio.sleep(circuit.open_seconds)
+        await call(circuit, trial)
+        assert circuit.state == OPEN
+        assert circuit.stats["opened"] == 2
+    asyncio.run(main())
+
+def test_results_from_before_a_state_change_are_ignored():
+    async def main():
+        circuit = breaker(half_open_calls=1)
+        started = asyncio.create_task(call(circuit, slow))
+        await asyncio.sleep(0)
+        circuit._open(0)
+        await asyncio.sleep(circuit.open_seconds)
+        assert await call(circuit, ok) == "ok"
+        assert circuit.state == CLOSED
+        # The slow call began while closed; it must not reopen the circuit
+        await started
+        assert circuit.state == CLOSED
+    asyncio.run(main())
+
+def test_disabled_breaker_never_opens():
+    async def main():
+        circuit = breaker(enabled=False)
+        await trip(circuit)
+        await trip(circuit)
+        assert circuit.state == CLOSED
+    asyncio.run(main())
+
+def test_reset_closes_an_open_circuit():
+    async def main():
+        circuit = breaker(open_seconds=60)
+        await trip(circuit)
+        circuit.reset()
+        assert await circuit.call(ok) == "ok"
+    asyncio.run(main())
+
+class FakeXero:
+    """
+    Answers XeroService requests: POSTs raise `post_error` if set, GETs
+    return `existing`
+    """
+    def __init__(self, post_error=None, existing=None):
+        self.post_error = post_error
+        self.existing = existing
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, kwargs))
+        if method == "POST" and self.post_error:
+            raise self.post_error
+        response = requests.Response()
+        response.status_code = 200
+        body = {"InvoiceID": "new"} if method == "POST" else {"Invoices": [self.existing] if self.existing else []}
+        response._content = json.dumps(body).encode()
+        return response
+
+def push(fake, monkeypatch, check_existing=False):
+    monkeypatch.setattr("app.services.xero_service.upstream_session", lambda upstream: fake)
+    service = XeroService(
+        access_token="token", token_expires_at=datetime.now() + timedelta(hours=1),
+        breaker=breaker(timeout=1, slow_call_seconds=1, min_calls=100)
+    )
+    record = InvoiceRecord("d1", "Acme", None, None, 10.0, datetime(2024, 1, 1), "acme")
+    return asyncio.run(service.push_invoice(record, check_existing=check_existing))
+
+def test_push_sends_an_idempotency_key(monkeypatch):
+    fake = FakeXero()
+    assert push(fake, monkeypatch) == {"success": True, "xero_invoice_id": "new"}
+    method, kwargs = fake.requests[0]
+    assert method == "POST"
+    assert kwargs["headers"]["Idempotency-Key"] == "acme:d1"
+
+@pytest.mark.parametrize("error, unconfirmed", [
+    (requests.exceptions.ReadTimeout("slow"), True),
+    (requests.exceptions.ConnectTimeout("no route"), False),
+])
+def test_push_failures_say_whether_xero_may_have_the_invoice(monkeypatch, error, unconfirmed):
+    result = push(FakeXero(post_error=error), monkeypatch)
+    assert result["deferred"]
+    assert result["unconfirmed"] is unconfirmed
+
+def test_unconfirmed_push_finds_the_existing_invoice_instead_of_posting(monkeypatch):
+    fake = FakeXero(existing={"InvoiceID": "already-there"})
+    assert push(fake, monkeypatch, check_existing=True) == {"success": True, "xero_invoice_id": "already-there"}
+    assert [method for method, _ in fake.requests] == ["GET"]
+    assert fake.requests[0][1]["params"] == {"where": 'Reference=="DEXT-d1"'}
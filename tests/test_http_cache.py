@@ -0,0 +1,156 @@
+from datetime import datetime
+import asyncio
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, insert, update
+from app.api import invoices
+from app.core.config import settings
+from app.core.database import get_db
+from app.core.dependencies import get_invoice_archive
+from app.core.http_cache import bump_invoice_generations, invoice_generation
+from app.core.security import verify_api_key
+from app.models.invoice import Invoice, InvoiceStatus
+from app.models.invoice_record import InvoiceRecord
+from app.services.archive_service import InvoiceArchive
+from app.services.invoice_store import InvoiceBatchWriter
+
+ACME = {"X-Tenant-ID": "acme"}
+
+@pytest.fixture
+def client(session_factory, tmp_path):
+    db = session_factory()
+    db.execute(insert(Invoice.__table__), [
+        {"tenant_id": tenant_id, "dext_id": f"{tenant_id}-{i}", "supplier_name": "S", "amount": 10.0 + i,
+         "date": datetime(2024, 1, 1 + i), "status": InvoiceStatus.PUSHED_TO_XERO,
+         "created_at": datetime(2024, 2, 1), "updated_at": datetime(2024, 2, 1)}
+        for tenant_id in ("acme", "globex") for i in range(3)
+    ])
+    db.commit()
+    db.close()
+
+    app = FastAPI()
+    app.include_router(invoices.router, prefix="/api")
+
+    def get_test_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = get_test_db
+    app.dependency_overrides[get_invoice_archive] = lambda: InvoiceArchive(str(tmp_path / "archive"), session_factory)
+    app.dependency_overrides[verify_api_key] = lambda: {"sub": "test", "tenants": ["acme", "globex"]}
+    with TestClient(app) as client:
+        client.session_factory = session_factory
+        yield client
+
+def acme_invoice_id(client, dext_id="acme-0"):
+    return next(invoice["id"] for invoice in client.get("/api/invoices", headers=ACME).json()
+                if invoice["dext_id"] == dext_id)
+
+def revalidate(client, path, response):
+    return client.get(path, headers={**ACME, "If-None-Match": response.headers["ETag"]})
+
+def test_matching_etag_gets_304(client):
+    first = client.get("/api/invoices", headers=ACME)
+
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "private, no-cache"
+    again = revalidate(client, "/api/invoices", first)
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["ETag"] == first.headers["ETag"]
+
+def test_list_has_no_last_modified(client):
+    assert "Last-Modified" not in client.get("/api/invoices", headers=ACME).headers
+
+def test_orm_change_invalidates_the_tenants_responses(client):
+    first = client.get("/api/invoices", headers=ACME)
+    db = client.session_factory()
+    db.query(Invoice).filter(Invoice.dext_id == "acme-1").one().status = InvoiceStatus.ERROR
+    db.commit()
+    db.close()
+
+    changed = revalidate(client, "/api/invoices", first)
+
+    assert changed.status_code == 200
+    assert "error" in [invoice["status"] for invoice in changed.json()]
+
+def test_delete_invalidates_the_list(client):
+    first = client.get("/api/invoices", headers=ACME)
+    db = client.session_factory()
+    db.delete(db.query(Invoice).filter(Invoice.dext_id == "acme-2").one())
+    db.commit()
+    db.close()
+
+    changed = revalidate(client, "/api/invoices", first)
+
+    assert changed.status_code == 200
+    assert len(changed.json()) == 2
+
+def test_batch_writer_inserts_invalidate_the_list(client):
+    first = client.get("/api/invoices", headers=ACME)
+    writer = InvoiceBatchWriter("acme", client.session_factory)
+    record = InvoiceRecord("acme-new", "S", None, None, 5.0, datetime(2024, 3, 1), "acme", InvoiceStatus.ERROR)
+
+    async def write():
+        await writer.add(record)
+        await writer.flush()
+    asyncio.run(write())
+
+    assert len(revalidate(client, "/api/invoices", first).json()) == 4
+
+def test_core_writes_elsewhere_invalidate_through_the_shared_generation(client):
+    first = client.get("/api/invoices", headers=ACME)
+    # Another worker updating rows with Core statements, as the archive does
+    db = client.session_factory()
+    db.execute(delete(Invoice.__table__).where(Invoice.dext_id == "acme-0"))
+    bump_invoice_generations(db, ["acme"])
+    db.commit()
+    db.close()
+
+    assert len(revalidate(client, "/api/invoices", first).json()) == 2
+
+def test_other_tenants_changes_keep_the_cache(client):
+    first = client.get("/api/invoices", headers=ACME)
+    db = client.session_factory()
+    generation = invoice_generation(db, "acme")
+    db.query(Invoice).filter(Invoice.dext_id == "globex-0").one().status = InvoiceStatus.ERROR
+    db.commit()
+
+    assert invoice_generation(db, "acme") == generation
+    db.close()
+    assert revalidate(client, "/api/invoices", first).status_code == 304
+
+def test_single_invoice_supports_if_modified_since(client):
+    invoice_id = acme_invoice_id(client)
+    path = f"/api/invoices/{invoice_id}"
+    first = client.get(path, headers=ACME)
+
+    assert first.headers["Last-Modified"] == "Thu, 01 Feb 2024 00:00:00 GMT"
+    assert client.get(path, headers={**ACME, "If-Modified-Since": first.headers["Last-Modified"]}).status_code == 304
+    assert client.get(path, headers={**ACME, "If-Modified-Since": "Wed, 31 Jan 2024 00:00:00 GMT"}).status_code == 200
+
+    db = client.session_factory()
+    db.execute(update(Invoice.__table__).where(Invoice.id == invoice_id).values(updated_at=datetime(2024, 3, 1)))
+    bump_invoice_generations(db, ["acme"])
+    db.commit()
+    db.close()
+    assert client.get(path, headers={**ACME, "If-Modified-Since": first.headers["Last-Modified"]}).status_code == 200
+
+def test_single_invoice_of_another_tenant_is_not_found(client):
+    invoice_id = acme_invoice_id(client)
+    assert client.get(f"/api/invoices/{invoice_id}", headers={"X-Tenant-ID": "globex"}).status_code == 404
+
+def test_gzip_body_is_served_to_clients_that_accept_it(client, monkeypatch):
+    monkeypatch.setattr(settings, "GZIP_MINIMUM_SIZE", 10)
+    plain = client.get("/api/invoices", headers={**ACME, "Accept-Encoding": "identity"})
+    compressed = client.get("/api/invoices", headers={**ACME, "Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in plain.headers
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    # httpx decodes the body; the ETag is the same either way
+    assert compressed.content == plain.content
+    assert compressed.headers["ETag"] == plain.headers["ETag"]
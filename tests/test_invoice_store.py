@@ -0,0 +1,216 @@
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock
+import asyncio
+import pytest
+from sqlalchemy.exc import OperationalError
+from app.core.config import settings
+from app.models.invoice import Invoice, InvoiceStatus
+from app.models.invoice_record import InvoiceRecord
+from app.services import invoice_store
+from app.services.dext_service import DextService
+from app.services.ingestion_service import IngestionService
+from app.services.invoice_store import PUSH_IN_PROGRESS, InvoiceBatchWriter
+from app.services.sync_scheduler import FLUSH_ATTEMPTS, SyncScheduler, TenantContext
+
+TENANT = "acme"
+
+def record(dext_id, status=InvoiceStatus.ERROR):
+    return InvoiceRecord(dext_id, "Acme", None, None, 10.0, datetime(2024, 1, 2), TENANT, status)
+
+def payload(dext_id):
+    return {"id": dext_id, "supplier_name": "Acme", "amount": "10.00", "date": "2024-01-02"}
+
+def stored(session_factory):
+    db = session_factory()
+    try:
+        return {invoice.dext_id: invoice for invoice in db.query(Invoice).filter(Invoice.tenant_id == TENANT)}
+    finally:
+        db.close()
+
+def fail_writes(monkeypatch):
+    def write(self, records):
+        raise OperationalError("INSERT", {}, Exception("database unavailable"))
+    monkeypatch.setattr(InvoiceBatchWriter, "_write", write)
+
+def test_flush_bulk_inserts_waiting_records(session_factory):
+    writer = InvoiceBatchWriter(TENANT, session_factory)
+
+    async def main():
+        for dext_id in ("a", "b"):
+            await writer.add(record(dext_id))
+        return await writer.flush()
+
+    assert asyncio.run(main()) == 2
+    assert set(stored(session_factory)) == {"a", "b"}
+    assert writer.written == 2
+
+def test_add_flushes_a_full_batch(session_factory):
+    writer = InvoiceBatchWriter(TENANT, session_factory, batch_size=2, max_age=60)
+
+    async def main():
+        await writer.add(record("a"))
+        assert stored(session_factory) == {}
+        await writer.add(record("b"))
+
+    asyncio.run(main())
+    assert set(stored(session_factory)) == {"a", "b"}
+
+def test_conflicting_rows_fall_back_to_one_at_a_time(session_factory):
+    writer = InvoiceBatchWriter(TENANT, session_factory)
+
+    async def main():
+        await writer.add(record("b"))
+        await writer.flush()
+        # "b" was stored meanwhile, say by a webhook
+        for dext_id in ("a", "b", "c"):
+            await writer.add(record(dext_id, InvoiceStatus.PUSHED_TO_XERO))
+        return await writer.flush()
+
+    assert asyncio.run(main()) == 2
+    invoices = stored(session_factory)
+    assert set(invoices) == {"a", "b", "c"}
+    assert invoices["b"].status == InvoiceStatus.ERROR
+    assert invoices["a"].status == InvoiceStatus.PUSHED_TO_XERO
+
+def test_records_are_kept_when_the_database_fails(session_factory, monkeypatch):
+    writer = InvoiceBatchWriter(TENANT, session_factory)
+    asyncio.run(writer.add(record("a")))
+    with monkeypatch.context() as patch:
+        fail_writes(patch)
+        with pytest.raises(OperationalError):
+            asyncio.run(writer.flush())
+
+    assert asyncio.run(writer.flush()) == 1
+    assert set(stored(session_factory)) == {"a"}
+
+def test_save_stores_the_invoice_as_in_progress_before_the_push(session_factory):
+    writer = InvoiceBatchWriter(TENANT, session_factory)
+    pushed = record("a", InvoiceStatus.VALIDATED)
+
+    assert asyncio.run(writer.save(pushed))
+    invoice = stored(session_factory)["a"]
+    assert invoice.id == pushed.id
+    assert invoice.validation_errors == {"deferred": PUSH_IN_PROGRESS, "unconfirmed": True}
+
+    pushed.status = InvoiceStatus.PUSHED_TO_XERO
+    pushed.xero_invoice_id = "x-a"
+
+    async def main():
+        await writer.add(pushed)
+        return await writer.flush()
+
+    # An outcome update, not a new row
+    assert asyncio.run(main()) == 0
+    invoice = stored(session_factory)["a"]
+    assert (invoice.status, invoice.xero_invoice_id, invoice.validation_errors) == (
+        InvoiceStatus.PUSHED_TO_XERO, "x-a", None
+    )
+
+def test_save_refuses_an_invoice_stored_meanwhile(session_factory):
+    writer = InvoiceBatchWriter(TENANT, session_factory)
+    assert asyncio.run(writer.save(record("a", InvoiceStatus.VALIDATED)))
+    assert not asyncio.run(writer.save(record("a", InvoiceStatus.VALIDATED)))
+
+class StubXero:
+    """
+    Creates invoices by reference, like Xero, counting creations and lookups
+    """
+    def __init__(self):
+        self.created = {}
+        self.lookups = 0
+
+    async def push_invoice(self, invoice, check_existing=False):
+        if check_existing:
+            self.lookups += 1
+            if invoice.dext_id in self.created:
+                return {"success": True, "xero_invoice_id": self.created[invoice.dext_id]}
+        self.created[invoice.dext_id] = f"x-{invoice.dext_id}"
+        return {"success": True, "xero_invoice_id": self.created[invoice.dext_id]}
+
+class StubValidation:
+    async def validate_invoice(self, invoice, extraction=None):
+        return {"is_valid": True, "confidence_score": 0.99, "errors": []}
+
+def ingestion_service(xero, invoices=()):
+    dext = DextService(api_key="key")
+    dext.fetch_invoices = AsyncMock(return_value=list(invoices))
+    return IngestionService(dext, StubValidation(), xero)
+
+@pytest.fixture
+def scheduler(session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "ANOMALY_DETECTION_ENABLED", False)
+    scheduler = SyncScheduler(StubValidation(), session_factory=session_factory, workers=4)
+    scheduler.xero = StubXero()
+    scheduler.invoices = [payload(f"d{i}") for i in range(5)]
+
+    def tenant_context(db, tenant_id):
+        ingestion = ingestion_service(scheduler.xero, scheduler.invoices)
+        return TenantContext(tenant_id, ingestion, 4, writer=InvoiceBatchWriter(tenant_id, session_factory))
+
+    monkeypatch.setattr(scheduler, "tenant_context", tenant_context)
+    return scheduler
+
+def counted(flush, calls):
+    async def wrapper(self):
+        calls.append(len(self._records))
+        return await flush(self)
+    return wrapper
+
+def test_sync_saves_pushed_invoices_with_their_outcome(scheduler, session_factory):
+    metrics = asyncio.run(scheduler.run([TENANT]))[TENANT]
+
+    assert metrics["by_status"] == {"pushed_to_xero": 5}
+    invoices = stored(session_factory)
+    assert {invoice.status for invoice in invoices.values()} == {InvoiceStatus.PUSHED_TO_XERO}
+    assert {invoice.xero_invoice_id for invoice in invoices.values()} == set(scheduler.xero.created.values())
+
+def test_unsaved_outcomes_are_reconciled_without_pushing_again(scheduler, session_factory, monkeypatch):
+    writes = []
+    monkeypatch.setattr("app.services.sync_scheduler.asyncio.sleep", AsyncMock())
+    with monkeypatch.context() as patch:
+        fail_writes(patch)
+        patch.setattr(InvoiceBatchWriter, "flush", counted(InvoiceBatchWriter.flush, writes))
+        metrics = asyncio.run(scheduler.run([TENANT]))[TENANT]
+
+    # The final flush was retried, then given up on
+    assert len(writes) == FLUSH_ATTEMPTS
+    assert metrics["errors"] == 1
+    assert len(scheduler.xero.created) == 5
+    invoices = stored(session_factory)
+    assert len(invoices) == 5
+    assert all(invoice.validation_errors["deferred"] == PUSH_IN_PROGRESS for invoice in invoices.values())
+
+    # Too recent: the push might still be running
+    asyncio.run(scheduler.run([TENANT]))
+    assert scheduler.xero.lookups == 0
+
+    monkeypatch.setattr(invoice_store, "PUSH_IN_PROGRESS_GRACE", timedelta(0))
+    metrics = asyncio.run(scheduler.run([TENANT]))[TENANT]
+
+    assert metrics["resumed"] == 5
+    assert scheduler.xero.lookups == 5
+    assert len(scheduler.xero.created) == 5
+    assert {invoice.status for invoice in stored(session_factory).values()} == {InvoiceStatus.PUSHED_TO_XERO}
+
+def test_webhook_ingestion_commits_the_invoice_before_the_push(session_factory):
+    xero = StubXero()
+    seen = []
+
+    async def push_invoice(invoice, check_existing=False):
+        seen.append(stored(session_factory)["a"].validation_errors)
+        return await StubXero.push_invoice(xero, invoice, check_existing)
+
+    xero.push_invoice = push_invoice
+    ingestion = ingestion_service(xero)
+    db = session_factory()
+    try:
+        invoice = asyncio.run(ingestion.ingest(db, payload("a"), TENANT))
+        db.commit()
+        assert seen == [{"deferred": PUSH_IN_PROGRESS, "unconfirmed": True}]
+        assert invoice.status == InvoiceStatus.PUSHED_TO_XERO
+        assert stored(session_factory)["a"].xero_invoice_id == "x-a"
+        # Already stored: neither saved nor pushed again
+        assert asyncio.run(ingestion.ingest(db, payload("a"), TENANT)) is None
+        assert len(seen) == 1
+    finally:
+        db.close()
@@ -0,0 +1,144 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+from app.core import migrations
+from app.core.config import settings
+from app.core.migrations import (
+    Migration, backfill_in_batches, create_index_concurrently, get_schema_version, latest_version, run_migrations
+)
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'app.db'}")
+    yield engine
+    engine.dispose()
+
+def version(engine):
+    with engine.connect() as connection:
+        return get_schema_version(connection)
+
+def test_fresh_database_has_no_version(engine):
+    assert version(engine) == 0
+
+def test_migrations_resume_from_an_intermediate_version(engine):
+    assert [m.version for m in run_migrations(engine, target=3)] == [2, 3]
+    assert version(engine) == 3
+    # A pre-tenancy invoice, written by the schema at version 3
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO invoices (dext_id, supplier_name, amount, date, status) "
+            "VALUES ('d1', 'Acme', 10.0, :date, 'PENDING')"
+        ), {"date": datetime(2024, 1, 1)})
+
+    applied = run_migrations(engine)
+
+    assert [m.version for m in applied] == list(range(4, latest_version() + 1))
+    assert version(engine) == latest_version()
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT tenant_id FROM invoices")).scalar() == settings.DEFAULT_TENANT_ID
+        assert "document_extractions" in inspect(connection).get_table_names()
+    assert run_migrations(engine) == []
+
+def test_failed_migration_is_retried_on_the_next_run(engine, monkeypatch):
+    calls = []
+
+    def flaky(connection):
+        calls.append("flaky")
+        if len(calls) == 1:
+            raise RuntimeError("interrupted")
+        connection.execute(text("CREATE TABLE flaky (id INTEGER)"))
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", [
+        Migration(1, "first", lambda connection: connection.execute(text("CREATE TABLE first (id INTEGER)"))),
+        Migration(2, "flaky", flaky),
+    ])
+
+    with pytest.raises(RuntimeError):
+        run_migrations(engine)
+    # The first migration stays applied; the failed one rolled back
+    assert version(engine) == 1
+
+    assert [m.version for m in run_migrations(engine)] == [2]
+    assert version(engine) == 2
+    assert calls == ["flaky", "flaky"]
+
+def make_rows(engine, ids):
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE rows (id INTEGER PRIMARY KEY, kind VARCHAR, flag INTEGER)"))
+        for row_id in ids:
+            connection.execute(
+                text("INSERT INTO rows (id, kind) VALUES (:id, :kind)"),
+                {"id": row_id, "kind": "even" if row_id % 2 == 0 else "odd"},
+            )
+
+def flagged(engine):
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT id FROM rows WHERE flag = 1 ORDER BY id")).scalars().all()
+
+@pytest.mark.parametrize("batch_size", [1, 3, 4, 17, 100])
+def test_backfill_covers_every_row_across_batch_boundaries(engine, batch_size):
+    # Not starting at 1, with a gap wider than some batches
+    ids = [5, 6, 7, 8, 9, 10, 11, 12, 20, 21]
+    make_rows(engine, ids)
+
+    assert backfill_in_batches(engine, "rows", "flag = 1", batch_size=batch_size) == len(ids)
+    assert flagged(engine) == ids
+
+def test_backfill_applies_its_filter_and_params(engine):
+    make_rows(engine, range(1, 11))
+
+    updated = backfill_in_batches(engine, "rows", "flag = :flag", "kind = :kind", batch_size=3,
+                                  params={"flag": 1, "kind": "even"})
+
+    assert updated == 5
+    assert flagged(engine) == [2, 4, 6, 8, 10]
+    # Rerunning is harmless
+    assert backfill_in_batches(engine, "rows", "flag = 1", "flag IS NULL", batch_size=3) == 5
+
+def test_backfill_of_an_empty_table(engine):
+    make_rows(engine, [])
+    assert backfill_in_batches(engine, "rows", "flag = 1") == 0
+
+def test_create_index_is_idempotent(engine):
+    make_rows(engine, [1, 2])
+    for _ in range(2):
+        create_index_concurrently(engine, "ix_rows_kind", "rows", ["kind"], unique=True)
+    with engine.begin() as connection:
+        with pytest.raises(IntegrityError):
+            connection.execute(text("INSERT INTO rows (id, kind) VALUES (3, 'odd')"))
+
+def index_validity(engine, name):
+    with engine.connect() as connection:
+        return connection.execute(
+            text("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"),
+            {"name": name},
+        ).scalar()
+
+@pytest.mark.postgres
+def test_invalid_index_left_by_a_failed_build_is_rebuilt(postgres_engine):
+    make_rows(postgres_engine, [1, 2, 3])
+    # Duplicate kinds make the concurrent unique build fail halfway, leaving
+    # an INVALID index behind
+    with pytest.raises(IntegrityError):
+        create_index_concurrently(postgres_engine, "ix_rows_kind", "rows", ["kind"], unique=True)
+    assert index_validity(postgres_engine, "ix_rows_kind") is False
+
+    with postgres_engine.begin() as connection:
+        connection.execute(text("DELETE FROM rows WHERE id = 3"))
+    create_index_concurrently(postgres_engine, "ix_rows_kind", "rows", ["kind"], unique=True)
+
+    assert index_validity(postgres_engine, "ix_rows_kind") is True
+    with postgres_engine.begin() as connection:
+        with pytest.raises(IntegrityError):
+            connection.execute(text("INSERT INTO rows (id, kind) VALUES (3, 'odd')"))
+
+@pytest.mark.postgres
+def test_all_migrations_apply_on_postgres_and_resume(postgres_engine):
+    run_migrations(postgres_engine, target=6)
+    assert version(postgres_engine) == 6
+
+    run_migrations(postgres_engine)
+
+    assert version(postgres_engine) == latest_version()
+    assert run_migrations(postgres_engine) == []
@@ -0,0 +1,172 @@
+from datetime import datetime
+import asyncio
+import io
+import threading
+import pytest
+from PIL import Image
+from app.services import ocr_service
+from app.services.ocr_service import (
+    OCRBackend, OCRService, TesseractOCRBackend, _PageBatcher, get_ocr_backend, parse_invoice_text
+)
+from app.services.upstream_budget import UpstreamBudget
+
+INVOICE_TEXT = """ACME SUPPLIES LTD
+VAT Reg No: GB 123 4567 89
+Invoice date: 05/03/2024
+Due date: 2024-04-04
+Subtotal 1,000.00
+VAT @ 20% 200.00
+Total 1,200.00
+"""
+
+class FakeBackend(OCRBackend):
+    """
+    In-process backend answering each page with its size, recording batches
+    """
+    name = "fake"
+    batch_size = 3
+
+    def __init__(self, credentials=None, texts=None, error=None):
+        self.texts = texts
+        self.error = error
+        self.batches = []
+
+    async def annotate(self, pages):
+        self.batches.append(len(pages))
+        await asyncio.sleep(0)
+        if self.error:
+            raise self.error
+        if self.texts is not None:
+            return self.texts
+        return [f"page of {len(page)} bytes" for page in pages]
+
+def test_invoice_fields_are_parsed_from_text():
+    assert parse_invoice_text(INVOICE_TEXT) == {
+        "vat_number": "GB123456789",
+        "amount": 1200.0,
+        "vat_code": "20% (VAT on Expenses)",
+        # Numeric dates are day first, and the invoice date line comes first
+        "date": datetime(2024, 3, 5).isoformat(),
+    }
+
+def test_amount_falls_back_to_the_largest_figure_without_a_total_line():
+    assert parse_invoice_text("Widgets 12.50\nGadgets 7.25") == {"amount": 12.5}
+
+def test_written_dates_and_zero_rate_are_recognised():
+    fields = parse_invoice_text("Dated 3rd March 2024\nVAT 0%\nAmount due 10.00")
+    assert fields == {"date": datetime(2024, 3, 3).isoformat(), "vat_code": "Zero Rated Expenses", "amount": 10.0}
+
+def test_text_without_fields_parses_to_nothing():
+    assert parse_invoice_text("Thank you for your business") == {}
+
+def test_pages_from_concurrent_callers_share_batches():
+    backend = FakeBackend()
+
+    async def main():
+        batcher = _PageBatcher(backend, UpstreamBudget(), window=0.01)
+        return await asyncio.gather(
+            batcher.annotate([b"a", b"bb"]),
+            batcher.annotate([b"ccc", b"dddd"]),
+            batcher.annotate([b"eeeee"]),
+        )
+
+    # Each caller gets its own pages' texts back, in order
+    assert asyncio.run(main()) == [
+        ["page of 1 bytes", "page of 2 bytes"],
+        ["page of 3 bytes", "page of 4 bytes"],
+        ["page of 5 bytes"],
+    ]
+    # A full batch goes straight away; the rest once the window passes
+    assert backend.batches == [3, 2]
+
+def test_backend_errors_reach_every_caller_in_the_batch():
+    async def main():
+        batcher = _PageBatcher(FakeBackend(error=RuntimeError("quota")), UpstreamBudget(), window=0.01)
+        return await asyncio.gather(batcher.annotate([b"a"]), batcher.annotate([b"b"]), return_exceptions=True)
+
+    assert [str(result) for result in asyncio.run(main())] == ["quota", "quota"]
+
+def test_backend_returning_the_wrong_number_of_texts_fails_the_batch():
+    async def main():
+        batcher = _PageBatcher(FakeBackend(texts=["only one"]), UpstreamBudget(), window=0.01)
+        await batcher.annotate([b"a", b"b"])
+
+    with pytest.raises(RuntimeError, match="1 results for 2 pages"):
+        asyncio.run(main())
+
+def document(pages=2):
+    frames = [Image.new("RGB", (200, 100), (255, 255, 255)) for _ in range(pages)]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="TIFF", save_all=True, append_images=frames[1:])
+    return buffer.getvalue()
+
+@pytest.fixture
+def service(session_factory, monkeypatch):
+    # Preprocess in the loop's thread pool rather than spawning processes
+    monkeypatch.setattr(ocr_service, "get_process_pool", lambda: None)
+    backend = FakeBackend()
+    threads = set()
+
+    def recording_factory(**options):
+        threads.add(threading.get_ident())
+        return session_factory(**options)
+
+    service = OCRService(backend, recording_factory)
+    service.threads = threads
+    return service
+
+def test_extractions_are_cached_by_document_hash(service):
+    content = document()
+
+    first = asyncio.run(service.extract(content, "image/tiff"))
+    again = asyncio.run(service.extract(content, "image/tiff"))
+
+    assert first["cached"] is False
+    assert first["pages"] == 2
+    assert again["cached"] is True
+    assert again["document_hash"] == first["document_hash"]
+    assert service.backend.batches == [2]
+    # The cache is read and written off the event loop
+    assert threading.get_ident() not in service.threads
+
+def test_another_document_or_backend_misses_the_cache(service, session_factory):
+    asyncio.run(service.extract(document(), "image/tiff"))
+    assert asyncio.run(service.extract(document(pages=1), "image/tiff"))["cached"] is False
+
+    class OtherBackend(FakeBackend):
+        name = "other"
+
+    other = OCRService(OtherBackend(), session_factory)
+    assert asyncio.run(other.extract(document(), "image/tiff"))["cached"] is False
+
+def test_the_same_document_arriving_twice_at_once_is_processed_once(service):
+    content = document()
+
+    async def main():
+        return await asyncio.gather(service.extract(content, "image/tiff"), service.extract(content, "image/tiff"))
+
+    results = asyncio.run(main())
+    assert sorted(result["cached"] for result in results) == [False, True]
+    assert service.backend.batches == [2]
+
+def test_unreadable_documents_are_not_extracted(service):
+    assert asyncio.run(service.extract(b"not an image", "image/png")) is None
+    assert service.backend.batches == []
+
+def test_custom_backends_load_from_a_module_path():
+    backend = get_ocr_backend(f"{__name__}:FakeBackend", credentials={"key": "value"})
+    assert isinstance(backend, FakeBackend)
+    with pytest.raises(ValueError):
+        get_ocr_backend("nonexistent")
+
+def test_backends_must_implement_annotate():
+    class Incomplete(OCRBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_tesseract_without_pytesseract_fails_when_chosen(monkeypatch):
+    monkeypatch.setattr(ocr_service.importlib.util, "find_spec", lambda name: None)
+    with pytest.raises(RuntimeError, match="pytesseract"):
+        TesseractOCRBackend()
@@ -0,0 +1,186 @@
+from datetime import date, datetime
+import pytest
+from sqlalchemy import delete, func, insert, select, text, update
+from sqlalchemy.exc import IntegrityError
+from app.core import partitions
+from app.core.migrations import run_migrations
+from app.core.partitions import (
+    DEFAULT_PARTITION, DEXT_ID_TABLE, PARTITIONED_INDEXES, add_months, ensure_invoice_partitions, is_partitioned,
+    month_start, partition_invoices_table, partition_months, retire_partitions
+)
+from app.models.invoice import Invoice, InvoiceStatus
+
+pytestmark = pytest.mark.postgres
+
+INVOICES = Invoice.__table__
+OLDEST = date(2023, 1, 1)
+
+def row(dext_id, when, tenant_id="acme", **fields):
+    return {
+        "tenant_id": tenant_id, "dext_id": dext_id, "supplier_name": "Acme", "amount": 10.0, "date": when,
+        "status": InvoiceStatus.PUSHED_TO_XERO, "validation_errors": None, "created_at": datetime(2024, 1, 1),
+        "updated_at": datetime(2024, 1, 1), **fields,
+    }
+
+def add(engine, *rows):
+    with engine.begin() as connection:
+        connection.execute(insert(INVOICES), list(rows))
+
+def ids(engine, table="invoices"):
+    with engine.connect() as connection:
+        return set(connection.execute(text(f"SELECT id FROM {table}")).scalars())
+
+def dext_ids(engine, table="invoices"):
+    with engine.connect() as connection:
+        return set(connection.execute(text(f"SELECT dext_id FROM {table}")).scalars())
+
+def claims(engine):
+    with engine.connect() as connection:
+        return set(connection.execute(text(f"SELECT tenant_id, dext_id FROM {DEXT_ID_TABLE}")).all())
+
+@pytest.fixture
+def engine(postgres_engine):
+    """
+    A database at the last version before partitioning, holding invoices
+    from a closed month, an open month and without a date
+    """
+    run_migrations(postgres_engine, target=6)
+    add(
+        postgres_engine,
+        row("closed", datetime(2022, 6, 1)),
+        row("open", datetime(2023, 2, 10)),
+        row("undated", None),
+        row("open", datetime(2023, 2, 10), tenant_id="globex"),
+    )
+    return postgres_engine
+
+def test_migration_partitions_the_table_keeping_rows_and_sequence(engine):
+    before = ids(engine)
+
+    run_migrations(engine)
+
+    with engine.connect() as connection:
+        assert is_partitioned(connection)
+        months = partition_months(connection)
+        sequence = connection.execute(text("SELECT pg_get_serial_sequence('invoices', 'id')")).scalar()
+        indexes = set(connection.execute(
+            text("SELECT indexname FROM pg_indexes WHERE tablename = 'invoices'")
+        ).scalars())
+    assert ids(engine) == before
+    assert month_start(datetime.utcnow()) in months
+    # Closed months and undated rows are cold
+    assert dext_ids(engine, DEFAULT_PARTITION) >= {"closed", "undated"}
+    # The sequence moved with the table and carries on after the copied ids
+    assert sequence is not None
+    with engine.begin() as connection:
+        new_id = connection.execute(insert(INVOICES).returning(INVOICES.c.id), [row("new", datetime.utcnow())]).scalar()
+    assert new_id > max(before)
+    assert {name for name, _, _ in PARTITIONED_INDEXES} <= indexes
+    assert claims(engine) == {("acme", "closed"), ("acme", "open"), ("acme", "undated"), ("globex", "open"),
+                              ("acme", "new")}
+
+def test_dext_ids_stay_unique_whatever_the_date(engine):
+    partition_invoices_table(engine, OLDEST, months_ahead=0)
+
+    # Same document, another date and so another partition
+    with pytest.raises(IntegrityError):
+        add(engine, row("open", datetime(2022, 1, 1)))
+    with pytest.raises(IntegrityError):
+        add(engine, row("undated", datetime(2023, 2, 11)))
+    add(engine, row("open", datetime(2022, 1, 1), tenant_id="initech"))
+
+    # Moving an invoice to another month keeps its claim
+    with engine.begin() as connection:
+        connection.execute(update(INVOICES).where(INVOICES.c.dext_id == "closed").values(date=datetime(2023, 2, 1)))
+    with pytest.raises(IntegrityError):
+        add(engine, row("closed", datetime(2022, 6, 1)))
+
+    # Deleting or renaming an invoice frees its Dext id
+    with engine.begin() as connection:
+        connection.execute(delete(INVOICES).where(INVOICES.c.dext_id == "undated"))
+        connection.execute(
+            update(INVOICES).where(INVOICES.c.dext_id == "open", INVOICES.c.tenant_id == "acme").values(dext_id="moved")
+        )
+    add(engine, row("undated", datetime(2023, 2, 12)), row("open", datetime(2023, 2, 12)))
+    with pytest.raises(IntegrityError):
+        add(engine, row("moved", datetime(2023, 2, 13)))
+
+def test_changes_made_during_the_copy_are_caught_at_the_swap(engine, monkeypatch):
+    with engine.connect() as connection:
+        high = connection.execute(select(func.max(INVOICES.c.id))).scalar()
+
+    class ChangedAfterCopy(list):
+        """
+        Changes the old table once, when the copied shadow table's indexes
+        are built
+        """
+        changed = False
+
+        def __iter__(self):
+            if not self.changed:
+                self.changed = True
+                with engine.begin() as connection:
+                    connection.execute(
+                        update(INVOICES).where(INVOICES.c.dext_id == "closed")
+                        .values(supplier_name="Renamed", updated_at=datetime.utcnow())
+                    )
+                    connection.execute(delete(INVOICES).where(INVOICES.c.dext_id == "undated"))
+                    connection.execute(insert(INVOICES), [row("late", datetime(2023, 2, 20))])
+            return super().__iter__()
+
+    monkeypatch.setattr(partitions, "PARTITIONED_INDEXES", ChangedAfterCopy(PARTITIONED_INDEXES))
+
+    partition_invoices_table(engine, OLDEST, months_ahead=0, batch_size=1)
+
+    with engine.connect() as connection:
+        assert is_partitioned(connection)
+        assert connection.execute(
+            select(INVOICES.c.supplier_name).where(INVOICES.c.dext_id == "closed")
+        ).scalar() == "Renamed"
+    assert dext_ids(engine) == {"closed", "open", "late"}
+    assert max(ids(engine)) > high
+    assert claims(engine) == {("acme", "closed"), ("acme", "open"), ("globex", "open"), ("acme", "late")}
+
+def test_leftovers_of_an_interrupted_run_are_rebuilt(engine):
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE invoices_partitioned (id INTEGER)"))
+        connection.execute(text(f"CREATE TABLE {DEXT_ID_TABLE} (tenant_id VARCHAR, dext_id VARCHAR)"))
+        connection.execute(text(f"INSERT INTO {DEXT_ID_TABLE} VALUES ('acme', 'stale')"))
+
+    partition_invoices_table(engine, OLDEST, months_ahead=0)
+    # Running again once partitioned does nothing
+    partition_invoices_table(engine, OLDEST, months_ahead=0)
+
+    assert dext_ids(engine) == {"closed", "open", "undated"}
+    assert ("acme", "stale") not in claims(engine)
+
+def test_open_months_get_partitions_taking_their_rows_from_the_default(engine):
+    partition_invoices_table(engine, OLDEST, months_ahead=0)
+    # No partition covers May 2023 yet, so it lands in the default partition
+    add(engine, row("may", datetime(2023, 5, 3)))
+    assert "may" in dext_ids(engine, DEFAULT_PARTITION)
+
+    created = ensure_invoice_partitions(engine, OLDEST, months_ahead=0)
+
+    assert "invoices_p2023_05" in created
+    assert dext_ids(engine, "invoices_p2023_05") == {"may"}
+    assert "may" not in dext_ids(engine, DEFAULT_PARTITION)
+    assert ensure_invoice_partitions(engine, OLDEST, months_ahead=0) == []
+    # The moved row kept its claim
+    with pytest.raises(IntegrityError):
+        add(engine, row("may", datetime(2023, 6, 1)))
+
+def test_retired_partitions_hand_their_rows_to_the_default(engine):
+    partition_invoices_table(engine, OLDEST, months_ahead=0)
+    before = ids(engine)
+
+    retired = retire_partitions(engine, add_months(OLDEST, 2))
+
+    assert retired == ["invoices_p2023_02"]
+    with engine.connect() as connection:
+        assert date(2023, 2, 1) not in partition_months(connection)
+    assert ids(engine) == before
+    assert dext_ids(engine, DEFAULT_PARTITION) == {"closed", "open", "undated"}
+    with pytest.raises(IntegrityError):
+        add(engine, row("open", datetime(2023, 2, 10)))
+    assert retire_partitions(engine, add_months(OLDEST, 2)) == []
@@ -0,0 +1,112 @@
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+import asyncio
+import json
+import os
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.api import admin
+from app.core import profiling
+from app.core.config import settings
+from app.core.security import create_access_token, require_admin
+
+@pytest.fixture(autouse=True)
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(settings, "PROFILE_SYNC_RUNS", False)
+    monkeypatch.setattr(settings, "PROFILE_DIR", str(tmp_path / "profiles"))
+    return tmp_path / "profiles"
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.middleware("http")(profiling.profiling_middleware)
+
+    @app.get("/work")
+    async def work():
+        await asyncio.sleep(0.01)
+        return {"ok": True}
+
+    app.include_router(admin.router, prefix="/api")
+    app.dependency_overrides[require_admin] = lambda: {"sub": "test", "role": "admin"}
+    with TestClient(app) as client:
+        yield client
+
+def bearer(**claims):
+    return {"Authorization": f"Bearer {create_access_token({'sub': 'test', **claims})}"}
+
+def test_admin_requests_with_the_header_are_profiled(client, profile_dir):
+    response = client.get("/work", headers={**bearer(role="admin"), profiling.PROFILE_HEADER: "html"})
+
+    profile_id = response.headers[profiling.PROFILE_ID_HEADER]
+    assert profiling.get_profile_path(profile_id) == str(profile_dir / f"{profile_id}.html")
+    [metadata] = profiling.list_profiles()
+    assert metadata["id"] == profile_id
+    assert metadata["label"] == "GET /work"
+    assert metadata["format"] == "html"
+
+@pytest.mark.parametrize("headers", [{}, bearer(), {"Authorization": "Bearer not-a-token"}])
+def test_other_callers_are_not_profiled(client, profile_dir, headers):
+    response = client.get("/work", headers={**headers, profiling.PROFILE_HEADER: "1"})
+
+    assert response.status_code == 200
+    assert profiling.PROFILE_ID_HEADER not in response.headers
+    assert profiling.list_profiles() == []
+
+def test_requests_without_the_header_are_not_profiled(client):
+    assert profiling.PROFILE_ID_HEADER not in client.get("/work", headers=bearer(role="admin")).headers
+
+def test_profile_saves_a_speedscope_file_and_its_metadata(profile_dir):
+    async def main():
+        async with profiling.profile("sync-run") as profile_id:
+            # Nested profiles are skipped rather than clashing
+            async with profiling.profile("inner") as inner:
+                assert inner is None
+            await asyncio.sleep(0.01)
+        return profile_id
+
+    profile_id = asyncio.run(main())
+
+    with open(profile_dir / f"{profile_id}.speedscope.json") as f:
+        assert json.load(f)["$schema"].startswith("https://www.speedscope.app")
+    with open(profile_dir / f"{profile_id}.meta.json") as f:
+        metadata = json.load(f)
+    assert metadata["file"] == f"{profile_id}.speedscope.json"
+    assert metadata["wall_time"] > 0
+
+def test_profile_ids_cannot_escape_the_profile_dir():
+    assert profiling.get_profile_path("../secrets") is None
+
+def test_sync_runs_are_only_profiled_within_the_window(profile_dir):
+    assert isinstance(profiling.sync_run_profile(), nullcontext)
+
+    until = profiling.profile_sync_runs_for(timedelta(minutes=5))
+
+    assert profiling.sync_runs_profiled_until() == until
+    # Written where every worker, and a restarted one, reads it
+    assert os.path.exists(profile_dir / profiling.SYNC_PROFILE_FILE)
+    assert not isinstance(profiling.sync_run_profile(), nullcontext)
+
+    (profile_dir / profiling.SYNC_PROFILE_FILE).write_text((datetime.utcnow() - timedelta(seconds=1)).isoformat())
+    assert profiling.sync_runs_profiled_until() is None
+    assert isinstance(profiling.sync_run_profile(), nullcontext)
+
+def test_profiling_window_is_capped(profile_dir):
+    until = profiling.profile_sync_runs_for(timedelta(days=7))
+    assert until <= datetime.utcnow() + profiling.MAX_SYNC_PROFILE_WINDOW
+
+def test_admin_endpoint_opens_and_closes_the_window(client):
+    opened = client.post("/api/admin/profiling", json={"syncRunsMinutes": 30}).json()
+
+    assert opened["syncRuns"] is False
+    assert opened["syncRunsUntil"] == client.get("/api/admin/profiling").json()["syncRunsUntil"]
+    assert datetime.fromisoformat(opened["syncRunsUntil"]) > datetime.utcnow() + timedelta(minutes=29)
+
+    closed = client.post("/api/admin/profiling", json={"syncRunsMinutes": 0}).json()
+    assert closed["syncRunsUntil"] is None
+    assert client.post("/api/admin/profiling", json={"syncRunsMinutes": 60 * 48}).status_code == 400
+
+def test_admin_endpoint_refuses_when_profiling_is_disabled(client, monkeypatch):
+    monkeypatch.setattr(settings, "PROFILING_ENABLED", False)
+    assert client.post("/api/admin/profiling", json={"syncRunsMinutes": 5}).status_code == 400
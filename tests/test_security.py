@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta, timezone
+import time
+import jwt
+import pytest
+from fastapi import HTTPException
+from app.core import security
+from app.core.security import (
+    ALGORITHM, MAX_TOKEN_LIFETIME, create_access_token, retire_signing_key, revoke_token, token_cache, verify_token
+)
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    """
+    Two signing keys, "old" and the active "new", and no cached or revoked tokens
+    """
+    monkeypatch.setattr(security, "SIGNING_KEYS", {"old": "old-secret", "new": "new-secret"})
+    monkeypatch.setattr(security, "ACTIVE_KID", "new")
+    monkeypatch.setattr(security, "revoked_tokens", {})
+    monkeypatch.setattr(security, "revoked_token_ids", {})
+    token_cache.clear()
+    yield
+    token_cache.clear()
+
+def signed(claims, kid="new", key=None, algorithm=ALGORITHM):
+    now = int(time.time())
+    claims = {"sub": "test", "iat": now, "exp": now + 60, **claims}
+    return jwt.encode(claims, key or security.SIGNING_KEYS.get(kid, "unknown"), algorithm=algorithm,
+                      headers={"kid": kid})
+
+def rejected(token, detail="Invalid token"):
+    with pytest.raises(HTTPException) as error:
+        verify_token(token)
+    assert error.value.status_code == 401
+    assert error.value.detail == detail
+
+def move_clock(monkeypatch, seconds):
+    """
+    Shift the clocks of both the token cache and PyJWT's expiry check
+    """
+    now = time.time() + seconds
+
+    class Later(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(now, tz or timezone.utc)
+
+    monkeypatch.setattr(security.time, "time", lambda: now)
+    monkeypatch.setattr(jwt.api_jwt, "datetime", Later)
+
+def test_verified_tokens_are_served_from_the_cache():
+    token = create_access_token({"sub": "test"})
+    payload = verify_token(token)
+
+    assert token_cache.get(security._token_digest(token), time.time()) is payload
+    assert verify_token(token) is payload
+
+def test_cached_token_is_rejected_once_it_expires(monkeypatch):
+    token = create_access_token({"sub": "test"}, timedelta(minutes=1))
+    verify_token(token)
+
+    move_clock(monkeypatch, 120)
+
+    rejected(token, "Token has expired")
+
+def test_token_signed_with_a_retired_key_is_rejected():
+    token = create_access_token({"sub": "test"})
+    old = signed({}, kid="old")
+    verify_token(old)
+
+    retire_signing_key("old")
+
+    rejected(old)
+    # Tokens signed with the other keys are unaffected
+    assert verify_token(token)["sub"] == "test"
+
+def test_active_key_cannot_be_retired():
+    with pytest.raises(ValueError):
+        retire_signing_key("new")
+
+def test_token_with_an_unknown_kid_is_rejected():
+    rejected(signed({}, kid="elsewhere", key="new-secret"))
+
+def test_token_signed_with_another_keys_secret_is_rejected():
+    rejected(signed({}, kid="new", key="old-secret"))
+
+def test_revocation_by_jti_covers_every_token_with_it():
+    first = create_access_token({"sub": "test", "jti": "session-1"})
+    second = create_access_token({"sub": "test", "jti": "session-1"}, timedelta(minutes=5))
+    other = create_access_token({"sub": "test"})
+    verify_token(first)
+
+    revoke_token(jti="session-1")
+
+    rejected(first, "Token has been revoked")
+    rejected(second, "Token has been revoked")
+    assert verify_token(other)["sub"] == "test"
+
+def test_revocation_by_raw_token():
+    token = create_access_token({"sub": "test"})
+    verify_token(token)
+
+    revoke_token(token)
+
+    rejected(token, "Token has been revoked")
+    # Its jti goes too, so a re-encoding of the same claims is refused
+    assert jwt.decode(token, options={"verify_signature": False})["jti"] in security.revoked_token_ids
+
+def test_revocations_are_kept_no_longer_than_the_max_lifetime():
+    revoke_token(jti="forever")
+    assert security.revoked_token_ids["forever"] <= time.time() + MAX_TOKEN_LIFETIME
+
+def test_token_living_longer_than_the_max_lifetime_is_rejected():
+    now = int(time.time())
+    rejected(signed({"iat": now, "exp": now + MAX_TOKEN_LIFETIME + 60}), "Token lifetime is too long")
+    # Without an iat the lifetime counts from now
+    no_iat = jwt.encode({"sub": "test", "exp": now + MAX_TOKEN_LIFETIME + 60}, "new-secret", algorithm=ALGORITHM,
+                        headers={"kid": "new"})
+    rejected(no_iat, "Token lifetime is too long")
+
+def test_token_without_expiry_is_rejected():
+    token = jwt.encode({"sub": "test"}, "new-secret", algorithm=ALGORITHM, headers={"kid": "new"})
+    rejected(token, "Token has no expiry")
+
+def test_long_lived_tokens_are_not_issued():
+    with pytest.raises(ValueError):
+        create_access_token({"sub": "test"}, timedelta(seconds=MAX_TOKEN_LIFETIME + 1))
+
+def test_unsigned_token_is_rejected():
+    now = int(time.time())
+    token = jwt.encode({"sub": "test", "iat": now, "exp": now + 60}, None, algorithm="none", headers={"kid": "new"})
+    rejected(token)
+
+@pytest.mark.parametrize("keys", ["abc", ",", " : "])
+def test_signing_keys_without_a_pair_are_a_configuration_error(monkeypatch, keys):
+    monkeypatch.setenv("JWT_SIGNING_KEYS", keys)
+    with pytest.raises(ValueError, match="JWT_SIGNING_KEYS"):
+        security._load_signing_keys()
+
+def test_active_kid_must_be_a_loaded_key(monkeypatch):
+    monkeypatch.setenv("JWT_ACTIVE_KID", "missing")
+    with pytest.raises(ValueError, match="JWT_ACTIVE_KID"):
+        security._active_kid({"a": "secret"})
+    monkeypatch.delenv("JWT_ACTIVE_KID")
+    assert security._active_kid({"a": "secret", "b": "other"}) == "a"
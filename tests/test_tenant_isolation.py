@@ -0,0 +1,169 @@
+from datetime import datetime, timedelta
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+from app.api import invoices, settings as settings_api, sync, webhooks
+from app.core.config import settings
+from app.core.database import get_db
+from app.core.dependencies import get_webhook_queue
+from app.core.security import create_access_token
+from app.models.invoice import Invoice, InvoiceStatus
+from app.models.settings import Settings
+from app.services.sync_scheduler import SyncScheduler, UnknownTenantError
+from app.services.xero_service import XeroService
+
+def auth(claims, tenant=None):
+    headers = {"Authorization": "Bearer " + create_access_token(claims, timedelta(minutes=5))}
+    if tenant:
+        headers["X-Tenant-ID"] = tenant
+    return headers
+
+class RecordingQueue:
+    def __init__(self):
+        self.events = []
+
+    def enqueue(self, event):
+        self.events.append(event)
+        return True
+
+@pytest.fixture
+def tenants(session_factory):
+    db = session_factory()
+    db.add(Settings(tenant_id="acme", dext_webhook_secret="acme-secret", xero_tenant_id="xt-acme"))
+    db.add(Settings(tenant_id="globex", dext_api_key="globex-key", xero_tenant_id="xt-globex"))
+    db.execute(insert(Invoice.__table__), [
+        {"tenant_id": tenant_id, "dext_id": f"{tenant_id}-1", "supplier_name": "S", "amount": 10.0,
+         "date": datetime(2024, 1, 1), "status": InvoiceStatus.PUSHED_TO_XERO}
+        for tenant_id in ("acme", "globex")
+    ])
+    db.commit()
+    db.close()
+    return session_factory
+
+@pytest.fixture
+def client(tenants):
+    app = FastAPI()
+    for module in (invoices, settings_api, sync, webhooks):
+        app.include_router(module.router, prefix="/api")
+    queue = RecordingQueue()
+
+    def get_test_db():
+        db = tenants()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = get_test_db
+    app.dependency_overrides[get_webhook_queue] = lambda: queue
+    with TestClient(app) as client:
+        client.queue = queue
+        yield client
+
+def test_tenant_header_is_limited_to_the_token_tenants(client):
+    acme = {"sub": "user", "tenants": ["acme"]}
+    assert client.get("/api/settings", headers=auth(acme, "acme")).status_code == 200
+    assert client.get("/api/settings", headers=auth(acme, "globex")).status_code == 403
+    # A token without a tenants claim only acts for the default tenant
+    assert client.get("/api/settings", headers=auth({"sub": "user"}, "globex")).status_code == 403
+    assert client.get("/api/settings", headers=auth({"sub": "user"})).status_code == 200
+    assert client.get("/api/settings", headers=auth({"sub": "admin", "role": "admin"}, "globex")).status_code == 200
+
+def test_invoice_list_only_shows_the_tenants_own_invoices(client):
+    response = client.get("/api/invoices", headers=auth({"sub": "user", "tenants": ["acme"]}))
+
+    assert response.status_code == 200
+    assert [invoice["dext_id"] for invoice in response.json()] == ["acme-1"]
+
+def test_sync_run_refuses_tenants_outside_the_token(client):
+    response = client.post(
+        "/api/sync/run", json={"tenants": ["globex"]}, headers=auth({"sub": "user", "tenants": ["acme"]})
+    )
+    assert response.status_code == 403
+
+def test_dext_webhooks_are_checked_against_the_tenants_own_secret(client, monkeypatch):
+    monkeypatch.setattr(settings, "DEXT_WEBHOOK_SECRET", "global-secret")
+
+    def deliver(tenant, secret):
+        body = json.dumps({"id": "delivery", "data": {"id": "doc"}}).encode()
+        signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        params = {"tenant": tenant} if tenant else None
+        return client.post("/api/webhooks/dext", params=params, content=body, headers={"X-Dext-Signature": signature})
+
+    assert deliver("acme", "acme-secret").status_code == 200
+    assert client.queue.events[-1].tenant_id == "acme"
+    # The deployment-wide secret only signs the default tenant's events
+    assert deliver("acme", "global-secret").status_code == 401
+    assert deliver("globex", "global-secret").status_code == 401
+    assert deliver(None, "global-secret").status_code == 200
+    assert client.queue.events[-1].tenant_id == settings.DEFAULT_TENANT_ID
+
+def test_xero_webhooks_are_routed_by_the_signed_payload(client, monkeypatch):
+    monkeypatch.setattr(settings, "XERO_WEBHOOK_KEY", "xero-key")
+    monkeypatch.setattr(settings, "XERO_TENANT_ID", "xt-default")
+    body = json.dumps({"events": [
+        {"resourceId": f"r-{xero_tenant}", "eventDateUtc": "2024-01-01T00:00:00", "eventType": "UPDATE",
+         "eventCategory": "INVOICE", "tenantId": xero_tenant}
+        for xero_tenant in ("xt-acme", "xt-default", "xt-unknown")
+    ]}).encode()
+    signature = base64.b64encode(hmac.new(b"xero-key", body, hashlib.sha256).digest()).decode()
+
+    # ?tenant= is not signed, so it is ignored
+    response = client.post(
+        "/api/webhooks/xero", params={"tenant": "globex"}, content=body, headers={"x-xero-signature": signature}
+    )
+
+    assert response.status_code == 200
+    assert [(event.resource_id, event.tenant_id) for event in client.queue.events] == [
+        ("r-xt-acme", "acme"), ("r-xt-default", settings.DEFAULT_TENANT_ID)
+    ]
+
+def test_only_the_default_tenant_falls_back_to_global_credentials(tenants, monkeypatch):
+    monkeypatch.setattr(settings, "DEXT_API_KEY", "global-dext-key")
+    monkeypatch.setattr(settings, "XERO_TENANT_ID", "xt-default")
+    scheduler = SyncScheduler(validation_service=None, session_factory=tenants)
+    db = tenants()
+    try:
+        with pytest.raises(UnknownTenantError):
+            scheduler.tenant_context(db, "nobody")
+
+        acme = scheduler.tenant_context(db, "acme").ingestion
+        assert acme.dext_service.api_key == ""
+        assert acme.xero_service.xero_tenant_id == "xt-acme"
+
+        globex = scheduler.tenant_context(db, "globex").ingestion
+        assert globex.dext_service.api_key == "globex-key"
+
+        default = scheduler.tenant_context(db, settings.DEFAULT_TENANT_ID).ingestion
+        assert default.dext_service.api_key == "global-dext-key"
+        assert default.xero_service.xero_tenant_id == "xt-default"
+    finally:
+        db.close()
+
+def test_xero_requests_name_the_tenants_organisation(monkeypatch):
+    sent = []
+
+    class Response:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"Invoices": [{"InvoiceID": "inv"}]}
+
+    class Session:
+        def request(self, method, url, **kwargs):
+            sent.append(kwargs["headers"])
+            return Response()
+
+    monkeypatch.setattr("app.services.xero_service.upstream_session", lambda upstream: Session())
+    service = XeroService(access_token="token", token_expires_at=datetime.now() + timedelta(hours=1),
+                          xero_tenant_id="xt-acme")
+
+    assert asyncio.run(service.get_resource("Invoices", "inv")) == {"InvoiceID": "inv"}
+    assert sent[0]["xero-tenant-id"] == "xt-acme"
@@ -0,0 +1,81 @@
+import asyncio
+import gzip
+import httpx
+import pytest
+import requests
+from app.core.config import settings
+from app.core.upstream_traffic import (
+    RECORD, REPLAY, UpstreamTraffic, _httpx_transport_class, request_key, upstream_session, upstream_traffic
+)
+
+def test_tenant_header_is_digested_into_the_key(monkeypatch):
+    monkeypatch.setattr(settings, "UPSTREAM_TRAFFIC_SECRET", "secret")
+    url = "https://api.xero.com/Invoices?b=2&a=1"
+
+    acme = request_key("xero", "get", url, None, {"Xero-Tenant-Id": "acme-org", "Authorization": "Bearer a"})
+    # The organisation id wins over a refreshed access token
+    assert acme == request_key("xero", "GET", url, None, {"xero-tenant-id": "acme-org", "Authorization": "Bearer b"})
+    assert acme != request_key("xero", "GET", url, None, {"xero-tenant-id": "globex-org"})
+    assert acme[:4] == ("xero", "GET", "/Invoices?a=1&b=2", "")
+    assert "acme-org" not in acme[4]
+
+    monkeypatch.setattr(settings, "UPSTREAM_TRAFFIC_SECRET", "other")
+    assert request_key("xero", "GET", url, None, {"xero-tenant-id": "acme-org"}) != acme
+
+def test_replay_never_answers_one_tenant_with_anothers_response(tmp_path):
+    archive = str(tmp_path / "traffic.jsonl.gz")
+    traffic = UpstreamTraffic(RECORD, archive)
+    traffic.record("dext", "GET", "https://dext/invoices", None, {"Authorization": "Bearer acme-key"}, 0.01,
+                   status=200, headers={"Content-Type": "application/json"}, content=b"[]")
+    traffic.close()
+
+    assert b"acme-key" not in gzip.open(archive).read()
+    traffic.configure(REPLAY, archive, speed=0)
+    assert traffic.lookup("dext", "GET", "https://elsewhere/invoices", None, {"Authorization": "Bearer acme-key"})
+    assert traffic.lookup("dext", "GET", "https://dext/invoices", None, {"Authorization": "Bearer globex-key"}) is None
+    assert traffic.stats == {"recorded": 0, "replayed": 1, "misses": 1}
+
+def test_session_replays_with_the_same_credentials(tmp_path):
+    archive = str(tmp_path / "traffic.jsonl.gz")
+    traffic = UpstreamTraffic(RECORD, archive)
+    traffic.record("dext", "GET", "http://dext/invoices", None, {"Authorization": "Bearer acme-key"}, 0.0,
+                   status=200, headers={}, content=b'{"invoices": []}')
+    traffic.close()
+    with upstream_traffic.using(REPLAY, archive, 0):
+        session = upstream_session("dext")
+        assert session.get("http://dext/invoices", headers={"Authorization": "Bearer acme-key"}).json() == {
+            "invoices": []
+        }
+        with pytest.raises(requests.exceptions.ConnectionError):
+            session.get("http://dext/invoices", headers={"Authorization": "Bearer globex-key"})
+
+def test_httpx_transport_records_and_replays_gzipped_responses(tmp_path):
+    body = b'{"choices": [{"message": {"content": "ok"}}]}'
+
+    def upstream(request):
+        # As OpenAI answers: compressed, with its length on the wire
+        return httpx.Response(200, headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+                              content=gzip.compress(body))
+
+    archive = str(tmp_path / "traffic.jsonl.gz")
+    url = "https://api.openai.com/v1/chat/completions"
+    headers = {"Authorization": "Bearer key"}
+
+    async def post(traffic):
+        transport = _httpx_transport_class()("openai", traffic)
+        transport.transport = httpx.MockTransport(upstream)
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await client.post(url, headers=headers, content=b"{}")
+
+    traffic = UpstreamTraffic(RECORD, archive)
+    recorded = asyncio.run(post(traffic))
+    traffic.close()
+
+    assert recorded.content == body
+    assert recorded.json()["choices"][0]["message"]["content"] == "ok"
+    assert traffic.stats["recorded"] == 1
+
+    traffic.configure(REPLAY, archive, speed=0)
+    replayed = asyncio.run(post(traffic))
+    assert replayed.status_code == 200
+    assert replayed.content == body
@@ -0,0 +1,205 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import asyncio
+import logging
+from app.models.invoice import Invoice, InvoiceStatus
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.upstream_budget import UpstreamBudget
+from app.services.webhook_service import WebhookEvent, WebhookProcessor, WebhookQueue
+
+START = datetime(2024, 1, 1)
+
+def event(event_id, resource_id="doc", seconds=0, tenant_id="acme"):
+    return WebhookEvent("dext", "document", resource_id, event_id, START + timedelta(seconds=seconds), tenant_id)
+
+class ImmediateRetryQueue(WebhookQueue):
+    """
+    Retries and deferrals without the backoff delay
+    """
+    def _schedule(self, event, delay):
+        super()._schedule(event, 0)
+
+class Handler:
+    """
+    Records handled event ids, failing the first `failures` calls
+    """
+    def __init__(self, failures=0, error=RuntimeError("boom")):
+        self.failures = failures
+        self.error = error
+        self.handled = []
+
+    async def __call__(self, event):
+        self.handled.append(event.event_id)
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+
+def run(handler, scenario, workers=1, max_attempts=3):
+    async def main():
+        queue = ImmediateRetryQueue(handler, workers=workers, max_attempts=max_attempts)
+        await queue.start()
+        try:
+            await scenario(queue)
+        finally:
+            await queue.stop()
+        return queue
+    return asyncio.run(main())
+
+def test_redeliveries_are_dropped_while_queued_and_once_handled():
+    handler = Handler()
+
+    async def scenario(queue):
+        assert queue.enqueue(event("e1"))
+        assert not queue.enqueue(event("e1"))
+        await queue.drain()
+        assert not queue.enqueue(event("e1"))
+
+    queue = run(handler, scenario)
+    assert handler.handled == ["e1"]
+    assert queue.stats["duplicates"] == 2
+
+def test_redelivery_is_dropped_while_a_failed_event_awaits_its_retry():
+    handler = Handler(failures=1)
+
+    async def scenario(queue):
+        assert queue.enqueue(event("e1"))
+        await asyncio.sleep(0.01)
+        assert not queue.enqueue(event("e1"))
+        await queue.drain()
+
+    assert run(handler, scenario).stats["processed"] == 1
+    assert handler.handled == ["e1", "e1"]
+
+def test_an_event_given_up_on_is_accepted_again(caplog):
+    handler = Handler(failures=3)
+
+    async def scenario(queue):
+        assert queue.enqueue(event("e1"))
+        await queue.drain()
+        assert queue.stats["failed"] == 1
+        assert queue.enqueue(event("e1"))
+        await queue.drain()
+
+    with caplog.at_level(logging.INFO, logger="app.webhooks"):
+        queue = run(handler, scenario)
+    assert handler.handled == ["e1"] * 4
+    assert queue.stats["processed"] == 1
+    assert "Giving up on webhook event e1 after 3 attempts" in caplog.messages
+
+def test_queued_events_for_a_resource_are_coalesced_into_the_newest():
+    handler = Handler()
+
+    async def scenario(queue):
+        # No worker runs until the first await, so both are pending together
+        assert queue.enqueue(event("older", seconds=1))
+        assert queue.enqueue(event("newer", seconds=2))
+        await queue.drain()
+        # Both ids were settled with the handled event
+        assert not queue.enqueue(event("older", seconds=1))
+        assert not queue.enqueue(event("newer", seconds=2))
+
+    queue = run(handler, scenario)
+    assert handler.handled == ["newer"]
+    assert queue.stats["coalesced"] == 1
+
+def test_events_older_than_the_last_handled_one_are_stale():
+    handler = Handler()
+
+    async def scenario(queue):
+        queue.enqueue(event("newer", seconds=5))
+        await queue.drain()
+        assert not queue.enqueue(event("older", seconds=1))
+        await queue.drain()
+
+    queue = run(handler, scenario)
+    assert handler.handled == ["newer"]
+    assert queue.stats["stale"] == 1
+
+def test_resources_of_different_tenants_are_kept_apart():
+    handler = Handler()
+
+    async def scenario(queue):
+        queue.enqueue(event("a", tenant_id="acme"))
+        queue.enqueue(event("b", tenant_id="globex"))
+        await queue.drain()
+
+    queue = run(handler, scenario)
+    assert sorted(handler.handled) == ["a", "b"]
+    assert queue.stats["coalesced"] == 0
+
+def test_a_resource_is_handled_by_one_worker_at_a_time():
+    running = {"now": 0, "most": 0}
+    handled = []
+
+    async def scenario(queue):
+        gate = asyncio.Event()
+
+        async def handler(event):
+            running["now"] += 1
+            running["most"] = max(running["most"], running["now"])
+            handled.append(event.event_id)
+            await gate.wait()
+            running["now"] -= 1
+
+        queue.handler = handler
+        queue.enqueue(event("first", seconds=1))
+        await asyncio.sleep(0.01)
+        # Picked up by the idle worker while the first is still running
+        queue.enqueue(event("second", seconds=2))
+        await asyncio.sleep(0.01)
+        gate.set()
+        await queue.drain()
+
+    run(Handler(), scenario, workers=2)
+    assert handled == ["first", "second"]
+    assert running["most"] == 1
+
+def test_open_circuit_defers_without_using_an_attempt():
+    handler = Handler(failures=5, error=CircuitOpenError("xero", 30))
+
+    async def scenario(queue):
+        queue.enqueue(event("e1"))
+        await queue.drain()
+
+    queue = run(handler, scenario, max_attempts=2)
+    assert handler.handled == ["e1"] * 6
+    assert queue.stats["deferred"] == 5
+    assert queue.stats["processed"] == 1
+    assert queue.stats["failed"] == 0
+
+class XeroInvoices:
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    async def get_resource(self, resource, resource_id):
+        assert resource == "Invoices"
+        return {"InvoiceID": resource_id, "Status": self.statuses[resource_id]}
+
+def apply_xero_event(session_factory, statuses, resource_id):
+    xero = XeroInvoices(statuses)
+    scheduler = SimpleNamespace(
+        budget=UpstreamBudget(),
+        tenant_context=lambda db, tenant_id: SimpleNamespace(ingestion=SimpleNamespace(xero_service=xero)),
+    )
+    processor = WebhookProcessor(scheduler, session_factory)
+    xero_event = WebhookEvent("xero", "INVOICE", resource_id, "e1", START, "acme")
+    asyncio.run(processor.handle(xero_event))
+
+def test_xero_invoice_voided_in_xero_is_marked_as_an_error(session_factory):
+    db = session_factory()
+    for xero_id in ("x-void", "x-paid"):
+        db.add(Invoice(tenant_id="acme", dext_id=f"d-{xero_id}", xero_invoice_id=xero_id, date=START,
+                       status=InvoiceStatus.PUSHED_TO_XERO))
+    db.commit()
+    db.close()
+    statuses = {"x-void": "VOIDED", "x-paid": "PAID"}
+
+    for xero_id in statuses:
+        apply_xero_event(session_factory, statuses, xero_id)
+
+    db = session_factory()
+    invoices = {invoice.xero_invoice_id: invoice for invoice in db.query(Invoice)}
+    assert invoices["x-void"].status == InvoiceStatus.ERROR
+    assert invoices["x-void"].validation_errors == {"xero_error": "Invoice voided in Xero"}
+    assert invoices["x-paid"].status == InvoiceStatus.PUSHED_TO_XERO
+    db.close()